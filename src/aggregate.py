@@ -0,0 +1,311 @@
+"""
+Replicate aggregation of parsed level 3 profiles.
+
+Level 3 profiles (see parser.parsing_level3_cp) are turned into consensus
+signatures in two steps, as in the CMap pipeline (Subramanian et al.,
+2017; cmapPy.math):
+  robust_zscore   every gene of every profile is z-scored against the
+                  median and MAD of a reference population: the profiles of
+                  the same plate, or the vehicle controls of the plate.
+  consensus       replicates (same cell line, compound, dose and time) are
+                  collapsed into one signature, by default with MODZ: a
+                  weighted average where the weight of a replicate is its
+                  mean Spearman correlation to the other replicates.
+
+Instead of a Python loop over the groups, the rows are sorted by group
+once (query.group_bounds), groups of the same size are stacked into a
+(groups x size x genes) array, and every statistic of a batch is a single
+NumPy operation (median along an axis, batched matrix products for the
+correlations). Batches are at most memory_budget bytes, and with n_jobs
+they are processed by several threads (NumPy releases the GIL in these
+operations, and the threads write straight into the output).
+"""
+from __future__ import unicode_literals, print_function, division
+from typing import Callable, List, Optional, Sequence, Tuple, Union
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .dataset import LincsDataset
+from .instrument import current_stage, instrumented
+from .parallel import effective_n_jobs
+from .query import group_bounds
+from .similarity import _as_dataset, _prepare
+
+__author__ = "Hosein Fooladi"
+__email__ = "fooladi.hosein@gmail.com"
+
+# Fields identifying the replicates of an experiment
+REPLICATE_FIELDS = ('cell_id', 'pert_id', 'pert_dose', 'pert_time')
+# Normalization groups when the dataset has no plate field
+POPULATION_FIELDS = ('cell_id', 'pert_time')
+PLATE_FIELD = 'rna_plate'
+METHODS = ('modz', 'mean', 'median')
+
+# Scale of the MAD of normally distributed data
+MAD_SCALE = 1.4826
+# Intermediate data of a batch of groups (default 256 MiB)
+DEFAULT_MEMORY_BUDGET = 256 * 1024**2
+
+
+def _batches(sizes: np.ndarray, row_bytes: int,
+             memory_budget: Optional[int]) -> List[np.ndarray]:
+  """Groups of equal size, in batches of at most memory_budget bytes"""
+  budget = DEFAULT_MEMORY_BUDGET if memory_budget is None else memory_budget
+  assert budget > 0, "memory_budget must be positive"
+  by_size = np.argsort(sizes, kind='stable')
+  bounds = np.flatnonzero(np.diff(sizes[by_size])) + 1
+  batches = []
+  for groups in np.split(by_size, bounds):
+    if not len(groups):
+      continue
+    step = max(1, int(budget // max(sizes[groups[0]] * row_bytes, 1)))
+    batches.extend(groups[i:i + step] for i in range(0, len(groups), step))
+  return batches
+
+
+def _run(function: Callable, tasks: Sequence, n_jobs: Optional[int]) -> None:
+  n_jobs = effective_n_jobs(n_jobs)
+  if n_jobs == 1 or len(tasks) <= 1:
+    for task in tasks:
+      function(task)
+  else:
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+      list(executor.map(function, tasks))
+
+
+def _group_rows(order: np.ndarray, starts: np.ndarray, groups: np.ndarray,
+                size: int) -> np.ndarray:
+  """(groups x size) rows of groups of the same size"""
+  return order[starts[groups][:, None] + np.arange(size)]
+
+
+def _robust_stats(expression: np.ndarray, order: np.ndarray,
+                  starts: np.ndarray, ends: np.ndarray,
+                  memory_budget: Optional[int],
+                  n_jobs: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+  """Median and MAD of every gene in every group"""
+  sizes = ends - starts
+  median = np.empty((len(sizes), expression.shape[1]), dtype=np.float32)
+  mad = np.empty_like(median)
+
+  def compute(groups: np.ndarray) -> None:
+    block = expression[_group_rows(order, starts, groups, sizes[groups[0]])]
+    center = np.median(block, axis=1)
+    median[groups] = center
+    mad[groups] = np.median(np.abs(block - center[:, None]), axis=1)
+
+  # block, deviations and the partition copies of np.median
+  _run(compute, _batches(sizes, 16 * expression.shape[1], memory_budget),
+       n_jobs)
+  return median, mad
+
+
+def _group_keys(dataset: LincsDataset, fields: Sequence[str],
+                field_codes: List[np.ndarray]) -> List[tuple]:
+  values = [dataset.categories[field][codes]
+            for field, codes in zip(fields, field_codes)]
+  return list(zip(*values))
+
+
+@instrumented()
+def robust_zscore(data: Union[str, List, LincsDataset],
+                  controls: Optional[Union[str, List, LincsDataset]] = None,
+                  by: Optional[Sequence[str]] = None,
+                  min_mad: float = 0.1,
+                  memory_budget: Optional[int] = None,
+                  n_jobs: Optional[int] = None) -> LincsDataset:
+  """Robust z-scores of the profiles, per plate or against vehicle controls
+
+  z = (x - median) / (1.4826 * max(MAD, min_mad)) for every gene, as
+  cmapPy.math.robust_zscore, where the median and MAD are computed on the
+  reference population of the group of the profile.
+
+  Parameters
+  ----------
+  data: Union[str, List, LincsDataset]
+    The profiles, e.g. parsing_level3_cp(..., as_dataset=True).
+  controls: Union[str, List, LincsDataset], optional
+    Reference profiles, e.g. the vehicle controls parsed with
+    pert_type='ctl_vehicle'. A profile is compared to the controls of its
+    group; groups without controls fall back to their own profiles.
+    Default=None (the profiles of the group: plate population control)
+  by: Sequence[str], optional
+    Fields defining the groups. Default=('rna_plate',) when the dataset
+    has this field (see the fields argument of parsing_level3_cp),
+    ('cell_id', 'pert_time') otherwise.
+  min_mad: float (default 0.1)
+    Lower bound of the MAD, so that genes with almost no variation do not
+    get huge z-scores.
+  memory_budget: int, optional
+    Approximate size of the intermediate data of a batch of groups.
+    Default DEFAULT_MEMORY_BUDGET.
+  n_jobs: int, optional
+    Number of threads processing the batches (-1: one per CPU).
+    Default=None (single thread)
+
+  Returns
+  -------
+  LincsDataset
+    float32 z-scores, with the metadata of data.
+  """
+  dataset = _as_dataset(data)
+  assert dataset.expression is not None, "The dataset has no expression data"
+  assert min_mad >= 0, "min_mad must be non-negative"
+  if by is None:
+    by = (PLATE_FIELD,) if PLATE_FIELD in dataset.fields else POPULATION_FIELDS
+  by = list(by)
+  expression = dataset.expression
+  current_stage().rows = len(dataset)
+
+  order, starts, ends, field_codes = group_bounds(dataset, by)
+  if controls is None:
+    median, mad = _robust_stats(expression, order, starts, ends,
+                                memory_budget, n_jobs)
+  else:
+    reference = _as_dataset(controls)
+    assert reference.expression is not None and \
+        reference.expression.shape[1] == expression.shape[1], \
+        "controls must have the same genes as data"
+    ref_order, ref_starts, ref_ends, ref_codes = group_bounds(reference, by)
+    ref_median, ref_mad = _robust_stats(reference.expression, ref_order,
+                                        ref_starts, ref_ends, memory_budget,
+                                        n_jobs)
+    position = {
+        key: g
+        for g, key in enumerate(_group_keys(reference, by, ref_codes))
+    }
+    matches = np.array([
+        position.get(key, -1)
+        for key in _group_keys(dataset, by, field_codes)
+    ], dtype=np.int64)
+    median = ref_median[np.maximum(matches, 0)]
+    mad = ref_mad[np.maximum(matches, 0)]
+    missing = np.flatnonzero(matches < 0)
+    if len(missing):
+      median[missing], mad[missing] = _robust_stats(expression, order,
+                                                    starts[missing],
+                                                    ends[missing],
+                                                    memory_budget, n_jobs)
+  scale = MAD_SCALE * np.maximum(mad, np.float32(min_mad))
+
+  # z-scores of consecutive rows of order, block by block
+  group = np.repeat(np.arange(len(starts)), ends - starts)
+  zscores = np.empty_like(expression, dtype=np.float32)
+  step = max(1, int((DEFAULT_MEMORY_BUDGET if memory_budget is None else
+                     memory_budget) // (12 * expression.shape[1])))
+
+  def normalize(start: int) -> None:
+    rows = order[start:start + step]
+    groups = group[start:start + step]
+    zscores[rows] = (expression[rows] - median[groups]) / scale[groups]
+
+  _run(normalize, range(0, len(order), step), n_jobs)
+  return LincsDataset(zscores,
+                      dataset.codes,
+                      dataset.categories,
+                      fields=dataset.fields,
+                      gene_ids=dataset.gene_ids)
+
+
+@instrumented()
+def consensus(data: Union[str, List, LincsDataset],
+              by: Sequence[str] = REPLICATE_FIELDS,
+              method: str = 'modz',
+              metric: str = 'spearman',
+              min_weight: float = 0.01,
+              memory_budget: Optional[int] = None,
+              n_jobs: Optional[int] = None,
+              return_weights: bool = False
+             ) -> Union[LincsDataset, Tuple[LincsDataset, np.ndarray]]:
+  """Consensus signature of every group of replicates
+
+  With method='modz', the weight of a replicate is its mean correlation
+  to the other replicates of the group (negative correlations count as 0),
+  at least min_weight, and the weights of a group are normalized to sum to
+  1, as cmapPy.math.agg_wt_avg. Groups of one profile keep it as it is.
+
+  Parameters
+  ----------
+  data: Union[str, List, LincsDataset]
+    The profiles, usually robust z-scores (see robust_zscore).
+  by: Sequence[str] (default REPLICATE_FIELDS)
+    Fields identifying the replicates: cell line, compound, dose, time.
+  method: str (default 'modz')
+    'modz' (correlation-weighted average), 'mean' or 'median'.
+  metric: str (default 'spearman')
+    Correlation of the MODZ weights, 'spearman' or 'pearson'.
+  min_weight: float (default 0.01)
+    Lower bound of the weights (before normalization).
+  memory_budget: int, optional
+    Approximate size of the intermediate data of a batch of groups.
+    Default DEFAULT_MEMORY_BUDGET.
+  n_jobs: int, optional
+    Number of threads processing the batches (-1: one per CPU).
+    Default=None (single thread)
+  return_weights: bool (default False)
+    Whether to return the weight of every profile as well.
+
+  Returns
+  -------
+  LincsDataset
+    One float32 signature per group, with the fields of data that have a
+    single value in every group (e.g. not the plate). Groups are ordered
+    by category codes, i.e. by first appearance in data.
+  weights: np.ndarray
+    If return_weights, the float32 weight of every profile of data in its
+    group (1 / size for 'mean', NaN for 'median').
+  """
+  dataset = _as_dataset(data)
+  assert dataset.expression is not None, "The dataset has no expression data"
+  assert method in METHODS, "method must be one of {}".format(METHODS)
+  assert metric in ('spearman', 'pearson'), \
+      "metric must be 'spearman' or 'pearson'"
+  expression = dataset.expression
+  n_genes = expression.shape[1]
+  current_stage().rows = len(dataset)
+
+  order, starts, ends, _ = group_bounds(dataset, list(by))
+  sizes = ends - starts
+  signatures = np.empty((len(sizes), n_genes), dtype=np.float32)
+  weights = np.empty(len(dataset), dtype=np.float32)
+
+  def aggregate(groups: np.ndarray) -> None:
+    size = sizes[groups[0]]
+    rows = _group_rows(order, starts, groups, size)
+    block = expression[rows]
+    if method == 'median':
+      signatures[groups] = np.median(block, axis=1)
+      weights[rows] = np.nan
+      return
+    if method == 'mean' or size == 1:
+      signatures[groups] = block.mean(axis=1)
+      weights[rows] = 1 / size
+      return
+    prepared = _prepare(block.reshape(-1, n_genes),
+                        metric).reshape(block.shape)
+    correlation = np.maximum(prepared @ prepared.transpose(0, 2, 1), 0)
+    correlation[:, np.arange(size), np.arange(size)] = 0
+    raw = np.maximum(correlation.sum(axis=2) / (size - 1), min_weight)
+    weight = raw / raw.sum(axis=1, keepdims=True)
+    signatures[groups] = (weight[:, None, :] @ block)[:, 0]
+    weights[rows] = weight
+
+  # block, transformed block and the copies of the ranking
+  _run(aggregate, _batches(sizes, 16 * n_genes, memory_budget), n_jobs)
+
+  first = order[starts]
+  fields = []
+  for field in dataset.fields:
+    codes = dataset.codes[field][order]
+    if np.array_equal(codes, np.repeat(codes[starts], sizes)):
+      fields.append(field)
+  result = LincsDataset(signatures,
+                        {field: dataset.codes[field][first] for field in fields},
+                        {field: dataset.categories[field] for field in fields},
+                        fields=fields,
+                        gene_ids=dataset.gene_ids)
+  if return_weights:
+    return result, weights
+  return result
@@ -0,0 +1,368 @@
+"""
+Approximate nearest-neighbour index of expression profiles.
+
+Exact search (see similarity.py) scores every profile. IVFIndex scores a
+small part of them, with an inverted-file (IVF) index in a PCA-reduced
+space:
+  - profiles are transformed as for the metric (unit norm, centered for
+    pearson, gene ranks for spearman) and projected on the n_components
+    principal axes of a sample, so that dot products of the reduced
+    vectors approximate the scores;
+  - a spherical k-means on a sample splits the reduced space into n_lists
+    cells, and every profile is stored in the list of its nearest
+    centroid;
+  - a query only scores the profiles of the nprobe lists closest to it.
+    Optionally, the best candidates are re-scored exactly on the full
+    profiles (refine).
+
+Recall and speed are tuned with nprobe (lists visited per query),
+n_components and refine; see benchmarks/bench_ann.py for recall against
+exact search versus latency. Profiles added after the index is built go
+to the lists of the existing centroids (rebuild when the data changes
+much). An index is saved as a directory:
+  ann.json           format version, parameters and sizes
+  <array>.npy        projection, centroids, reduced vectors, list of every
+                     vector and their identifiers (memory-mapped on load)
+"""
+from __future__ import unicode_literals, print_function, division
+from typing import List, Optional, Union
+
+import json
+import os
+
+import numpy as np
+
+from .dataset import LincsDataset
+from .instrument import current_stage, instrumented, stage
+from .similarity import SearchResult, _as_dataset, _prepare
+
+__author__ = "Hosein Fooladi"
+__email__ = "fooladi.hosein@gmail.com"
+
+FORMAT_NAME = 'lincs-ann'
+FORMAT_VERSION = 1
+HEADER_FILE = 'ann.json'
+METRICS = ('cosine', 'pearson', 'spearman')
+_ARRAYS = ('projection', 'centroids', 'vectors', 'lists', 'ids')
+
+# Profiles transformed and projected at a time
+_BLOCK = 20000
+
+
+def _expression(data: Union[np.ndarray, List, LincsDataset]) -> np.ndarray:
+  if isinstance(data, np.ndarray):
+    return np.atleast_2d(data)
+  return _as_dataset(data).expression
+
+
+def _nearest(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+  """Centroid of largest dot product of every vector"""
+  lists = np.empty(len(vectors), dtype=np.int32)
+  for start in range(0, len(vectors), _BLOCK):
+    lists[start:start + _BLOCK] = np.argmax(
+        vectors[start:start + _BLOCK] @ centroids.T, axis=1)
+  return lists
+
+
+def _kmeans(vectors: np.ndarray, n_lists: int, n_iter: int,
+            rng: np.random.RandomState) -> np.ndarray:
+  """Spherical k-means centroids (unit norm) of vectors"""
+  centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+  for _ in range(n_iter):
+    lists = _nearest(vectors, centroids)
+    sums = np.zeros_like(centroids)
+    np.add.at(sums, lists, vectors)
+    counts = np.bincount(lists, minlength=n_lists)
+    empty = counts == 0
+    # Empty cells restart from random vectors
+    sums[empty] = vectors[rng.choice(len(vectors), empty.sum())]
+    norm = np.linalg.norm(sums, axis=1)
+    norm[norm == 0] = 1
+    centroids = (sums / norm[:, None]).astype(np.float32)
+  return centroids
+
+
+class IVFIndex(object):
+  """Inverted-file index of profiles in a PCA-reduced space
+
+  Parameters
+  ----------
+  metric: str, optional (default 'cosine')
+    One of METRICS: 'cosine', 'pearson' or 'spearman'.
+  n_lists: int, optional
+    Number of cells (lists). Default: about 4 * sqrt(number of profiles).
+  n_components: int, optional (default 64)
+    Dimension of the reduced space.
+  nprobe: int, optional (default 8)
+    Lists visited per query (see search).
+  seed: int, optional (default 0)
+    Seed of the sampling and of the k-means.
+  """
+
+  def __init__(self,
+               metric: str = 'cosine',
+               n_lists: Optional[int] = None,
+               n_components: int = 64,
+               nprobe: int = 8,
+               seed: int = 0):
+    assert metric in METRICS, "metric must be one of {}".format(METRICS)
+    self.metric = metric
+    self.n_lists = n_lists
+    self.n_components = n_components
+    self.nprobe = nprobe
+    self.seed = seed
+    self.projection = None  # type: Optional[np.ndarray]
+    self.centroids = None  # type: Optional[np.ndarray]
+    self.vectors = np.zeros((0, n_components), dtype=np.float32)
+    self.lists = np.zeros(0, dtype=np.int32)
+    self.ids = np.zeros(0, dtype=np.int64)
+    self._order = None  # profiles sorted by list, and list offsets
+    self._offsets = None
+
+  def __len__(self) -> int:
+    return len(self.ids)
+
+  @property
+  def is_trained(self) -> bool:
+    return self.centroids is not None
+
+  def _reduce(self, expression: np.ndarray) -> np.ndarray:
+    """Transformed and projected profiles"""
+    reduced = np.empty((len(expression), self.projection.shape[1]),
+                       dtype=np.float32)
+    for start in range(0, len(expression), _BLOCK):
+      block = _prepare(expression[start:start + _BLOCK], self.metric)
+      reduced[start:start + _BLOCK] = block @ self.projection
+    return reduced
+
+  def train(self,
+            data: Union[np.ndarray, List, LincsDataset],
+            sample_size: int = 100000,
+            n_iter: int = 10) -> 'IVFIndex':
+    """Learn the projection and the centroids from a sample of data"""
+    expression = _expression(data)
+    n, n_genes = expression.shape
+    assert n > 0, "No profile to train on"
+    rng = np.random.RandomState(self.seed)
+    sample = np.sort(rng.choice(n, min(n, sample_size), replace=False))
+    prepared = _prepare(expression[sample], self.metric)
+
+    # Principal axes of the (uncentered) second moment: dot products of
+    # the projections approximate the dot products of the profiles
+    n_components = min(self.n_components, n_genes)
+    moment = (prepared.T @ prepared).astype(np.float64) / len(prepared)
+    values, vectors = np.linalg.eigh(moment)
+    self.projection = np.ascontiguousarray(
+        vectors[:, ::-1][:, :n_components], dtype=np.float32)
+    self.n_components = n_components
+
+    if self.n_lists is None:
+      self.n_lists = int(max(1, min(4 * np.sqrt(n), len(sample) // 39)))
+    n_lists = min(self.n_lists, len(sample))
+    reduced = prepared @ self.projection
+    norm = np.linalg.norm(reduced, axis=1)
+    norm[norm == 0] = 1
+    self.centroids = _kmeans(reduced / norm[:, None], n_lists, n_iter, rng)
+    self.n_lists = n_lists
+    self.vectors = np.zeros((0, n_components), dtype=np.float32)
+    self.lists = np.zeros(0, dtype=np.int32)
+    self.ids = np.zeros(0, dtype=np.int64)
+    self._order = None
+    return self
+
+  def add(self,
+          data: Union[np.ndarray, List, LincsDataset],
+          ids: Optional[np.ndarray] = None) -> np.ndarray:
+    """Insert profiles (after the ones already indexed)
+
+    Parameters
+    ----------
+    data: Union[np.ndarray, List, LincsDataset]
+      The profiles, with the genes of the training data.
+    ids: np.ndarray, optional
+      Identifiers returned by search. Default: consecutive numbers after
+      the last indexed profile (the rows of the dataset when the whole
+      dataset is added at once).
+
+    Returns
+    -------
+    np.ndarray
+      The identifiers of the new profiles.
+    """
+    assert self.is_trained, "The index must be trained first (see train)"
+    expression = _expression(data)
+    if ids is None:
+      start = int(self.ids.max()) + 1 if len(self.ids) else 0
+      ids = np.arange(start, start + len(expression), dtype=np.int64)
+    ids = np.asarray(ids, dtype=np.int64)
+    assert len(ids) == len(expression), "One identifier per profile"
+
+    reduced = self._reduce(expression)
+    self.vectors = np.concatenate([self.vectors, reduced])
+    self.lists = np.concatenate([self.lists, _nearest(reduced, self.centroids)])
+    self.ids = np.concatenate([self.ids, ids])
+    self._order = None
+    return ids
+
+  def _inverted_lists(self):
+    if self._order is None:
+      self._order = np.argsort(self.lists, kind='stable')
+      self._offsets = np.searchsorted(self.lists[self._order],
+                                      np.arange(self.n_lists + 1))
+    return self._order, self._offsets
+
+  @instrumented('ann_search')
+  def search(self,
+             queries: Union[np.ndarray, List, LincsDataset],
+             k: int = 10,
+             nprobe: Optional[int] = None,
+             data: Optional[Union[List, LincsDataset]] = None,
+             refine: int = 0) -> SearchResult:
+    """Approximate k most similar profiles of every query
+
+    Parameters
+    ----------
+    queries: Union[np.ndarray, List, LincsDataset]
+      A signature or a (queries x genes) matrix.
+    k: int, optional (default 10)
+      Number of profiles returned per query (fewer if fewer are scored).
+    nprobe: int, optional
+      Lists visited per query: more is slower and closer to exact search.
+      Default: the nprobe of the index.
+    data: Union[List, LincsDataset], optional
+      The indexed profiles (ids being their rows), for refine.
+    refine: int, optional (default 0)
+      If positive, the refine best candidates of every query (at least k)
+      are re-scored exactly on the profiles of data.
+
+    Returns
+    -------
+    SearchResult
+      Identifiers of the profiles and scores, best first. Scores are
+      approximate unless refine is used.
+    """
+    assert self.is_trained, "The index must be trained first (see train)"
+    assert isinstance(k, int) and k > 0, "k must be a positive integer"
+    nprobe = min(self.nprobe if nprobe is None else nprobe, self.n_lists)
+    queries = _prepare(_expression(queries).astype(np.float32), self.metric)
+    reduced = queries @ self.projection
+    n_queries = len(queries)
+    current_stage().rows = n_queries
+    n_candidates = max(k, refine)
+
+    order, offsets = self._inverted_lists()
+    probes = np.argsort(-(reduced @ self.centroids.T), axis=1)[:, :nprobe]
+    best_scores = np.full((n_queries, n_candidates), -np.inf, dtype=np.float32)
+    best_rows = np.zeros((n_queries, n_candidates), dtype=np.int64)
+    with stage('scan', rows=n_queries, nprobe=nprobe):
+      # List by list: every list is scored against all its queries at once
+      for cell in np.unique(probes):
+        members = order[offsets[cell]:offsets[cell + 1]]
+        if not len(members):
+          continue
+        visitors = np.flatnonzero((probes == cell).any(axis=1))
+        scores = np.hstack([best_scores[visitors],
+                            reduced[visitors] @ self.vectors[members].T])
+        rows = np.hstack([
+            best_rows[visitors],
+            np.broadcast_to(members, (len(visitors), len(members)))
+        ])
+        top = np.argpartition(-scores, n_candidates - 1,
+                              axis=1)[:, :n_candidates]
+        best_scores[visitors] = np.take_along_axis(scores, top, axis=1)
+        best_rows[visitors] = np.take_along_axis(rows, top, axis=1)
+
+    if refine > 0:
+      assert data is not None, "refine needs the indexed profiles (data)"
+      expression = _expression(data)
+      with stage('refine', rows=n_queries * best_rows.shape[1]):
+        for q in range(n_queries):
+          valid = np.isfinite(best_scores[q])
+          rows = self.ids[best_rows[q][valid]]
+          exact = _prepare(expression[np.sort(rows)], self.metric) @ queries[q]
+          best_scores[q][valid] = exact[np.argsort(np.argsort(rows))]
+
+    # Best first; profiles that were never scored are dropped
+    n_found = int(np.isfinite(best_scores).sum(axis=1).min()) \
+        if best_scores.size else 0
+    k = min(k, n_found)
+    top = np.argsort(-best_scores, axis=1, kind='stable')[:, :k]
+    return SearchResult(
+        self.ids[np.take_along_axis(best_rows, top, axis=1)],
+        np.take_along_axis(best_scores, top, axis=1), self.metric)
+
+  def save(self, index_dir: str) -> None:
+    """Write the index in a directory"""
+    assert self.is_trained, "The index must be trained first (see train)"
+    os.makedirs(index_dir, exist_ok=True)
+    for name in _ARRAYS:
+      np.save(os.path.join(index_dir, name + '.npy'), getattr(self, name))
+    header = {
+        'format': FORMAT_NAME,
+        'version': FORMAT_VERSION,
+        'metric': self.metric,
+        'n_lists': self.n_lists,
+        'n_components': self.n_components,
+        'nprobe': self.nprobe,
+        'seed': self.seed,
+        'n_profiles': len(self),
+    }
+    # The header is written last: its presence marks a complete index.
+    with open(os.path.join(index_dir, HEADER_FILE), 'w') as f:
+      json.dump(header, f, indent=2)
+
+  @classmethod
+  def load(cls, index_dir: str, mmap: bool = True) -> 'IVFIndex':
+    """Read an index written by save (memory-mapped by default)"""
+    with open(os.path.join(index_dir, HEADER_FILE)) as f:
+      header = json.load(f)
+    assert header.get('format') == FORMAT_NAME, \
+        "{} is not a LINCS ANN index".format(index_dir)
+    assert header.get('version', 0) <= FORMAT_VERSION, \
+        "Unsupported ANN index version: {}".format(header.get('version'))
+    index = cls(header['metric'], header['n_lists'], header['n_components'],
+                header['nprobe'], header['seed'])
+    for name in _ARRAYS:
+      setattr(index, name,
+              np.load(os.path.join(index_dir, name + '.npy'),
+                      mmap_mode='r' if mmap else None))
+    assert len(index.ids) == header['n_profiles'], \
+        "Incomplete ANN index: {}".format(index_dir)
+    return index
+
+  def __repr__(self) -> str:
+    return 'IVFIndex(metric={}, n_lists={}, n_components={}, profiles={})'.format(
+        self.metric, self.n_lists, self.n_components, len(self))
+
+
+@instrumented()
+def build_index(data: Union[str, List, LincsDataset],
+                metric: str = 'cosine',
+                n_lists: Optional[int] = None,
+                n_components: int = 64,
+                nprobe: int = 8,
+                sample_size: int = 100000,
+                seed: int = 0) -> IVFIndex:
+  """Train an IVFIndex on data and add all its profiles
+
+  Parameters
+  ----------
+  data: Union[str, List, LincsDataset]
+    The profiles, e.g. the output of parsing_level3_cp (as_dataset=True)
+    or a dataset directory. Search results are the rows of data.
+  metric, n_lists, n_components, nprobe, seed:
+    See IVFIndex.
+  sample_size: int, optional (default 100000)
+    Number of profiles the projection and the centroids are learnt from.
+
+  Returns
+  -------
+  IVFIndex
+  """
+  dataset = _as_dataset(data)
+  index = IVFIndex(metric, n_lists, n_components, nprobe, seed)
+  with stage('train'):
+    index.train(dataset, sample_size=sample_size)
+  with stage('add', rows=len(dataset)):
+    index.add(dataset)
+  return index
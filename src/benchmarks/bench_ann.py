@@ -0,0 +1,107 @@
+"""
+Benchmark of the approximate nearest-neighbour index.
+
+Parses a synthetic level 3 release (see synthetic.py), indexes all but the
+last n_queries profiles with ann.build_index, and searches the held-out
+profiles. For several nprobe / refine settings it reports the recall@k
+against exact search (similarity.search) and the latency per query.
+
+Usage:
+  python -m src.benchmarks.bench_ann --n_profiles 200000 --n_queries 500
+"""
+from __future__ import unicode_literals, print_function, division
+
+import argparse
+import os
+import tempfile
+import time
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from ..ann import build_index
+from ..parser import parsing_level3_cp
+from ..similarity import search
+from ..synthetic import generate
+
+__author__ = "Hosein Fooladi"
+__email__ = "fooladi.hosein@gmail.com"
+
+
+def recall(indices: np.ndarray, exact: np.ndarray) -> float:
+  """Mean fraction of the exact top-k found by the approximate search"""
+  return float(
+      np.mean([
+          len(np.intersect1d(found, truth)) / len(truth)
+          for found, truth in zip(indices, exact)
+      ]))
+
+
+def run(n_profiles: int = 50000,
+        n_queries: int = 200,
+        k: int = 10,
+        metric: str = 'cosine',
+        nprobes: Sequence[int] = (1, 2, 4, 8, 16, 32, 64),
+        refines: Sequence[int] = (0, 100),
+        seed: int = 0) -> Tuple[Dict[str, float], List[Dict[str, float]]]:
+  """Build / exact search times and recall and latency of every setting"""
+  with tempfile.TemporaryDirectory() as tmp:
+    paths = generate(os.path.join(tmp, 'synthetic'),
+                     n_profiles=n_profiles + n_queries,
+                     n_compounds=max(500, n_profiles // 25),
+                     seed=seed,
+                     level5=False)
+    dataset = parsing_level3_cp(paths['level3'], paths['inst_info'],
+                                paths['gene_info'], as_dataset=True)
+  profiles = dataset.subset(np.arange(len(dataset) - n_queries))
+  queries = dataset.expression[len(dataset) - n_queries:]
+
+  start = time.perf_counter()
+  index = build_index(profiles, metric=metric, seed=seed)
+  build = time.perf_counter() - start
+  start = time.perf_counter()
+  exact = search(profiles, queries, k=k, metric=metric)
+  exact_ms = (time.perf_counter() - start) / n_queries * 1e3
+
+  results = []
+  for refine in refines:
+    for nprobe in nprobes:
+      start = time.perf_counter()
+      found = index.search(queries, k=k, nprobe=nprobe, data=profiles,
+                           refine=refine)
+      results.append({
+          'nprobe': nprobe,
+          'refine': refine,
+          'recall': recall(found.indices, exact.indices),
+          'ms_per_query': (time.perf_counter() - start) / n_queries * 1e3,
+      })
+  summary = {
+      'n_profiles': len(profiles),
+      'n_lists': index.n_lists,
+      'build_s': build,
+      'exact_ms_per_query': exact_ms,
+  }
+  return summary, results
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the ANN index')
+  parser.add_argument('--n_profiles', type=int, default=50000)
+  parser.add_argument('--n_queries', type=int, default=200)
+  parser.add_argument('--k', type=int, default=10)
+  parser.add_argument('--metric', type=str, default='cosine',
+                      choices=['cosine', 'pearson', 'spearman'])
+  parser.add_argument('--seed', type=int, default=0)
+  flags = parser.parse_args()
+
+  summary, results = run(flags.n_profiles, flags.n_queries, flags.k,
+                         flags.metric, seed=flags.seed)
+  print("{n_profiles} profiles, {n_lists} lists, built in {build_s:.1f} s, "
+        "exact search {exact_ms_per_query:.2f} ms/query".format(**summary))
+  print("{:>7s} {:>7s} {:>10s} {:>10s} {:>9s}".format(
+      'nprobe', 'refine', 'recall@{}'.format(flags.k), 'ms/query', 'speedup'))
+  for result in results:
+    print("{:7d} {:7d} {:10.3f} {:10.3f} {:9.1f}".format(
+        result['nprobe'], result['refine'], result['recall'],
+        result['ms_per_query'],
+        summary['exact_ms_per_query'] / result['ms_per_query']))
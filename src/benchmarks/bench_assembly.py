@@ -0,0 +1,118 @@
+"""
+Benchmark of the assembly of parse results.
+
+Compares the per-column loop formerly used by parsing_level3_cp /
+parsing_level5_cp (label lookups and data_df.iloc[:, i] for every profile)
+with the bulk path of parser._assemble, on a synthetic GCTX file.
+
+Usage:
+  python -m src.benchmarks.bench_assembly --n_profiles 20000 --n_genes 978
+"""
+from __future__ import unicode_literals, print_function, division
+
+import argparse
+import os
+import tempfile
+import time
+from typing import List
+
+import numpy as np
+import pandas as pd
+from cmapPy.pandasGEXpress.GCToo import GCToo
+from cmapPy.pandasGEXpress.parse import parse
+import cmapPy.pandasGEXpress.write_gctx as wg
+
+from ..parser import _assemble
+
+__author__ = "Hosein Fooladi"
+__email__ = "fooladi.hosein@gmail.com"
+
+
+def make_gctx(dataset_dir: str, n_profiles: int, n_genes: int,
+              seed: int = 0) -> pd.DataFrame:
+  """Write a random GCTX file and return its inst_info-like metadata"""
+  rng = np.random.RandomState(seed)
+  inst_ids = ['inst_{}'.format(i) for i in range(n_profiles)]
+  gene_ids = [str(i) for i in range(n_genes)]
+  data_df = pd.DataFrame(rng.randn(n_genes, n_profiles).astype(np.float32),
+                         index=pd.Index(gene_ids, name='rid'),
+                         columns=pd.Index(inst_ids, name='cid'))
+  wg.write(GCToo(data_df=data_df), dataset_dir)
+
+  return pd.DataFrame({
+      'inst_id': inst_ids,
+      'cell_id': rng.choice(['MCF7', 'A375', 'PC3', 'HT29'], n_profiles),
+      'pert_id': ['BRD-{}'.format(i) for i in rng.randint(0, 500, n_profiles)],
+      'pert_type': 'trt_cp',
+      'pert_dose': rng.choice([0.04, 0.12, 0.37, 1.11, 3.33, 10.0], n_profiles),
+      'pert_dose_unit': 'um',
+      'pert_time': rng.choice([6, 24], n_profiles),
+      'pert_time_unit': 'h'
+  })
+
+
+def legacy_assemble(query_trt: pd.DataFrame, data_df: pd.DataFrame) -> List:
+  """The per-column loop of the original parsers"""
+  parse_list = []
+  for i in range(query_trt.shape[0]):
+    parse_list.append([
+        (query_trt.cell_id.iloc[i], query_trt.pert_id.iloc[i],
+         query_trt.pert_type.iloc[i], query_trt.pert_dose.iloc[i],
+         query_trt.pert_dose_unit.iloc[i], query_trt.pert_time.iloc[i],
+         query_trt.pert_time_unit.iloc[i]),
+        np.array(data_df.iloc[:, i])
+    ])
+  return parse_list
+
+
+def run(n_profiles: int = 20000, n_genes: int = 978, repeat: int = 3) -> dict:
+  """Time both assembly paths; returns the best wall time of each (seconds)"""
+  with tempfile.TemporaryDirectory() as tmp:
+    dataset_dir = os.path.join(tmp, 'bench.gctx')
+    inst_info = make_gctx(dataset_dir, n_profiles, n_genes)
+    gctoo = parse(dataset_dir)
+
+  query_trt = inst_info.set_index(inst_info.inst_id)
+  query_trt = query_trt.reindex(gctoo.data_df.columns)
+  matrix = gctoo.data_df.to_numpy().T
+
+  paths = {
+      'legacy_loop': lambda: legacy_assemble(query_trt, gctoo.data_df),
+      'bulk_copy': lambda: _assemble(query_trt, matrix, gctoo.data_df.index,
+                                     False),
+      'bulk_views': lambda: _assemble(query_trt, matrix, gctoo.data_df.index,
+                                      False, copy=False),
+      'bulk_dataset': lambda: _assemble(query_trt, matrix, gctoo.data_df.index,
+                                        True),
+  }
+
+  reference = paths['legacy_loop']()
+  for name in ('bulk_copy', 'bulk_views'):
+    output = paths[name]()
+    assert all(a[0] == b[0] and np.array_equal(a[1], b[1])
+               for a, b in zip(reference, output)), name
+  del reference
+
+  timings = {}
+  for name, fn in paths.items():
+    best = np.inf
+    for _ in range(repeat):
+      start = time.perf_counter()
+      fn()
+      best = min(best, time.perf_counter() - start)
+    timings[name] = best
+  return timings
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark parse assembly')
+  parser.add_argument('--n_profiles', type=int, default=20000)
+  parser.add_argument('--n_genes', type=int, default=978)
+  parser.add_argument('--repeat', type=int, default=3)
+  flags = parser.parse_args()
+
+  timings = run(flags.n_profiles, flags.n_genes, flags.repeat)
+  base = timings['legacy_loop']
+  for name, seconds in timings.items():
+    print("{:<14s} {:8.3f} s  ({:6.1f}x, {:,.0f} profiles/s)".format(
+        name, seconds, base / seconds, flags.n_profiles / seconds))
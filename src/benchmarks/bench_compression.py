@@ -0,0 +1,100 @@
+"""
+Benchmark of the compressed expression storage.
+
+Writes a synthetic level-3-like dataset (978 landmark genes) with several
+compression settings and reports the size ratio against the raw float32
+matrix, the encode time and the decode throughput of open_dataset.
+
+Usage:
+  python -m src.benchmarks.bench_compression --n_profiles 50000 --n_jobs 4
+"""
+from __future__ import unicode_literals, print_function, division
+
+import argparse
+import os
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from ..compression import Compression, available_codecs
+from ..dataset import LincsDataset
+from ..storage import open_dataset, save_dataset
+
+__author__ = "Hosein Fooladi"
+__email__ = "fooladi.hosein@gmail.com"
+
+
+def make_dataset(n_profiles: int, n_genes: int = 978,
+                 seed: int = 0) -> LincsDataset:
+  """Random profiles with a per-gene level, like log2 expression values"""
+  rng = np.random.RandomState(seed)
+  level = rng.uniform(4, 14, n_genes).astype(np.float32)
+  expression = level + rng.randn(n_profiles, n_genes).astype(np.float32)
+  codes = {field: np.zeros(n_profiles, dtype=np.int32)
+           for field in ('cell_id', 'pert_id', 'pert_type', 'pert_dose',
+                         'pert_dose_unit', 'pert_time', 'pert_time_unit')}
+  categories = {field: np.array(['x'], dtype=object) for field in codes}
+  return LincsDataset(expression, codes, categories)
+
+
+def default_settings() -> List[Tuple[str, Compression]]:
+  settings = []
+  for codec in available_codecs():
+    if codec in ('none', 'bz2', 'lzma'):
+      continue
+    settings.append((codec, Compression(codec, shuffle=False)))
+    settings.append((codec + '+shuffle', Compression(codec)))
+  fast = 'lz4' if 'lz4' in available_codecs() else 'zlib'
+  settings.append(('lzma+shuffle', Compression('lzma')))
+  settings.append((fast + '+float16', Compression(fast, dtype='float16')))
+  settings.append((fast + '+q16', Compression(fast, quantize=16)))
+  settings.append((fast + '+q8', Compression(fast, quantize=8)))
+  return settings
+
+
+def run(n_profiles: int = 20000, n_genes: int = 978,
+        n_jobs: int = -1) -> Dict[str, Dict[str, float]]:
+  """Size ratio, encode time, decode throughput and error of every setting"""
+  dataset = make_dataset(n_profiles, n_genes)
+  raw = dataset.expression.nbytes
+  results = {}
+  with tempfile.TemporaryDirectory() as tmp:
+    for name, compression in [('raw .npy', None)] + default_settings():
+      dataset_dir = os.path.join(tmp, name)
+      start = time.perf_counter()
+      save_dataset(dataset_dir, dataset, index=False, compression=compression)
+      encode = time.perf_counter() - start
+      size = sum(
+          os.path.getsize(os.path.join(dataset_dir, f))
+          for f in os.listdir(dataset_dir)
+          if f.startswith('expression'))
+
+      start = time.perf_counter()
+      output = open_dataset(dataset_dir, mmap=False, index=False, n_jobs=n_jobs)
+      decode = time.perf_counter() - start
+      results[name] = {
+          'ratio': raw / size,
+          'encode_s': encode,
+          'decode_mb_s': raw / decode / 1e6,
+          'max_error': float(np.max(np.abs(output.expression -
+                                            dataset.expression))),
+      }
+  return results
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark expression compression')
+  parser.add_argument('--n_profiles', type=int, default=20000)
+  parser.add_argument('--n_genes', type=int, default=978)
+  parser.add_argument('--n_jobs', type=int, default=-1)
+  flags = parser.parse_args()
+
+  results = run(flags.n_profiles, flags.n_genes, flags.n_jobs)
+  print("{:<16s} {:>7s} {:>10s} {:>12s} {:>10s}".format(
+      'setting', 'ratio', 'encode s', 'decode MB/s', 'max error'))
+  for name, result in results.items():
+    print("{:<16s} {:7.2f} {:10.3f} {:12.0f} {:10.2g}".format(
+        name, result['ratio'], result['encode_s'], result['decode_mb_s'],
+        result['max_error']))
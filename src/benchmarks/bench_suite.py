@@ -0,0 +1,260 @@
+"""
+End-to-end benchmark suite on synthetic LINCS data.
+
+Generates a synthetic release (see synthetic.py), then times the main
+stages of the package on it: parsing (level 3 and 5), saving and loading,
+filtering, statistics and to_dataframe. Every stage reports its best wall
+time over a few repeats, its throughput (profiles/s) and the peak memory
+it adds to the process (peak RSS over the RSS at its start, Linux only).
+
+Results are compared with a stored baseline (baseline.json next to this
+file, one entry per scale): --check exits with status 1 when a stage is
+slower or uses more memory than its baseline beyond the tolerances, and
+--update-baseline records the current results. Throughputs depend on
+the machine: record the baseline on the machine that runs the checks.
+
+Usage:
+  python -m src.benchmarks.bench_suite --check
+  python -m src.benchmarks.bench_suite --n_profiles 200000 --update-baseline
+"""
+from __future__ import unicode_literals, print_function, division
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .. import filtering
+from ..cache import invalidate
+from ..instrument import peak_rss_mb, reset_peak_rss, rss_mb
+from ..parser import parsing_level3_cp, parsing_level5_cp
+from ..statistics import summarize
+from ..storage import save_dataset
+from ..synthetic import generate
+from ..utils import load_dataset, load_pickle, parse_list, to_dataframe, write_pickle
+
+__author__ = "Hosein Fooladi"
+__email__ = "fooladi.hosein@gmail.com"
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'baseline.json')
+# Peak memory increases below this many MB are never regressions
+_RSS_SLACK_MB = 16
+
+
+def measure(function: Callable[[], int], repeat: int = 3) -> Dict[str, float]:
+  """Best wall time, profiles/s and peak memory of function
+
+  function returns the number of profiles it processed. Its output
+  (prints and progress bars) is discarded.
+  """
+  best, rows, peak = float('inf'), 0, None
+  for _ in range(repeat):
+    start_rss = rss_mb()
+    tracked = reset_peak_rss() and start_rss is not None
+    with contextlib.redirect_stdout(io.StringIO()), \
+        contextlib.redirect_stderr(io.StringIO()):
+      start = time.perf_counter()
+      rows = function()
+      elapsed = time.perf_counter() - start
+    best = min(best, elapsed)
+    if tracked:
+      added = max(peak_rss_mb() - start_rss, 0.0)
+      peak = added if peak is None else max(peak, added)
+  return {
+      'rows': rows,
+      'wall_s': best,
+      'rows_per_s': rows / best if best > 0 else float('inf'),
+      'peak_rss_mb': peak,
+  }
+
+
+def stages(data_dir: str, work_dir: str,
+           paths: Dict[str, str]) -> List[Tuple[str, Callable[[], int]]]:
+  """The benchmarked stages, in order (later ones use earlier outputs)"""
+  level3, state = {}, {}
+  dataset_dir = os.path.join(work_dir, 'level3_dataset')
+  pickle_dir = os.path.join(work_dir, 'level3.pkl')
+
+  def parse_level3() -> int:
+    level3['data'] = parsing_level3_cp(paths['level3'], paths['inst_info'],
+                                       paths['gene_info'], as_dataset=True)
+    return len(level3['data'])
+
+  def parse_level3_list() -> int:
+    level3['list'] = parsing_level3_cp(paths['level3'], paths['inst_info'],
+                                       paths['gene_info'])
+    return len(level3['list'])
+
+  def parse_level5() -> int:
+    return len(parsing_level5_cp(paths['level5'], paths['sig_info'],
+                                 paths['gene_info'], as_dataset=True))
+
+  def save() -> int:
+    save_dataset(dataset_dir, level3['data'])
+    return len(level3['data'])
+
+  def load() -> int:
+    invalidate()
+    data = load_dataset(dataset_dir)
+    float(np.asarray(data.expression).sum())  # read the memory-mapped matrix
+    return len(data)
+
+  def pickle_load() -> int:
+    if not os.path.exists(pickle_dir):
+      write_pickle(pickle_dir, level3['list'])
+    return len(load_pickle(pickle_dir))
+
+  def filter_list() -> int:
+    data = level3['data']
+    if 'cell' not in state:
+      state['cell'] = summarize(data, ['cell_id'])['cell_id'].top(0, 1)[0]
+    parse_list(data, 0, [state['cell']])
+    return len(data)
+
+  def filter_cli() -> int:
+    filtering.main([
+        '--dataset_dir', dataset_dir, '--cells', state['cell'], '--output_dir',
+        os.path.join(work_dir, 'filtered.pkl')
+    ])
+    return len(level3['data'])
+
+  def statistics() -> int:
+    data = level3['data'].subset(slice(None))  # without cached counts
+    summarize(data)
+    return len(data)
+
+  def dataframe() -> int:
+    return len(to_dataframe(level3['data']))
+
+  return [('parse_level3', parse_level3),
+          ('parse_level3_list', parse_level3_list),
+          ('parse_level5', parse_level5), ('save_dataset', save),
+          ('load_dataset', load), ('load_pickle', pickle_load),
+          ('filter_parse_list', filter_list), ('filter_cli', filter_cli),
+          ('statistics', statistics), ('to_dataframe', dataframe)]
+
+
+def run(n_profiles: int = 100000,
+        n_genes: int = 978,
+        repeat: int = 3,
+        data_dir: Optional[str] = None,
+        seed: int = 0) -> Dict[str, Dict[str, float]]:
+  """Results of every stage on a synthetic release of n_profiles"""
+  with tempfile.TemporaryDirectory() as tmp:
+    data_dir = data_dir or os.path.join(tmp, 'synthetic')
+    paths = generate(data_dir, n_profiles=n_profiles, n_genes=n_genes,
+                     seed=seed)
+    invalidate()
+    return {name: measure(function, repeat)
+            for name, function in stages(data_dir, tmp, paths)}
+
+
+def scale_key(n_profiles: int, n_genes: int, seed: int) -> str:
+  return 'profiles={},genes={},seed={}'.format(n_profiles, n_genes, seed)
+
+
+def compare(results: Dict[str, Dict[str, float]],
+            baseline: Dict[str, Dict[str, float]],
+            tolerance: float = 0.5,
+            rss_tolerance: float = 0.3) -> List[str]:
+  """Regressions of results against baseline (empty if none)
+
+  A stage regresses when its throughput is below (1 - tolerance) times
+  the baseline, or its peak memory above (1 + rss_tolerance) times the
+  baseline plus a few MB.
+  """
+  regressions = []
+  for name, base in baseline.items():
+    if name not in results:
+      continue
+    result = results[name]
+    if result['rows_per_s'] < base['rows_per_s'] * (1 - tolerance):
+      regressions.append('{}: {:.0f} profiles/s, baseline {:.0f}'.format(
+          name, result['rows_per_s'], base['rows_per_s']))
+    if result['peak_rss_mb'] is not None and base.get('peak_rss_mb') is not None \
+        and result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + rss_tolerance) + _RSS_SLACK_MB:
+      regressions.append('{}: peak memory {:.0f} MB, baseline {:.0f} MB'.format(
+          name, result['peak_rss_mb'], base['peak_rss_mb']))
+  return regressions
+
+
+def read_baseline(path: str = BASELINE) -> Dict[str, Dict]:
+  if not os.path.exists(path):
+    return {}
+  with open(path) as f:
+    return json.load(f)
+
+
+def write_baseline(key: str, results: Dict[str, Dict[str, float]],
+                   path: str = BASELINE) -> None:
+  baselines = read_baseline(path)
+  baselines[key] = {
+      name: {
+          'rows_per_s': round(result['rows_per_s']),
+          'peak_rss_mb': None if result['peak_rss_mb'] is None else round(
+              result['peak_rss_mb'], 1)
+      } for name, result in results.items()
+  }
+  with open(path, 'w') as f:
+    json.dump(baselines, f, indent=2, sort_keys=True)
+    f.write('\n')
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+  parser = argparse.ArgumentParser(description='End-to-end benchmark suite')
+  parser.add_argument('--n_profiles', type=int, default=100000)
+  parser.add_argument('--n_genes', type=int, default=978)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--data_dir', type=str, default=None,
+                      help='Directory of the synthetic files. '
+                      'Default: a temporary directory')
+  parser.add_argument('--baseline', type=str, default=BASELINE)
+  parser.add_argument('--check', action='store_true',
+                      help='Exit with status 1 on regressions')
+  parser.add_argument('--tolerance', type=float, default=0.5,
+                      help='Allowed relative throughput loss')
+  parser.add_argument('--rss_tolerance', type=float, default=0.3,
+                      help='Allowed relative peak memory increase')
+  parser.add_argument('--update-baseline', '--update_baseline',
+                      dest='update_baseline', action='store_true')
+  flags = parser.parse_args(argv)
+
+  results = run(flags.n_profiles, flags.n_genes, flags.repeat, flags.data_dir,
+                flags.seed)
+  print("{:<18s} {:>9s} {:>10s} {:>13s} {:>12s}".format(
+      'stage', 'profiles', 'wall s', 'profiles/s', 'peak MB'))
+  for name, result in results.items():
+    peak = result['peak_rss_mb']
+    print("{:<18s} {:9d} {:10.3f} {:13.0f} {:>12s}".format(
+        name, result['rows'], result['wall_s'], result['rows_per_s'],
+        '-' if peak is None else '{:.1f}'.format(peak)))
+
+  key = scale_key(flags.n_profiles, flags.n_genes, flags.seed)
+  if flags.update_baseline:
+    write_baseline(key, results, flags.baseline)
+    print("Baseline {} written to {}".format(key, flags.baseline))
+    return 0
+
+  baseline = read_baseline(flags.baseline).get(key)
+  if baseline is None:
+    print("No baseline for {} in {}".format(key, flags.baseline))
+    return 0
+  regressions = compare(results, baseline, flags.tolerance, flags.rss_tolerance)
+  for regression in regressions:
+    print("REGRESSION " + regression)
+  if not regressions:
+    print("No regression against the baseline ({})".format(key))
+  return 1 if regressions and flags.check else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
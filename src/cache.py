@@ -0,0 +1,179 @@
+"""
+Process-level cache of loaded datasets.
+
+The utils functions accept the directory of a dataset and used to
+unpickle it on every call. DatasetCache keeps recently loaded datasets in
+memory, keyed on the absolute path plus the modification time and size of
+the file, so a changed file is reloaded automatically. The least recently
+used entries are evicted once the cached data exceeds a memory cap.
+"""
+from __future__ import unicode_literals, print_function, division
+from typing import Any, Callable, Optional, Tuple
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from .dataset import LincsDataset
+
+__author__ = "Hosein Fooladi"
+__email__ = "fooladi.hosein@gmail.com"
+
+
+def _default_max_bytes() -> int:
+  """A quarter of the physical memory (4 GiB if it cannot be determined)"""
+  if os.environ.get('LINCS_CACHE_MAX_BYTES'):
+    return int(os.environ['LINCS_CACHE_MAX_BYTES'])
+  try:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 4
+  except (AttributeError, ValueError, OSError):
+    return 4 * 1024**3
+
+
+def file_stamp(path: str) -> Tuple[int, int]:
+  """(mtime in ns, size) of a file, or of the header of a dataset directory"""
+  if os.path.isdir(path):
+    # The header of the on-disk format (see storage.py) and the manifest of
+    # partitioned datasets (see partition.py) are written last.
+    for name in ('header.json', 'partitions.json'):
+      if os.path.exists(os.path.join(path, name)):
+        path = os.path.join(path, name)
+        break
+  stat = os.stat(path)
+  return stat.st_mtime_ns, stat.st_size
+
+
+def sizeof(data: Any) -> int:
+  """Approximate resident memory of a dataset
+
+  Memory-mapped arrays are not counted: their pages belong to the OS page
+  cache, not to the process.
+  """
+  if isinstance(data, LincsDataset):
+    size = 0
+    if data.expression is not None and not isinstance(data.expression,
+                                                      np.memmap):
+      size += data.expression.nbytes
+    for field in data.fields:
+      if not isinstance(data.codes[field], np.memmap):
+        size += data.codes[field].nbytes
+    return size
+  if isinstance(data, list):
+    # ~200 bytes of Python objects (list, tuple, boxed scalars) per row
+    size = 200 * len(data)
+    for line in data:
+      if isinstance(line[1], np.ndarray):
+        size += line[1].nbytes
+    return size
+  if isinstance(data, pd.DataFrame):
+    # ~64 bytes per string of the object columns
+    size = int(data.memory_usage(index=True, deep=False).sum())
+    n_objects = sum(data[c].dtype == object for c in data.columns)
+    return size + 64 * n_objects * len(data)
+  return 0
+
+
+class DatasetCache(object):
+  """LRU cache of loaded datasets
+
+  Parameters
+  ----------
+  max_bytes: int, optional
+    Memory cap of the cached datasets. Default: the LINCS_CACHE_MAX_BYTES
+    environment variable, or a quarter of the physical memory.
+  """
+
+  def __init__(self, max_bytes: Optional[int] = None):
+    self.max_bytes = _default_max_bytes() if max_bytes is None else max_bytes
+    self.enabled = True
+    self.hits = 0
+    self.misses = 0
+    self._entries = OrderedDict()  # type: OrderedDict
+    self._lock = threading.RLock()
+
+  @property
+  def nbytes(self) -> int:
+    """Memory used by the cached datasets"""
+    with self._lock:
+      return sum(entry[2] for entry in self._entries.values())
+
+  def get(self, path: str, loader: Callable[[str], Any], kind: str = 'raw') -> Any:
+    """Return the dataset at path, loading it with loader on a miss
+
+    Parameters
+    ----------
+    path: str
+      Directory of the dataset.
+    loader: Callable[[str], Any]
+      Function that loads the dataset from path.
+    kind: str, optional (default 'raw')
+      Distinguishes several representations of the same file
+      (e.g. the unpickled list and its LincsDataset conversion).
+    """
+    if not self.enabled or self.max_bytes <= 0:
+      return loader(path)
+
+    key = (os.path.abspath(path), kind)
+    stamp = file_stamp(path)
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and entry[0] == stamp:
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    data = loader(path)
+    size = sizeof(data)
+    with self._lock:
+      self.misses += 1
+      self._entries.pop(key, None)
+      if size <= self.max_bytes:
+        self._entries[key] = (stamp, data, size)
+        self._evict()
+    return data
+
+  def _evict(self) -> None:
+    total = sum(entry[2] for entry in self._entries.values())
+    while total > self.max_bytes and self._entries:
+      _, entry = self._entries.popitem(last=False)
+      total -= entry[2]
+
+  def invalidate(self, path: Optional[str] = None) -> None:
+    """Forget the cached dataset(s) of path, or everything if path is None"""
+    with self._lock:
+      if path is None:
+        self._entries.clear()
+        return
+      path = os.path.abspath(path)
+      for key in [key for key in self._entries if key[0] == path]:
+        del self._entries[key]
+
+  def set_max_bytes(self, max_bytes: int) -> None:
+    """Change the memory cap (evicting entries if needed)"""
+    with self._lock:
+      self.max_bytes = max_bytes
+      self._evict()
+
+  def __len__(self) -> int:
+    return len(self._entries)
+
+  def __contains__(self, path: str) -> bool:
+    path = os.path.abspath(path)
+    return any(key[0] == path for key in self._entries)
+
+
+# Cache shared by all the functions that accept the directory of a dataset.
+dataset_cache = DatasetCache()
+
+
+def invalidate(path: Optional[str] = None) -> None:
+  """Forget the cached dataset(s) of path, or everything if path is None"""
+  dataset_cache.invalidate(path)
+
+
+def set_cache_limit(max_bytes: int) -> None:
+  """Memory cap (bytes) of the dataset cache; 0 disables caching"""
+  dataset_cache.set_max_bytes(max_bytes)
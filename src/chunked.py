@@ -0,0 +1,328 @@
+"""
+Chunked container of the legacy list format.
+
+A monolithic pickle of [(metadata tuple), expression vector] rows has to be
+unpickled whole, in one uninterruptible call. A chunked file stores the
+same rows as a sequence of independently pickled blocks followed by an
+offset table, so rows can be streamed block by block, read by row range
+(only the overlapping blocks are decoded) or converted to a LincsDataset
+by several processes, with progress reporting.
+
+Layout:
+  MAGIC
+  block 0, block 1, ...     pickled lists of block_size rows
+  table                     pickled dict: n_rows and (offset, nbytes,
+                            first row, n_rows) of every block
+  table offset (uint64, little endian) + MAGIC
+"""
+from __future__ import unicode_literals, print_function, division
+from typing import Iterator, List, Optional, Sequence, Union
+
+import os
+import pickle
+import struct
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from tqdm import tqdm
+
+from .dataset import LincsDataset
+from .parallel import effective_n_jobs
+
+__author__ = "Hosein Fooladi"
+__email__ = "fooladi.hosein@gmail.com"
+
+MAGIC = b'LINCSCK1'
+_TRAILER = struct.Struct('<Q8s')
+
+
+def is_chunked(dataset_dir: str) -> bool:
+  """Whether dataset_dir is a file written by ChunkedWriter"""
+  if not os.path.isfile(dataset_dir):
+    return False
+  with open(dataset_dir, 'rb') as f:
+    return f.read(len(MAGIC)) == MAGIC
+
+
+class ChunkedWriter(object):
+  """Writer of the chunked container
+
+  Parameters
+  ----------
+  dataset_dir: str
+    Path of the output file.
+  block_size: int, optional (default 10000)
+    Number of rows per block.
+  """
+
+  def __init__(self, dataset_dir: str, block_size: int = 10000):
+    assert isinstance(dataset_dir, str), "The dataset_dir must be a string object"
+    assert isinstance(block_size, int) and block_size > 0, \
+        "block_size must be a positive integer"
+    self.dataset_dir = dataset_dir
+    self.block_size = block_size
+    self.n_rows = 0
+    self._blocks = []
+    self._pending = []
+    self._file = open(dataset_dir, 'wb')
+    self._file.write(MAGIC)
+
+  def append(self, rows: List) -> None:
+    """Append rows in the legacy list format"""
+    self._pending.extend(rows)
+    while len(self._pending) >= self.block_size:
+      self._flush(self._pending[:self.block_size])
+      self._pending = self._pending[self.block_size:]
+
+  def _flush(self, rows: List) -> None:
+    payload = pickle.dumps(rows, protocol=pickle.HIGHEST_PROTOCOL)
+    self._blocks.append((self._file.tell(), len(payload), self.n_rows, len(rows)))
+    self._file.write(payload)
+    self.n_rows += len(rows)
+
+  def close(self) -> None:
+    """Write the last block and the offset table"""
+    if self._pending:
+      self._flush(self._pending)
+      self._pending = []
+    offset = self._file.tell()
+    pickle.dump({
+        'n_rows': self.n_rows,
+        'block_size': self.block_size,
+        'blocks': self._blocks
+    }, self._file)
+    self._file.write(_TRAILER.pack(offset, MAGIC))
+    self._file.close()
+
+  def __enter__(self) -> 'ChunkedWriter':
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback) -> None:
+    if exc_type is None:
+      self.close()
+    else:
+      self._file.close()
+
+
+def write_chunked(dataset_dir: str, data: List, block_size: int = 10000) -> None:
+  """Write a list in the legacy format as a chunked file"""
+  assert isinstance(data, list), "The data must be a list object"
+  with ChunkedWriter(dataset_dir, block_size) as writer:
+    for start in range(0, len(data), block_size):
+      writer.append(data[start:start + block_size])
+
+
+def convert_pickle(pickle_dir: str,
+                   dataset_dir: str,
+                   block_size: int = 10000,
+                   progress: bool = True) -> int:
+  """Convert a monolithic pickle into a chunked file
+
+  Parameters
+  ----------
+  pickle_dir: str
+    The pickle file. e.g., './Data/level3_trt_cp_landmark.pkl'
+  dataset_dir: str
+    The chunked output file. e.g., './Data/level3_trt_cp_landmark.lck'
+  block_size: int, optional (default 10000)
+    Number of rows per block.
+  progress: bool, optional (default True)
+    Whether to show a progress bar while writing the blocks.
+
+  Returns
+  -------
+  int
+    Number of rows written.
+  """
+  if progress:
+    print("Loading {} ...".format(pickle_dir))
+  with open(pickle_dir, 'rb') as f:
+    data = pickle.load(f)
+  assert isinstance(data, list), "The pickle must contain a list"
+
+  with ChunkedWriter(dataset_dir, block_size) as writer:
+    for start in tqdm(range(0, len(data), block_size),
+                      desc='Writing blocks',
+                      disable=not progress):
+      writer.append(data[start:start + block_size])
+  return writer.n_rows
+
+
+class ChunkedReader(object):
+  """Reader of the chunked container
+
+  It behaves like a read-only list of rows: len(reader), reader[i] and
+  reader[start:stop] only decode the blocks they need.
+
+  Parameters
+  ----------
+  dataset_dir: str
+    Path of a file written by ChunkedWriter.
+  """
+
+  def __init__(self, dataset_dir: str):
+    assert isinstance(dataset_dir, str), "The dataset_dir must be a string object"
+    self.dataset_dir = dataset_dir
+    with open(dataset_dir, 'rb') as f:
+      assert f.read(len(MAGIC)) == MAGIC, \
+          "{} is not a chunked file".format(dataset_dir)
+      f.seek(-_TRAILER.size, os.SEEK_END)
+      offset, magic = _TRAILER.unpack(f.read(_TRAILER.size))
+      assert magic == MAGIC, "{} is incomplete".format(dataset_dir)
+      f.seek(offset)
+      table = pickle.load(f)
+    self.n_rows = table['n_rows']
+    self.blocks = table['blocks']
+    self._starts = np.array([block[2] for block in self.blocks], dtype=np.int64)
+    self._last = (None, None)
+
+  @property
+  def n_blocks(self) -> int:
+    return len(self.blocks)
+
+  def _payload(self, i: int) -> bytes:
+    offset, nbytes, _, _ = self.blocks[i]
+    with open(self.dataset_dir, 'rb') as f:
+      f.seek(offset)
+      return f.read(nbytes)
+
+  def read_block(self, i: int) -> List:
+    """Rows of block i"""
+    if self._last[0] != i:
+      self._last = (i, pickle.loads(self._payload(i)))
+    return self._last[1]
+
+  def iter_blocks(self,
+                  blocks: Optional[Sequence[int]] = None,
+                  progress: bool = False) -> Iterator[List]:
+    """Decode the blocks one at a time (lazily)"""
+    blocks = range(self.n_blocks) if blocks is None else blocks
+    for i in tqdm(blocks, desc='Loading blocks', disable=not progress):
+      yield pickle.loads(self._payload(i))
+
+  def read_range(self, start: int, stop: int) -> List:
+    """Rows start to stop (excluded), decoding only the overlapping blocks"""
+    start, stop = max(start, 0), min(stop, self.n_rows)
+    if start >= stop:
+      return []
+    first = int(np.searchsorted(self._starts, start, side='right')) - 1
+    last = int(np.searchsorted(self._starts, stop, side='left'))
+    rows = []
+    for i in range(first, last):
+      block = self.read_block(i)
+      begin = self.blocks[i][2]
+      rows.extend(block[max(start - begin, 0):stop - begin])
+    return rows
+
+  def read(self,
+           n_jobs: Optional[int] = None,
+           as_dataset: bool = False,
+           progress: bool = True) -> Union[List, LincsDataset]:
+    """Every row of the file
+
+    Parameters
+    ----------
+    n_jobs: int, optional
+      Number of workers (-1: one per CPU). Default=None (1)
+    as_dataset: bool, optional (default False)
+      Whether to return a LincsDataset. The blocks are then decoded and
+      converted by n_jobs worker processes. For the list format, the
+      rows would have to be pickled again to leave a worker process, and
+      pickle.loads holds the GIL: n_jobs threads only read the blocks
+      from the file ahead of the main thread, which unpickles them one
+      after the other (this overlaps I/O, not decoding).
+    progress: bool, optional (default True)
+      Whether to show a progress bar.
+
+    Returns
+    -------
+    Union[List, LincsDataset]
+    """
+    n_jobs = effective_n_jobs(n_jobs)
+    bar = tqdm(total=self.n_rows,
+               unit='profiles',
+               unit_scale=True,
+               disable=not progress)
+    if n_jobs == 1:
+      blocks = (_convert(block, as_dataset)
+                for block in self.iter_blocks())
+      executor = None
+    elif as_dataset:
+      executor = ProcessPoolExecutor(max_workers=n_jobs)
+      blocks = executor.map(_read_dataset_block,
+                            [self.dataset_dir] * self.n_blocks,
+                            [self.blocks[i] for i in range(self.n_blocks)])
+    else:
+      executor = ThreadPoolExecutor(max_workers=n_jobs)
+      blocks = map(pickle.loads,
+                   executor.map(self._payload, range(self.n_blocks)))
+
+    parts = []
+    try:
+      for block in blocks:
+        parts.append(block)
+        bar.update(len(block))
+    finally:
+      bar.close()
+      if executor is not None:
+        executor.shutdown()
+
+    if not as_dataset:
+      data = []
+      for part in parts:
+        data.extend(part)
+      return data
+    if not parts:
+      return LincsDataset.from_list([])
+    return LincsDataset.concat(parts)
+
+  def metadata(self) -> LincsDataset:
+    """Metadata-only LincsDataset of every row, read block by block"""
+    rows = []
+    for block in self.iter_blocks():
+      rows.extend([line[0], None] for line in block)
+    return LincsDataset.from_list(rows, expression=False)
+
+  def __len__(self) -> int:
+    return self.n_rows
+
+  def __getitem__(self, item):
+    if isinstance(item, slice):
+      start, stop, step = item.indices(self.n_rows)
+      rows = self.read_range(start, stop)
+      return rows if step == 1 else rows[::step]
+    if item < 0:
+      item += self.n_rows
+    if not 0 <= item < self.n_rows:
+      raise IndexError("ChunkedReader index out of range")
+    i = int(np.searchsorted(self._starts, item, side='right')) - 1
+    return self.read_block(i)[item - self.blocks[i][2]]
+
+  def __iter__(self) -> Iterator[List]:
+    for block in self.iter_blocks():
+      for line in block:
+        yield line
+
+
+def _convert(block: List, as_dataset: bool) -> Union[List, LincsDataset]:
+  if not as_dataset:
+    return block
+  dtype = block[0][1].dtype if len(block) > 0 else np.float32
+  return LincsDataset.from_list(block, dtype=dtype)
+
+
+def _read_dataset_block(dataset_dir: str, entry) -> LincsDataset:
+  offset, nbytes, _, _ = entry
+  with open(dataset_dir, 'rb') as f:
+    f.seek(offset)
+    return _convert(pickle.loads(f.read(nbytes)), True)
+
+
+def load_chunked(dataset_dir: str,
+                 n_jobs: Optional[int] = None,
+                 as_dataset: bool = False,
+                 progress: bool = True) -> Union[List, LincsDataset]:
+  """Load a chunked file (see ChunkedReader.read)"""
+  return ChunkedReader(dataset_dir).read(n_jobs=n_jobs,
+                                         as_dataset=as_dataset,
+                                         progress=progress)
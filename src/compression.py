@@ -0,0 +1,245 @@
+"""
+Chunked compression of expression matrices.
+
+The expression matrix is cut into blocks of chunk_rows profiles, and every
+block is encoded independently:
+  1. optional downcast (float16) or linear quantization to 8 or 16 bits
+     per value (with a per-gene offset and scale stored with the block);
+  2. optional byte shuffle: the k-th byte of every value is stored
+     together, which groups the slowly varying exponent bytes and makes
+     floating-point data much more compressible (as in blosc);
+  3. a general-purpose codec.
+
+zlib, bz2 and lzma are always available; zstd (zstandard), lz4 and blosc
+are used when their package is installed. Blocks are decoded in parallel
+threads (the codecs release the GIL while they run).
+"""
+from __future__ import unicode_literals, print_function, division
+from typing import Callable, Dict, List, Optional, Tuple
+
+import bz2
+import lzma
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .parallel import effective_n_jobs
+
+__author__ = "Hosein Fooladi"
+__email__ = "fooladi.hosein@gmail.com"
+
+# name: (compress(data, level), decompress(data), default level)
+CODECS = {
+    'none': (lambda data, level: bytes(data), bytes, None),
+    'zlib': (lambda data, level: zlib.compress(data, level), zlib.decompress,
+             6),
+    'bz2': (lambda data, level: bz2.compress(data, level), bz2.decompress, 9),
+    'lzma': (lambda data, level: lzma.compress(data, preset=level),
+             lzma.decompress, 6),
+}  # type: Dict[str, Tuple[Callable, Callable, Optional[int]]]
+
+try:
+  import zstandard
+  CODECS['zstd'] = (
+      lambda data, level: zstandard.ZstdCompressor(level=level).compress(data),
+      lambda data: zstandard.ZstdDecompressor().decompress(data), 3)
+except ImportError:
+  pass
+
+try:
+  import lz4.frame
+  CODECS['lz4'] = (
+      lambda data, level: lz4.frame.compress(data, compression_level=level),
+      lz4.frame.decompress, 0)
+except ImportError:
+  pass
+
+try:
+  import blosc
+  CODECS['blosc'] = (
+      lambda data, level: blosc.compress(data, typesize=1, clevel=level,
+                                         shuffle=blosc.NOSHUFFLE),
+      blosc.decompress, 5)
+except ImportError:
+  pass
+
+
+def available_codecs() -> List[str]:
+  """Names of the codecs usable in this environment"""
+  return list(CODECS)
+
+
+def shuffle_bytes(data: np.ndarray) -> bytes:
+  """Bytes of data grouped by position within the values"""
+  data = np.ascontiguousarray(data)
+  itemsize = data.dtype.itemsize
+  return data.view(np.uint8).reshape(-1, itemsize).T.tobytes()
+
+
+def unshuffle_bytes(data: bytes, dtype) -> np.ndarray:
+  """Inverse of shuffle_bytes (1-D array of dtype)"""
+  dtype = np.dtype(dtype)
+  raw = np.frombuffer(data, dtype=np.uint8)
+  return np.ascontiguousarray(raw.reshape(dtype.itemsize, -1).T).view(dtype).ravel()
+
+
+class Compression(object):
+  """Settings of the compressed expression storage
+
+  Parameters
+  ----------
+  codec: str, optional (default 'zlib')
+    One of available_codecs().
+  level: int, optional
+    Compression level. Default: the codec's default.
+  shuffle: bool, optional (default True)
+    Whether to byte-shuffle the values before compressing them.
+  dtype: str, optional
+    Storage dtype of the values ('float32' or 'float16'). Default: the
+    dtype of the dataset.
+  quantize: int, optional
+    8 or 16: store every value as an integer of that many bits, linearly
+    mapped between the minimum and maximum of its gene within the block
+    (lossy; the maximum error is (max - min) / (2**quantize - 2) / 2).
+  chunk_rows: int, optional (default 4096)
+    Number of profiles per compressed block.
+  """
+
+  def __init__(self,
+               codec: str = 'zlib',
+               level: Optional[int] = None,
+               shuffle: bool = True,
+               dtype: Optional[str] = None,
+               quantize: Optional[int] = None,
+               chunk_rows: int = 4096):
+    assert codec in CODECS, "Unknown or unavailable codec {!r} (available: {})".format(
+        codec, available_codecs())
+    assert dtype in (None, 'float32', 'float16'), \
+        "dtype must be None, 'float32' or 'float16'"
+    assert quantize in (None, 8, 16), "quantize must be None, 8 or 16"
+    assert dtype is None or quantize is None, \
+        "dtype and quantize are mutually exclusive"
+    assert isinstance(chunk_rows, int) and chunk_rows > 0, \
+        "chunk_rows must be a positive integer"
+    self.codec = codec
+    self.level = CODECS[codec][2] if level is None else level
+    self.shuffle = shuffle
+    self.dtype = dtype
+    self.quantize = quantize
+    self.chunk_rows = chunk_rows
+
+  def to_dict(self) -> Dict:
+    return {
+        'codec': self.codec,
+        'level': self.level,
+        'shuffle': self.shuffle,
+        'dtype': self.dtype,
+        'quantize': self.quantize,
+        'chunk_rows': self.chunk_rows,
+    }
+
+  @classmethod
+  def from_dict(cls, settings: Dict) -> 'Compression':
+    return cls(**settings)
+
+  def __repr__(self) -> str:
+    return "Compression({})".format(", ".join(
+        "{}={!r}".format(k, v) for k, v in self.to_dict().items()))
+
+
+def encode_block(block: np.ndarray, compression: Compression) -> bytes:
+  """Compressed bytes of a (profiles x genes) block"""
+  block = np.ascontiguousarray(block)
+  header = b''
+  if compression.quantize is not None:
+    qtype = np.uint8 if compression.quantize == 8 else np.uint16
+    top = np.iinfo(qtype).max - 1  # the last code marks NaN
+    with np.errstate(invalid='ignore'):
+      low = np.nanmin(block, axis=0) if len(block) else np.zeros(block.shape[1])
+      high = np.nanmax(block, axis=0) if len(block) else np.zeros(block.shape[1])
+    low = np.nan_to_num(low).astype(np.float32)
+    scale = (np.nan_to_num(high).astype(np.float32) - low) / top
+    scale[scale == 0] = 1
+    values = np.rint((block - low) / scale)
+    values[np.isnan(block)] = top + 1
+    values = values.astype(qtype)
+    header = low.tobytes() + scale.astype(np.float32).tobytes()
+  elif compression.dtype is not None:
+    values = block.astype(compression.dtype)
+  else:
+    values = block
+
+  data = shuffle_bytes(values) if compression.shuffle else values.tobytes()
+  return CODECS[compression.codec][0](header + data, compression.level)
+
+
+def decode_block(payload: bytes, compression: Compression, n_genes: int,
+                 dtype) -> np.ndarray:
+  """Inverse of encode_block: (profiles x genes) matrix of dtype"""
+  raw = CODECS[compression.codec][1](payload)
+  if compression.quantize is not None:
+    stored = np.uint8 if compression.quantize == 8 else np.uint16
+    low = np.frombuffer(raw, dtype=np.float32, count=n_genes)
+    scale = np.frombuffer(raw, dtype=np.float32, count=n_genes,
+                          offset=4 * n_genes)
+    raw = raw[8 * n_genes:]
+  else:
+    stored = compression.dtype or dtype
+
+  if compression.shuffle:
+    values = unshuffle_bytes(raw, stored)
+  else:
+    values = np.frombuffer(raw, dtype=stored)
+  values = values.reshape(-1, n_genes)
+
+  if compression.quantize is None:
+    return values.astype(dtype)
+  block = (values * scale + low).astype(dtype)
+  block[values == np.iinfo(stored).max] = np.nan
+  return block
+
+
+def decode_blocks(payloads: List[bytes],
+                  compression: Compression,
+                  n_genes: int,
+                  dtype,
+                  n_jobs: Optional[int] = None) -> np.ndarray:
+  """Decode consecutive blocks into one matrix, n_jobs at a time (threads)
+
+  Every block but the last holds compression.chunk_rows profiles, so each
+  thread writes its block straight to its place in the output.
+
+  Parameters
+  ----------
+  payloads: List[bytes]
+    Encoded blocks, in order.
+  compression: Compression
+    Settings the blocks were encoded with.
+  n_genes: int
+    Number of expression columns.
+  dtype:
+    dtype of the result.
+  n_jobs: int, optional
+    Number of decoding threads (-1: one per CPU). Default=None (one per
+    CPU as well; decoding is CPU bound and the codecs release the GIL).
+  """
+  n_jobs = effective_n_jobs(-1 if n_jobs is None else n_jobs)
+  if not payloads:
+    return np.zeros((0, n_genes), dtype=dtype)
+  last = decode_block(payloads[-1], compression, n_genes, dtype)
+  rows = compression.chunk_rows
+  out = np.empty(((len(payloads) - 1) * rows + len(last), n_genes), dtype=dtype)
+  out[len(out) - len(last):] = last
+
+  def decode(i: int) -> None:
+    out[i * rows:(i + 1) * rows] = decode_block(payloads[i], compression,
+                                                n_genes, dtype)
+
+  if n_jobs == 1 or len(payloads) <= 2:
+    for i in range(len(payloads) - 1):
+      decode(i)
+  else:
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+      list(executor.map(decode, range(len(payloads) - 1)))
+  return out
@@ -0,0 +1,453 @@
+"""
+Columnar in-memory representation of parsed LINCS data.
+
+The parsers historically return a list of
+[(cell_line, drug, drug_type, dose, dose_unit, time, time_unit), np.array]
+pairs. LincsDataset keeps the same information as one contiguous 2-D
+expression matrix and one categorical-coded NumPy column per metadata field,
+and converts losslessly to and from the legacy list format.
+"""
+from __future__ import unicode_literals, print_function, division
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+__author__ = "Hosein Fooladi"
+__email__ = "fooladi.hosein@gmail.com"
+
+# Order of the metadata fields in line[0] of the legacy list format.
+FIELDS = ('cell_id', 'pert_id', 'pert_type', 'pert_dose', 'pert_dose_unit',
+          'pert_time', 'pert_time_unit')
+
+# Additional fields of the "allinfo" format consumed by utils.parse_list_v2.
+EXTRA_FIELDS = ('is_touchstone', 'clinical_phase', 'moa', 'target')
+
+
+def _object_array(values: Sequence) -> np.ndarray:
+  """Build a 1-D object array without letting NumPy broadcast nested items"""
+  values = list(values)
+  return np.fromiter(values, dtype=object, count=len(values))
+
+
+def _hashable(value):
+  """Hashable stand-in for list / ndarray metadata values"""
+  if isinstance(value, np.ndarray):
+    return ('__ndarray__', value.dtype.str, value.shape, value.tobytes())
+  if isinstance(value, (list, tuple)):
+    return (type(value).__name__,) + tuple(_hashable(x) for x in value)
+  return value
+
+
+def encode_column(values: Sequence) -> Tuple[np.ndarray, np.ndarray]:
+  """Categorical encoding of one metadata column
+
+  Categories are kept in order of first appearance, and they are the
+  original (unconverted) objects, so decoding gives back exactly the values
+  that were encoded. Missing values (None / NaN) share one category.
+
+  Parameters
+  ----------
+  values: Sequence
+    The values of the column, one per profile.
+
+  Returns
+  -------
+  codes: np.ndarray
+    int32 array with the category code of every profile.
+  categories: np.ndarray
+    Object array of the distinct values.
+  """
+  arr = values if isinstance(values, np.ndarray) and values.dtype == object \
+      else _object_array(values)
+  try:
+    codes, categories = pd.factorize(arr, use_na_sentinel=False)
+    categories = _object_array(categories)
+  except TypeError:
+    # Unhashable values (e.g. moa / target stored as lists)
+    keys = _object_array([_hashable(x) for x in arr])
+    codes, _ = pd.factorize(keys, use_na_sentinel=False)
+    _, first = np.unique(codes, return_index=True)
+    categories = arr[first]
+  return codes.astype(np.int32, copy=False), categories
+
+
+class LincsDataset(object):
+  """Parsed LINCS profiles stored column-wise
+
+  Parameters
+  ----------
+  expression: Optional[np.ndarray]
+    2-D matrix with one row per profile and one column per gene.
+    It can be None for metadata-only datasets (used for filtering
+    legacy lists without copying their expression vectors).
+  codes: Dict[str, np.ndarray]
+    Category codes (int32) of every metadata field.
+  categories: Dict[str, np.ndarray]
+    Distinct values of every metadata field.
+  fields: Sequence[str], optional
+    Order of the metadata fields in the legacy tuple. Default=FIELDS
+  gene_ids: Sequence[str], optional
+    Identifiers of the expression columns (GCTX row ids).
+  """
+
+  def __init__(self,
+               expression: Optional[np.ndarray],
+               codes: Dict[str, np.ndarray],
+               categories: Dict[str, np.ndarray],
+               fields: Optional[Sequence[str]] = None,
+               gene_ids: Optional[Sequence[str]] = None):
+    self.fields = tuple(FIELDS if fields is None else fields)
+    assert set(self.fields) == set(codes), "codes must cover every field"
+    assert set(self.fields) == set(categories), \
+        "categories must cover every field"
+
+    n = len(codes[self.fields[0]]) if self.fields else 0
+    for field in self.fields:
+      assert len(codes[field]) == n, "All metadata columns must have the same length"
+    if expression is not None:
+      assert expression.ndim == 2, "expression must be a 2-D matrix"
+      assert expression.shape[0] == n, \
+          "expression must have one row per profile"
+
+    self.expression = expression
+    self.codes = codes
+    self.categories = categories
+    self.gene_ids = None if gene_ids is None else np.asarray(gene_ids)
+    self._n = n
+    self._index = None
+    self._stats = {}  # cache of statistics.field_counts, per field
+    self._fingerprint = None
+    self._ranks = None  # cache of similarity.py (standardized gene ranks)
+    self._n_queries = 0  # filters run on the dataset (see utils._columns)
+
+  @classmethod
+  def from_list(cls,
+                data: List,
+                dtype=None,
+                fields: Optional[Sequence[str]] = None,
+                expression: bool = True) -> 'LincsDataset':
+    """Convert the legacy list format into a LincsDataset
+
+    Parameters
+    ----------
+    data: List
+      It must be a list of tuples with the following format:
+      line[0]:(cell_line, drug, drug_type, does, does_type, time, time_type, ...)
+      line[1]: 978 or 12328-dimensional Vector(Gene_expression_profile)
+    dtype: optional
+      dtype of the expression matrix. Default: the dtype of the first
+      vector (float32 for an empty list), so that the conversion is
+      lossless; e.g. np.float32 halves the memory of float64 vectors.
+    fields: Sequence[str], optional
+      Names of the metadata fields. By default FIELDS, followed by
+      EXTRA_FIELDS when the tuples are longer (the "allinfo" format).
+    expression: bool (default True)
+      If False, only the metadata is converted and the expression
+      matrix is None.
+
+    Returns
+    -------
+    LincsDataset
+    """
+    assert isinstance(data, list), "The data must be a list object"
+
+    width = len(data[0][0]) if len(data) > 0 else len(FIELDS)
+    if fields is None:
+      fields = (FIELDS + EXTRA_FIELDS)[:width]
+      if width > len(fields):
+        fields = fields + tuple(
+            'field_{}'.format(i) for i in range(len(fields), width))
+    assert len(fields) == width, "fields must match the metadata tuples"
+
+    codes = {}
+    categories = {}
+    for k, field in enumerate(fields):
+      codes[field], categories[field] = encode_column(
+          [line[0][k] for line in data])
+
+    matrix = None
+    if expression:
+      n_genes = len(data[0][1]) if len(data) > 0 else 0
+      if dtype is None:
+        dtype = np.asarray(data[0][1]).dtype if len(data) > 0 else np.float32
+      matrix = np.empty((len(data), n_genes), dtype=dtype)
+      for i, line in enumerate(data):
+        matrix[i] = line[1]
+
+    return cls(matrix, codes, categories, fields=fields)
+
+  @classmethod
+  def from_frame(cls,
+                 metadata: pd.DataFrame,
+                 expression: Optional[np.ndarray],
+                 columns: Optional[Sequence[str]] = None,
+                 gene_ids: Optional[Sequence[str]] = None) -> 'LincsDataset':
+    """Build a LincsDataset from a metadata table (inst_info / sig_info rows)
+
+    Parameters
+    ----------
+    metadata: pd.DataFrame
+      One row per profile, in the same order as the expression rows.
+    expression: Optional[np.ndarray]
+      Expression matrix (profiles x genes).
+    columns: Sequence[str], optional
+      Columns of metadata to keep as fields. Default=FIELDS
+    gene_ids: Sequence[str], optional
+      Identifiers of the expression columns.
+
+    Returns
+    -------
+    LincsDataset
+    """
+    columns = tuple(FIELDS if columns is None else columns)
+    codes = {}
+    categories = {}
+    for field in columns:
+      codes[field], categories[field] = encode_column(
+          metadata[field].to_numpy(dtype=object))
+    return cls(expression, codes, categories, fields=columns, gene_ids=gene_ids)
+
+  @classmethod
+  def concat(cls, datasets: Sequence['LincsDataset']) -> 'LincsDataset':
+    """Concatenate datasets with the same fields and genes
+
+    Parameters
+    ----------
+    datasets: Sequence[LincsDataset]
+      Consecutive blocks of profiles (e.g. yielded by a streaming parser).
+
+    Returns
+    -------
+    LincsDataset
+    """
+    datasets = list(datasets)
+    assert len(datasets) > 0, "No dataset to concatenate"
+    if len(datasets) == 1:
+      return datasets[0]
+    fields = datasets[0].fields
+    assert all(dataset.fields == fields for dataset in datasets), \
+        "datasets must have the same fields"
+    codes = {}
+    categories = {}
+    for field in fields:
+      codes[field], categories[field] = encode_column(
+          np.concatenate([dataset.column(field) for dataset in datasets]))
+    expression = None
+    if datasets[0].expression is not None:
+      expression = np.concatenate([dataset.expression for dataset in datasets])
+    return cls(expression,
+               codes,
+               categories,
+               fields=fields,
+               gene_ids=datasets[0].gene_ids)
+
+  def to_list(self) -> List:
+    """Convert back to the legacy list format
+
+    Returns
+    -------
+    List
+      line[0]: tuple with the metadata fields in self.fields order
+      line[1]: expression vector (a copy, or None for metadata-only datasets)
+    """
+    columns = [self.column(field) for field in self.fields]
+    rows = zip(*columns) if columns else iter([()] * len(self))
+    if self.expression is None:
+      return [[meta, None] for meta in rows]
+    return [[meta, np.array(vector)]
+            for meta, vector in zip(rows, self.expression)]
+
+  def column(self, field: str) -> np.ndarray:
+    """Decoded values of one metadata field (object array)"""
+    return self.categories[field][self.codes[field]]
+
+  def categorical(self, field: str) -> Union[pd.Categorical, np.ndarray]:
+    """Values of one metadata field as a pandas Categorical
+
+    The codes are used as they are (no decoding of the column). Missing
+    values (None / NaN) become missing values of the Categorical. Fields
+    with unhashable values (e.g. lists) are returned decoded, as an object
+    array.
+    """
+    categories = self.categories[field]
+    codes = np.asarray(self.codes[field])
+    try:
+      missing = np.array(
+          [pd.api.types.is_scalar(x) and pd.isna(x) for x in categories],
+          dtype=bool)
+      if missing.any():
+        mapping = np.cumsum(~missing, dtype=np.int32) - 1
+        mapping[missing] = -1
+        codes = mapping[codes]
+        categories = categories[~missing]
+      return pd.Categorical.from_codes(codes, pd.Index(categories, dtype=object))
+    except TypeError:
+      return self.column(field)
+
+  def subset(self, indices: Union[np.ndarray, Sequence[int], slice]) -> 'LincsDataset':
+    """Rows of the dataset selected by indices (or a slice)
+
+    Categories are shared with the parent dataset.
+    """
+    if not isinstance(indices, slice):
+      indices = np.asarray(indices, dtype=np.intp)
+    expression = None if self.expression is None else self.expression[indices]
+    codes = {field: self.codes[field][indices] for field in self.fields}
+    return LincsDataset(expression,
+                        codes,
+                        dict(self.categories),
+                        fields=self.fields,
+                        gene_ids=self.gene_ids)
+
+  def gene_positions(self, genes: Union[Sequence, np.ndarray, slice]) -> Union[np.ndarray, slice]:
+    """Column indices of genes in the expression matrix
+
+    Parameters
+    ----------
+    genes: Union[Sequence, np.ndarray, slice]
+      Gene identifiers (matched against gene_ids as strings), a boolean
+      mask or integer positions of the columns, or a slice.
+
+    Returns
+    -------
+    Union[np.ndarray, slice]
+      A slice when the columns are evenly spaced (in increasing order), so
+      that indexing with it gives a view; otherwise an intp array.
+    """
+    if isinstance(genes, slice):
+      return genes
+    genes = np.asarray(genes)
+    if genes.dtype == bool:
+      assert len(genes) == self.n_genes, "The gene mask must cover every gene"
+      positions = np.flatnonzero(genes)
+    elif genes.dtype.kind in 'iu':
+      positions = genes.astype(np.intp)
+    else:
+      assert self.gene_ids is not None, "The dataset has no gene_ids"
+      ids = self.gene_ids.astype(str)
+      order = np.argsort(ids, kind='stable')
+      wanted = genes.astype(str)
+      found = np.searchsorted(ids[order], wanted).clip(max=len(ids) - 1)
+      known = ids[order][found] == wanted if len(ids) else \
+          np.zeros(len(wanted), dtype=bool)
+      assert known.all(), "{} genes are not in the dataset, e.g. {}".format(
+          (~known).sum(), wanted[~known][:5].tolist())
+      positions = order[found]
+
+    if len(positions) == 1:
+      return slice(int(positions[0]), int(positions[0]) + 1)
+    if len(positions) > 1:
+      step = positions[1] - positions[0]
+      if step > 0 and np.all(np.diff(positions) == step):
+        return slice(int(positions[0]), int(positions[-1]) + 1, int(step))
+    return positions
+
+  def select_genes(self, genes: Union[Sequence, np.ndarray, slice]) -> 'LincsDataset':
+    """Projection of the dataset on a subset of genes (columns)
+
+    Profiles and metadata (including the metadata index) are shared with
+    the dataset. When the selected columns are evenly spaced, e.g. the
+    landmark genes stored first by save_dataset(leading_genes=...), the
+    expression matrix is a view (of the memory map, for datasets opened
+    with open_dataset); otherwise only the selected columns are copied.
+
+    Parameters
+    ----------
+    genes: Union[Sequence, np.ndarray, slice]
+      Gene identifiers, e.g. metadata.gene_subset(gene_info_dir, 'bing'),
+      or positions (see gene_positions).
+
+    Returns
+    -------
+    LincsDataset
+    """
+    assert self.expression is not None, "The dataset has no expression matrix"
+    positions = self.gene_positions(genes)
+    projection = LincsDataset(
+        self.expression[:, positions],
+        self.codes,
+        self.categories,
+        fields=self.fields,
+        gene_ids=None if self.gene_ids is None else self.gene_ids[positions])
+    projection._index = self._index
+    projection._stats = self._stats
+    projection._fingerprint = self._fingerprint
+    return projection
+
+  @property
+  def metadata_index(self):
+    """The MetadataIndex of the dataset, or None if it has not been built"""
+    return self._index
+
+  def build_index(self):
+    """Build (once) the inverted metadata index used by the filters
+
+    Returns
+    -------
+    MetadataIndex
+    """
+    if self._index is None:
+      from .index import MetadataIndex
+      self._index = MetadataIndex.build(self)
+    return self._index
+
+  def attach_index(self, index) -> None:
+    """Use a previously built (e.g. loaded from disk) MetadataIndex"""
+    index.check(self)
+    self._index = index
+
+  def fingerprint(self) -> str:
+    """Hash of the metadata (fields, codes and categories) of the dataset
+
+    Two datasets with the same fingerprint give the same result to any
+    metadata filter, so it keys the on-disk cache of query results (see
+    query_cache.py). The expression matrix is not hashed.
+    """
+    if self._fingerprint is None:
+      digest = hashlib.sha256()
+      digest.update(repr((self.fields, len(self))).encode('utf-8'))
+      for field in self.fields:
+        digest.update(
+            np.ascontiguousarray(self.codes[field], dtype='<i4').tobytes())
+        digest.update(repr([(type(x).__name__, x)
+                            for x in self.categories[field]]).encode('utf-8'))
+      self._fingerprint = digest.hexdigest()
+    return self._fingerprint
+
+  @property
+  def n_genes(self) -> int:
+    return 0 if self.expression is None else self.expression.shape[1]
+
+  @property
+  def nbytes(self) -> int:
+    """Approximate memory footprint in bytes"""
+    size = 0 if self.expression is None else self.expression.nbytes
+    for field in self.fields:
+      size += self.codes[field].nbytes + self.categories[field].nbytes
+    return size
+
+  def __len__(self) -> int:
+    return self._n
+
+  def __getitem__(self, item):
+    if isinstance(item, (int, np.integer)):
+      if item < 0:
+        item += len(self)
+      if not 0 <= item < len(self):
+        raise IndexError("LincsDataset index out of range")
+      meta = tuple(self.categories[field][self.codes[field][item]]
+                   for field in self.fields)
+      vector = None if self.expression is None else self.expression[item]
+      return [meta, vector]
+    return self.subset(item)
+
+  def __iter__(self) -> Iterator[List]:
+    for i in range(len(self)):
+      yield self[i]
+
+  def __repr__(self) -> str:
+    return "LincsDataset(n_profiles={}, n_genes={}, fields={})".format(
+        len(self), self.n_genes, list(self.fields))
@@ -12,6 +12,8 @@ from typing import List, Tuple
 import pandas as pd
 from collections import Counter
 
+from .metadata import read_metadata
+
 __author__ = "Hosein Fooladi"
 __email__ = "fooladi.hosein@gmail.com"
 
@@ -32,10 +34,7 @@ def print_drug_statistics(drug_info_dir: str) -> None:
   assert isinstance(drug_info_dir,
                     str), "The dataset_dir must be a string object"
 
-  drug_info = pd.read_csv(drug_info_dir,
-                          sep='\t',
-                          skiprows=9,
-                          encoding='latin-1')
+  drug_info = read_metadata(drug_info_dir, kind='drug_info')
 
   print("=================================================================")
   print("Data Statistics\n")
@@ -87,11 +86,8 @@ def drug_pert_retrieval(drug_info_dir: str,
                     str), "The dataset_dir must be a string object"
   assert isinstance(pert_type, str), "The pert_type must be a string object"
 
-  drug_info = pd.read_csv(drug_info_dir,
-                          sep='\t',
-                          skiprows=9,
-                          encoding='latin-1')
-  pert_info = pd.read_csv(pert_info_dir, sep='\t')
+  drug_info = read_metadata(drug_info_dir, kind='drug_info')
+  pert_info = read_metadata(pert_info_dir, kind='pert_info')
 
   assert pert_type in pert_info.pert_type.unique(
   ), "pert_type should be in the list of available perturbations"
@@ -1,71 +1,361 @@
+"""
+Command line filter of parsed LINCS data.
+
+All the filters (--cells, --compounds, --doses, --times) are fused into a
+single predicate, evaluated in one streaming pass over --chunk-size
+profiles at a time, so no intermediate copy of the dataset is made.
+Datasets in the on-disk format (see storage.py) are memory-mapped, and a
+dataset output is written with a DatasetWriter as soon as the matches are
+found. Chunked files (see chunked.py) are likewise decoded block by block.
+Memory then stays at about one chunk. Pickles are not streamed: a .pkl
+input is read whole, and a .pkl output (the default) holds every match
+until it is written as one list, as the legacy format requires. Use a
+dataset output, and a dataset, chunked or partitioned input, for constant
+memory.
+For partitioned datasets (see partition.py), only the partitions that can
+hold matching profiles (e.g. those of --cells) are read.
+With --cache-dir (or LINCS_QUERY_CACHE_DIR), the selected rows are stored
+in the query cache (see query_cache.py) and a repeated selection on an
+unchanged dataset skips the scan.
+
+Example:
+  python src/filtering.py --dataset_dir Data/level3_trt_cp_landmark \
+      --cells MCF7 A375 --times 24 --output_dir Data/after_parsing
+"""
 import argparse
+import os
+import sys
+import time
 import numpy as np
 import pickle
-import random
 from tqdm import tqdm
-from collections import Counter
+from typing import Iterator, List, Optional, Tuple, Union
+
+if __package__ in (None, ''):
+  # Executed as a script (python src/filtering.py): make the package importable
+  sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+  __package__ = 'src'
+
+from .cache import file_stamp
+from .chunked import ChunkedReader, is_chunked
+from .compression import Compression, available_codecs
+from .dataset import LincsDataset
+from . import instrument
+from .instrument import current_stage, instrumented, stage
+from .partition import (dataset_fields, is_partitioned, open_partitioned, prune,
+                        read_manifest)
+from .query import And, FieldPredicate, isin
+from .query_cache import configure, query_cache
+from .storage import DatasetWriter, is_dataset_dir, open_dataset
 
 __author__ = "Hosein Fooladi"
 __email__ = "fooladi.hosein@gmail.com"
 
-parser = argparse.ArgumentParser(description='Parsing LINCS')
-parser.add_argument('--dataset_dir',
-                    type=str,
-                    default='Data/level3_trt_cp_landmark.pkl')
-parser.add_argument('--data', type=list, default=None)
-parser.add_argument('--cells', type=str, nargs='+', default=None)
-parser.add_argument('--compounds', type=str, nargs='+', default=None)
-parser.add_argument('--doses', type=float, nargs='+', default=None)
-parser.add_argument('--times', type=int, nargs='+', default=None)
-parser.add_argument('--output_dir', type=str, default='Data/after_parsing.pkl')
-
-flags = parser.parse_args()
-
-assert isinstance(flags.dataset_dir,
-                  str), "The dataset_dir must be a string object"
-
-print("=================================================================")
-print("Data Loading..")
-
-## If you enter the data (which is a list), it overrides the dataset_dir and ignore it.
-if flags.data is None:
-  with open(flags.dataset_dir, "rb") as f:
-    train = pickle.load(f)
-else:
-  assert isinstance(flags.data, list), "The data must be a list object"
-  train = flags.data
-
-print("Number of Train Data: {}".format(len(train)))
-
-if flags.cells is None:
-  pass
-else:
-  train = [line for line in train if line[0][0] in flags.cells]
-  print("Number of training data after parsing based on cell lines: {}".format(
-      len(train)))
-
-if flags.compounds is None:
-  pass
-else:
-  train = [line for line in train if line[0][1] in flags.compounds]
-  print("Number of training data after parsing based on compounds: {}".format(
-      len(train)))
-
-if flags.doses is None:
-  pass
-else:
-  train = [line for line in train if line[0][3] in flags.doses]
-  print("Number of training data after parsing based on doses: {}".format(
-      len(train)))
-
-if flags.times is None:
-  pass
-else:
-  train = [line for line in train if line[0][5] in flags.times]
-  print("Number of training data after parsing based on times: {}".format(
-      len(train)))
-
-print("Number of final training data after parsing: {}".format(len(train)))
-
-with open(flags.output_dir, 'wb') as f:
-  pickle.dump(train, f)
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+  parser = argparse.ArgumentParser(description='Parsing LINCS')
+  parser.add_argument('--dataset_dir',
+                      type=str,
+                      default='Data/level3_trt_cp_landmark.pkl',
+                      help='Pickle (read whole), dataset, chunked or '
+                      'partitioned directory (read chunk by chunk)')
+  parser.add_argument('--data', type=list, default=None)
+  parser.add_argument('--cells', type=str, nargs='+', default=None)
+  parser.add_argument('--compounds', type=str, nargs='+', default=None)
+  parser.add_argument('--doses', type=float, nargs='+', default=None)
+  parser.add_argument('--times', type=int, nargs='+', default=None)
+  parser.add_argument('--output_dir',
+                      type=str,
+                      default='Data/after_parsing.pkl')
+  parser.add_argument('--output_format',
+                      type=str,
+                      choices=['pickle', 'dataset'],
+                      default=None,
+                      help='pickle (list format, kept in memory until '
+                      'written) or dataset (see storage.py, written as the '
+                      'matches are found). Default: pickle if output_dir '
+                      'ends with .pkl')
+  parser.add_argument('--chunk-size',
+                      '--chunk_size',
+                      dest='chunk_size',
+                      type=int,
+                      default=100000,
+                      help='Number of profiles filtered at a time')
+  parser.add_argument('--compression',
+                      type=str,
+                      choices=available_codecs(),
+                      default=None,
+                      help='Codec of the expression matrix of a dataset '
+                      'output (see compression.py). Default: uncompressed')
+  parser.add_argument('--cache-dir',
+                      '--cache_dir',
+                      dest='cache_dir',
+                      type=str,
+                      default=None,
+                      help='Directory of the query-result cache. '
+                      'Default: LINCS_QUERY_CACHE_DIR (no cache if unset)')
+  parser.add_argument('--instrument',
+                      action='store_true',
+                      help='Print the time, rows and peak memory of every '
+                      'stage to stderr (see instrument.py)')
+  parser.add_argument('--instrument-log',
+                      '--instrument_log',
+                      dest='instrument_log',
+                      type=str,
+                      default=None,
+                      help='Append the stage events to this JSON log')
+  return parser.parse_args(argv)
+
+
+def build_filters(flags: argparse.Namespace,
+                  fields: Tuple[str, ...]) -> List[FieldPredicate]:
+  """One predicate per filter given on the command line"""
+  filters = []
+  for values, k in [(flags.cells, 0), (flags.compounds, 1), (flags.doses, 3),
+                    (flags.times, 5)]:
+    if values is not None:
+      filters.append(isin(fields[k], values))
+  return filters
+
+
+def fused_mask(filters: List[FieldPredicate], chunk: LincsDataset,
+               category_masks: Optional[dict] = None) -> np.ndarray:
+  """AND of all the filters on the profiles of chunk
+
+  category_masks holds the per-category result of every filter; chunks
+  of one dataset share its categories, so they are computed only once.
+  """
+  if category_masks is None:
+    category_masks = {}
+  mask = np.ones(len(chunk), dtype=bool)
+  for i, predicate in enumerate(filters):
+    if i not in category_masks:
+      category_masks[i] = predicate.category_mask(chunk)
+    mask &= category_masks[i][chunk.codes[predicate.field]]
+  return mask
+
+
+def iter_matches(
+    train: Union[List, LincsDataset],
+    filters: List[FieldPredicate],
+    chunk_size: int,
+    indices: Optional[np.ndarray] = None
+) -> Iterator[Tuple[int, np.ndarray, Union[List, LincsDataset]]]:
+  """Stream the matching profiles of train, chunk by chunk
+
+  If indices (rows already known to match, e.g. from the query cache) is
+  given, the filters are not evaluated.
+
+  Yields
+  ------
+  (int, np.ndarray, Union[List, LincsDataset])
+    Number of profiles scanned, row indices of the matches among them and
+    the matches themselves (same format as train).
+  """
+  assert isinstance(chunk_size, int) and chunk_size > 0, \
+      "chunk_size must be a positive integer"
+  if indices is not None:
+    scanned = 0
+    for start in range(0, len(indices), chunk_size):
+      rows = indices[start:start + chunk_size]
+      end = len(train) if start + chunk_size >= len(indices) else rows[-1] + 1
+      yield end - scanned, rows, _take(train, rows)
+      scanned = end
+    if len(indices) == 0:
+      yield len(train), indices, _take(train, indices)
+    return
+
+  category_masks = {}
+  for start in range(0, len(train), chunk_size):
+    if isinstance(train, LincsDataset):
+      chunk = train.subset(slice(start, start + chunk_size))
+      rows = np.flatnonzero(fused_mask(filters, chunk, category_masks))
+      yield len(chunk), rows + start, chunk.subset(rows)
+    else:
+      block = train[start:start + chunk_size]
+      # Categories of a list chunk are its own: no sharing across chunks
+      columns = LincsDataset.from_list(block, expression=False)
+      rows = np.flatnonzero(fused_mask(filters, columns))
+      yield len(block), rows + start, [block[i] for i in rows]
+
+
+def _take(train: Union[List, LincsDataset],
+          rows: np.ndarray) -> Union[List, LincsDataset]:
+  if isinstance(train, LincsDataset):
+    return train.subset(rows)
+  return [train[i] for i in rows]
+
+
+def _cache_fingerprint(flags: argparse.Namespace,
+                       train: Union[List, LincsDataset, ChunkedReader]) -> str:
+  """Identifier of the input in the query cache
+
+  Chunked files and pickles are identified by their path and file stamp
+  (mtime, size), as in the dataset cache: the metadata fingerprint would
+  need all their blocks decoded, even for a cache hit.
+  """
+  if isinstance(train, LincsDataset):
+    return train.fingerprint()
+  if flags.data is None:
+    path = os.path.abspath(flags.dataset_dir)
+    return 'file:{}:{}:{}'.format(path, *file_stamp(path))
+  return LincsDataset.from_list(train, expression=False).fingerprint()
+
+
+class _PickleOutput(object):
+  """Matches collected in the legacy list format and pickled on close
+
+  The legacy format is a single pickled list, so every match is kept in
+  memory until close (use a dataset output to stream).
+  """
+
+  def __init__(self, output_dir: str):
+    self.output_dir = output_dir
+    self.data = []
+    self.n_profiles = 0
+
+  def append(self, matches: Union[List, LincsDataset]) -> None:
+    if isinstance(matches, LincsDataset):
+      matches = matches.to_list()
+    self.data.extend(matches)
+    self.n_profiles += len(matches)
+
+  def close(self) -> None:
+    with open(self.output_dir, 'wb') as f:
+      pickle.dump(self.data, f)
+
+
+class _DatasetOutput(object):
+  """Matches written to an on-disk dataset as they come
+
+  template (e.g. the first profile of the input) gives the fields, genes
+  and dtype of the output when no profile matches.
+  """
+
+  def __init__(self, output_dir: str, compression: Optional[str] = None,
+               template: Optional[LincsDataset] = None):
+    self.output_dir = output_dir
+    self.compression = None if compression is None else Compression(compression)
+    self.template = template
+    self.writer = None
+    self.n_profiles = 0
+
+  def _open(self, dataset: LincsDataset) -> None:
+    self.writer = DatasetWriter(self.output_dir,
+                                dataset.fields,
+                                dataset.n_genes,
+                                gene_ids=dataset.gene_ids,
+                                dtype=dataset.expression.dtype,
+                                compression=self.compression)
+
+  def append(self, matches: Union[List, LincsDataset]) -> None:
+    if len(matches) == 0:
+      return
+    if isinstance(matches, list):
+      matches = LincsDataset.from_list(matches)
+    if self.writer is None:
+      self._open(matches)
+    self.writer.append(matches)
+    self.n_profiles += len(matches)
+
+  def close(self) -> None:
+    if self.writer is None:
+      # No profile matches the filters: empty dataset
+      self._open(self.template if self.template is not None else
+                 LincsDataset.from_list([]))
+    self.writer.close()
+    open_dataset(self.output_dir, index=False).build_index().save(
+        os.path.join(self.output_dir, 'index.npz'))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+  flags = parse_args(argv)
+  if flags.instrument or flags.instrument_log is not None:
+    instrument.configure(log_path=flags.instrument_log,
+                         hook=instrument.print_event if flags.instrument else None)
+  return _main(flags)
+
+
+@instrumented('filtering')
+def _main(flags: argparse.Namespace) -> int:
+  assert isinstance(flags.dataset_dir,
+                    str), "The dataset_dir must be a string object"
+
+  print("=================================================================")
+
+  ## If you enter the data (which is a list), it overrides the dataset_dir and ignore it.
+  with stage('load') as current:
+    if flags.data is None:
+      if is_dataset_dir(flags.dataset_dir):
+        train = open_dataset(flags.dataset_dir, index=False)
+      elif is_partitioned(flags.dataset_dir):
+        # Partition pruning: only the partitions that can match are read
+        predicate = And(*build_filters(flags, dataset_fields(flags.dataset_dir)))
+        train = open_partitioned(flags.dataset_dir, predicate, index=False)
+        print("Partitions read: {} of {}".format(
+            len(prune(flags.dataset_dir, predicate)),
+            len(read_manifest(flags.dataset_dir)['partitions'])))
+      elif is_chunked(flags.dataset_dir):
+        # Read block by block while filtering (see chunked.py)
+        train = ChunkedReader(flags.dataset_dir)
+      else:
+        with open(flags.dataset_dir, "rb") as f:
+          train = pickle.load(f)
+    else:
+      assert isinstance(flags.data, list), "The data must be a list object"
+      train = flags.data
+    current.rows = len(train)
+
+  print("Number of Train Data: {}".format(len(train)))
+
+  # No profile: fields, genes and dtype of the input
+  if isinstance(train, LincsDataset):
+    template = train.subset(slice(0, 0))
+  else:
+    template = LincsDataset.from_list(train[:1])
+  filters = build_filters(flags, template.fields)
+
+  if flags.cache_dir is not None:
+    configure(flags.cache_dir)
+  indices, cache_key = None, None
+  if query_cache.enabled:
+    cache_key = (_cache_fingerprint(flags, train), And(*filters).key())
+    indices = query_cache.get(*cache_key)
+    print("Query cache: {}".format("hit" if indices is not None else "miss"))
+
+  output_format = flags.output_format
+  if output_format is None:
+    output_format = 'pickle' if flags.output_dir.endswith('.pkl') else 'dataset'
+  if output_format == 'dataset':
+    output = _DatasetOutput(flags.output_dir, flags.compression, template)
+  else:
+    output = _PickleOutput(flags.output_dir)
+
+  begin = time.time()
+  selected = []
+  with stage('filter', rows=len(train)) as current, \
+      tqdm(total=len(train), unit='profiles', unit_scale=True) as progress:
+    for n_scanned, rows, matches in iter_matches(train, filters,
+                                                 flags.chunk_size, indices):
+      output.append(matches)
+      selected.append(rows)
+      progress.update(n_scanned)
+      progress.set_postfix(kept=output.n_profiles)
+    current.info['kept'] = output.n_profiles
+  with stage('write', rows=output.n_profiles):
+    output.close()
+  if cache_key is not None and indices is None:
+    query_cache.put(*cache_key, np.concatenate(selected))
+  elapsed = time.time() - begin
+
+  print("Number of final training data after parsing: {}".format(
+      output.n_profiles))
+  print("Filtered {} profiles in {:.2f} s ({:.0f} profiles/s)".format(
+      len(train), elapsed,
+      len(train) / elapsed if elapsed > 0 else float('inf')))
+  current_stage().rows = len(train)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,238 @@
+"""
+Direct, chunked access to the matrix of a GCTX (HDF5) file.
+
+cmapPy's parse() reads every selected column in one go (and, when a row
+subset is requested, all the columns of the file for those rows), then
+builds a pandas DataFrame. GctxReader reads bounded blocks of columns
+straight from the HDF5 dataset, so profiles can be processed with a memory
+footprint controlled by the caller.
+"""
+from __future__ import unicode_literals, print_function, division
+from typing import Iterator, Optional, Sequence, Tuple
+
+from concurrent.futures import ProcessPoolExecutor
+
+import h5py
+import numpy as np
+
+from .parallel import effective_n_jobs
+
+__author__ = "Hosein Fooladi"
+__email__ = "fooladi.hosein@gmail.com"
+
+rid_node = "/0/META/ROW/id"
+cid_node = "/0/META/COL/id"
+data_node = "/0/DATA/0/matrix"
+
+
+def _decode(ids: np.ndarray) -> np.ndarray:
+  """Row/column ids as an array of str"""
+  ids = np.asarray(ids)
+  if ids.dtype.kind == 'S':
+    return np.char.decode(ids, 'utf-8').astype(object)
+  if ids.dtype.kind == 'O':
+    return np.asarray(
+        [x.decode('utf-8') if isinstance(x, bytes) else str(x) for x in ids],
+        dtype=object)
+  return ids.astype(str).astype(object)
+
+
+class GctxReader(object):
+  """Reader of column blocks of a GCTX file
+
+  Parameters
+  ----------
+  dataset_dir: str
+    It must be string file that shows the directory of the dataset.
+    dataset should be a gctx file. e.g., valid argument is something like this:
+    './Data/Level3_INF_mlr12k_n1319138x12328.gctx'
+  """
+
+  def __init__(self, dataset_dir: str):
+    assert isinstance(dataset_dir, str), "The dataset_dir must be a string object"
+    self.dataset_dir = dataset_dir
+    self._file = h5py.File(dataset_dir, 'r')
+    self._matrix = self._file[data_node]
+    self.row_ids = _decode(self._file[rid_node][()])
+    self.col_ids = _decode(self._file[cid_node][()])
+
+  @property
+  def shape(self) -> Tuple[int, int]:
+    """(number of genes, number of profiles) like cmapPy's data_df"""
+    return len(self.row_ids), len(self.col_ids)
+
+  def _positions(self, ids: Sequence, all_ids: np.ndarray, name: str) -> np.ndarray:
+    lookup = {x: i for i, x in enumerate(all_ids)}
+    try:
+      return np.asarray([lookup[str(x)] for x in ids], dtype=np.int64)
+    except KeyError as e:
+      raise KeyError("{} {} is not in {}".format(name, e, self.dataset_dir))
+
+  def row_index(self, rid: Sequence) -> np.ndarray:
+    """Positions of the row (gene) ids, in the given order"""
+    return self._positions(rid, self.row_ids, 'rid')
+
+  def col_index(self, cid: Sequence) -> np.ndarray:
+    """Positions of the column (profile) ids, in the given order"""
+    return self._positions(cid, self.col_ids, 'cid')
+
+  def read(self,
+           cidx: np.ndarray,
+           ridx: Optional[np.ndarray] = None) -> np.ndarray:
+    """Read the profiles at column positions cidx
+
+    Parameters
+    ----------
+    cidx: np.ndarray
+      Increasing column positions.
+    ridx: np.ndarray, optional
+      Row (gene) positions to keep. Default=None (all the genes)
+
+    Returns
+    -------
+    np.ndarray
+      float32 matrix of shape (len(cidx), len(ridx)), one row per profile.
+    """
+    cidx = np.asarray(cidx, dtype=np.int64)
+    if len(cidx) == 0:
+      n_genes = len(self.row_ids) if ridx is None else len(ridx)
+      return np.zeros((0, n_genes), dtype=np.float32)
+    assert np.all(np.diff(cidx) > 0), "cidx must be strictly increasing"
+
+    lo, hi = int(cidx[0]), int(cidx[-1]) + 1
+    if hi - lo <= 2 * len(cidx):
+      # Dense selection: one contiguous hyperslab read is much faster than
+      # an HDF5 point selection.
+      block = self._matrix[lo:hi, :]
+      if hi - lo != len(cidx):
+        block = block[cidx - lo]
+    else:
+      block = self._matrix[cidx, :]
+
+    if ridx is not None:
+      block = block[:, ridx]
+    return np.ascontiguousarray(block, dtype=np.float32)
+
+  def iter_chunks(self,
+                  cidx: np.ndarray,
+                  ridx: Optional[np.ndarray] = None,
+                  chunk_size: Optional[int] = None,
+                  memory_budget: Optional[int] = None
+                 ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Read the columns cidx in bounded blocks
+
+    Parameters
+    ----------
+    cidx: np.ndarray
+      Increasing column positions.
+    ridx: np.ndarray, optional
+      Row (gene) positions to keep. Default=None (all the genes)
+    chunk_size: int, optional
+      Number of profiles per block.
+    memory_budget: int, optional
+      Maximum number of bytes of one block read from the file. It is
+      used to derive chunk_size when chunk_size is not given.
+
+    Yields
+    ------
+    (np.ndarray, np.ndarray)
+      The positions of the block and its (profiles x genes) float32 matrix.
+    """
+    chunk_size = chunk_size_for(len(self.row_ids), chunk_size, memory_budget)
+    for start in range(0, len(cidx), chunk_size):
+      block_idx = cidx[start:start + chunk_size]
+      yield block_idx, self.read(block_idx, ridx)
+
+  def read_parallel(self,
+                    cidx: np.ndarray,
+                    ridx: Optional[np.ndarray] = None,
+                    n_jobs: Optional[int] = None,
+                    chunk_size: Optional[int] = None,
+                    memory_budget: Optional[int] = None) -> np.ndarray:
+    """Read the columns cidx with several processes
+
+    cidx is split into consecutive shards, every worker process reads
+    shards through its own HDF5 handle, and the shards are written into
+    the output in order, so the result is the same as read(cidx, ridx)
+    whatever the number of workers.
+
+    Parameters
+    ----------
+    cidx: np.ndarray
+      Increasing column positions.
+    ridx: np.ndarray, optional
+      Row (gene) positions to keep. Default=None (all the genes)
+    n_jobs: int, optional
+      Number of worker processes (-1: one per CPU). Default=None (1)
+    chunk_size: int, optional
+      Maximum number of profiles per shard.
+    memory_budget: int, optional
+      Maximum number of bytes of one shard read from the file.
+
+    Returns
+    -------
+    np.ndarray
+      float32 matrix of shape (len(cidx), len(ridx)), one row per profile.
+    """
+    n_jobs = effective_n_jobs(n_jobs)
+    cidx = np.asarray(cidx, dtype=np.int64)
+    n_genes = len(self.row_ids) if ridx is None else len(ridx)
+    if n_jobs == 1 or len(cidx) == 0:
+      return self.read(cidx, ridx)
+
+    shard = chunk_size_for(len(self.row_ids), chunk_size, memory_budget)
+    # At least one shard per worker
+    shard = max(1, min(shard, -(-len(cidx) // n_jobs)))
+    starts = range(0, len(cidx), shard)
+
+    out = np.empty((len(cidx), n_genes), dtype=np.float32)
+    with ProcessPoolExecutor(max_workers=n_jobs,
+                             initializer=_open_worker,
+                             initargs=(self.dataset_dir,)) as executor:
+      blocks = executor.map(_read_shard,
+                            [(cidx[start:start + shard], ridx)
+                             for start in starts])
+      for start, block in zip(starts, blocks):
+        out[start:start + len(block)] = block
+    return out
+
+  def close(self) -> None:
+    self._file.close()
+
+  def __enter__(self) -> 'GctxReader':
+    return self
+
+  def __exit__(self, *args) -> None:
+    self.close()
+
+
+# GctxReader of a worker process of GctxReader.read_parallel
+_worker_reader = None
+
+
+def _open_worker(dataset_dir: str) -> None:
+  global _worker_reader
+  _worker_reader = GctxReader(dataset_dir)
+
+
+def _read_shard(args: Tuple[np.ndarray, Optional[np.ndarray]]) -> np.ndarray:
+  cidx, ridx = args
+  return _worker_reader.read(cidx, ridx)
+
+
+def chunk_size_for(n_genes: int,
+                   chunk_size: Optional[int] = None,
+                   memory_budget: Optional[int] = None) -> int:
+  """Number of profiles per block
+
+  A block holds up to 3 float32 copies of its profiles (HDF5 read, row
+  subset, caller's copy), which the memory budget accounts for.
+  """
+  if chunk_size is not None:
+    assert isinstance(chunk_size, int) and chunk_size > 0, \
+        "chunk_size must be a positive integer"
+    return chunk_size
+  if memory_budget is not None:
+    assert memory_budget > 0, "memory_budget must be positive"
+    return max(1, int(memory_budget // (3 * 4 * max(n_genes, 1))))
+  return 10000
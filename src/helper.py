@@ -1,11 +1,125 @@
+from __future__ import unicode_literals, print_function, division
+from typing import Optional
+
+import re
+
+import numpy as np
 import pandas as pd
-from collections import Counter
+
+from .metadata import read_metadata
 
 __author__ = "Hosein Fooladi"
 __email__ = "fooladi.hosein@gmail.com"
 
+# "<number> <unit>" as in the pert_idose / pert_itime columns, e.g. '10 uM'
+_QUANTITY = re.compile(
+    r'^\s*(?P<value>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*(?P<unit>.*?)\s*$')
+
+# Factors to the canonical units: micromolar ('um') and hours ('h').
+# Units that are not listed (e.g. 'ng/ul', '%') are kept unchanged.
+DOSE_UNITS = {
+    'pm': 1e-6,
+    'nm': 1e-3,
+    'um': 1.0,
+    'µm': 1.0,  # micro sign
+    'μm': 1.0,  # greek mu
+    'mm': 1e3,
+    'm': 1e6,
+}
+TIME_UNITS = {
+    'm': 1 / 60,
+    'min': 1 / 60,
+    'h': 1.0,
+    'hr': 1.0,
+    'd': 24.0,
+}
+
+MISSING = '-666'
+
+
+def parse_quantity(values: pd.Series,
+                   units: Optional[dict] = None,
+                   canonical: Optional[str] = None) -> pd.DataFrame:
+  """Split '<number> <unit>' strings into a numeric and a unit column
+
+  Parameters
+  ----------
+  values: pd.Series
+    Strings like '10 uM' or '24 h'. '-666' (and missing values) give a
+    value of -666.0 and a unit of '-666', as in the LINCS metadata.
+  units: dict, optional
+    Conversion factors of the units (lower case) to the canonical unit.
+    Default=None (no conversion)
+  canonical: str, optional
+    Name of the canonical unit (required with units).
+
+  Returns
+  -------
+  pd.DataFrame
+    'value' (float64) and 'unit' (str) columns, with the index of values.
+  """
+  values = pd.Series(values)
+  strings = values.astype(object).where(values.notna(), MISSING).astype(str)
+  parts = strings.str.extract(_QUANTITY)
+
+  missing = (strings.str.strip() == MISSING) | parts['value'].isna()
+  value = pd.to_numeric(parts['value'], errors='coerce').astype(np.float64)
+  unit = parts['unit'].astype(object)
+  value[missing] = float(MISSING)
+  unit[missing] = MISSING
+
+  if units is not None:
+    assert canonical is not None, "canonical is required with units"
+    factor = unit.str.lower().map(units)
+    known = factor.notna() & ~missing
+    value[known] = value[known] * factor[known]
+    unit[known] = canonical
+  return pd.DataFrame({'value': value, 'unit': unit}, index=values.index)
+
+
+def dose_time_columns(frame: pd.DataFrame,
+                      normalize: bool = False) -> pd.DataFrame:
+  """pert_dose, pert_dose_unit, pert_time and pert_time_unit columns
+
+  They are derived from the pert_idose and pert_itime columns of the
+  GSE70138 metadata (e.g. '10 uM', '24 h'), the format GSE92742 uses.
+
+  Parameters
+  ----------
+  frame: pd.DataFrame
+    sig_info / inst_info with pert_idose and pert_itime columns.
+  normalize: bool, optional (default False)
+    Whether to convert the doses to micromolar (unit 'um') and the
+    times to hours (unit 'h') when their unit is known.
+
+  Returns
+  -------
+  pd.DataFrame
+    The four columns, with the index of frame.
+  """
+  dose = parse_quantity(frame['pert_idose'],
+                        DOSE_UNITS if normalize else None, 'um')
+  time = parse_quantity(frame['pert_itime'],
+                        TIME_UNITS if normalize else None, 'h')
+  return pd.DataFrame(
+      {
+          'pert_dose': dose['value'],
+          'pert_dose_unit': dose['unit'],
+          'pert_time': time['value'],
+          'pert_time_unit': time['unit']
+      },
+      index=frame.index)
+
+
+def augment_dose_time(frame: pd.DataFrame,
+                      normalize: bool = False) -> pd.DataFrame:
+  """frame with the dose_time_columns added (if it lacks them)"""
+  if 'pert_dose' in frame.columns or 'pert_idose' not in frame.columns:
+    return frame
+  return pd.concat([frame, dose_time_columns(frame, normalize)], axis=1)
+
 
-def sig_info_augment(sig_info_dir: str):
+def sig_info_augment(sig_info_dir: str, normalize: bool = False):
   """Unification between GSE70138 and GSE92742
 
     This function has been written for working with GSE70138.
@@ -18,6 +132,9 @@ def sig_info_augment(sig_info_dir: str):
     ----------
     sig_info_dir: str
       The directory of sig_info file. E.g., './Data/sig_info.txt'
+    normalize: bool, optional (default False)
+      Whether to convert the doses to micromolar ('um') and the times to
+      hours ('h'). See dose_time_columns.
 
     Returns
     -------
@@ -28,35 +145,15 @@ def sig_info_augment(sig_info_dir: str):
   assert isinstance(sig_info_dir,
                     str), "The dataset_dir must be a string object"
 
-  sig_info = pd.read_csv(sig_info_dir, sep='\t')
+  sig_info = read_metadata(sig_info_dir, kind='sig_info')
 
   print("Data Statistics\n")
   print("Number of available gene expression signature: {}".format(
       sig_info.shape[0]))
   print("Number of available columns: {}".format(sig_info.shape[1]))
 
-  dose = [
-      x.split() if x != '-666' else ['-666', '-666']
-      for x in sig_info.pert_idose
-  ]
-  time = [
-      x.split() if x != '-666' else ['-666', '-666']
-      for x in sig_info.pert_itime
-  ]
-
-  pert_dose = list(map(lambda x: float(x[0]), dose))
-  pert_dose_unit = list(map(lambda x: x[1], dose))
-  pert_time = list(map(lambda x: float(x[0]), time))
-  pert_time_unit = list(map(lambda x: x[1], time))
-
-  adding = pd.DataFrame({
-      'pert_dose': pert_dose,
-      'pert_dose_unit': pert_dose_unit,
-      'pert_time': pert_time,
-      'pert_time_unit': pert_time_unit
-  })
-
-  sig_info_v1 = pd.concat([sig_info, adding], axis=1)
+  sig_info_v1 = pd.concat([sig_info, dose_time_columns(sig_info, normalize)],
+                          axis=1)
   print("Number of available columns after augmentation: {}".format(
       sig_info_v1.shape[1]))
 
@@ -0,0 +1,164 @@
+"""
+Inverted index over the metadata of a LincsDataset.
+
+For every field the index keeps, per category, the sorted row ids of the
+profiles having that value (a CSR layout: one `order` array and one
+`offsets` array per field). Multi-valued fields (clinical phase, MOA and
+target, stored as 'a|b|c' strings) are additionally exploded into
+token -> categories tables, so a lookup by a single MOA does not have to
+split strings again.
+"""
+from __future__ import unicode_literals, print_function, division
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+__author__ = "Hosein Fooladi"
+__email__ = "fooladi.hosein@gmail.com"
+
+# Fields whose values are '|'-delimited lists of tokens.
+MULTI_VALUED_FIELDS = ('clinical_phase', 'moa', 'target')
+
+
+def split_tokens(value: Any, sep: str = '|') -> List[str]:
+  """Tokens of a multi-valued field ('a|b' or ['a|b'])"""
+  if isinstance(value, (list, tuple, np.ndarray)):
+    if len(value) == 0:
+      return []
+    value = value[0]
+  if not isinstance(value, str):
+    return []
+  return value.split(sep)
+
+
+class MetadataIndex(object):
+  """Value -> sorted row ids mapping for every metadata field
+
+  Parameters
+  ----------
+  n_rows: int
+    Number of profiles in the indexed dataset.
+  postings: Dict[str, Tuple[np.ndarray, np.ndarray]]
+    (order, offsets) of every field. The rows having category code c are
+    order[offsets[c]:offsets[c + 1]], in increasing order.
+  tokens: Dict[str, Dict[str, np.ndarray]]
+    For multi-valued fields, token -> category codes containing that token.
+  """
+
+  def __init__(self, n_rows: int, postings: Dict, tokens: Dict):
+    self.n_rows = n_rows
+    self.postings = postings
+    self.tokens = tokens
+    self._lookup = {}  # type: Dict[str, Dict]
+
+  @classmethod
+  def build(cls, dataset) -> 'MetadataIndex':
+    """Build the index of a LincsDataset (one stable argsort per field)"""
+    postings = {}
+    tokens = {}
+    for field in dataset.fields:
+      codes = dataset.codes[field]
+      n_categories = len(dataset.categories[field])
+      order = np.argsort(codes, kind='stable')
+      counts = np.bincount(codes, minlength=n_categories)
+      offsets = np.zeros(n_categories + 1, dtype=np.int64)
+      np.cumsum(counts, out=offsets[1:])
+      postings[field] = (order, offsets)
+
+      if field in MULTI_VALUED_FIELDS:
+        table = {}  # type: Dict[str, List[int]]
+        for code, value in enumerate(dataset.categories[field]):
+          for token in set(split_tokens(value)):
+            table.setdefault(token, []).append(code)
+        tokens[field] = {
+            token: np.asarray(codes_, dtype=np.int64)
+            for token, codes_ in table.items()
+        }
+    return cls(len(dataset), postings, tokens)
+
+  def counts(self, field: str) -> np.ndarray:
+    """Number of profiles of every category of field"""
+    return np.diff(self.postings[field][1])
+
+  def rows(self, field: str, codes: Sequence[int]) -> np.ndarray:
+    """Sorted row ids of the profiles whose field has one of the codes"""
+    order, offsets = self.postings[field]
+    codes = np.asarray(codes, dtype=np.int64)
+    if len(codes) == 0:
+      return np.zeros(0, dtype=np.int64)
+    if len(codes) == 1:
+      return order[offsets[codes[0]]:offsets[codes[0] + 1]].astype(np.int64)
+    parts = [order[offsets[c]:offsets[c + 1]] for c in codes]
+    return np.sort(np.concatenate(parts)).astype(np.int64, copy=False)
+
+  def token_rows(self, field: str, tokens: Iterable[str]) -> np.ndarray:
+    """Sorted row ids of the profiles having any of tokens in field"""
+    assert field in self.tokens, "{} is not a multi-valued field".format(field)
+    table = self.tokens[field]
+    codes = [table[token] for token in set(tokens) if token in table]
+    if not codes:
+      return np.zeros(0, dtype=np.int64)
+    return self.rows(field, np.unique(np.concatenate(codes)))
+
+  def get(self, dataset, field: str, value: Any) -> np.ndarray:
+    """Sorted row ids where field == value (or contains token value)"""
+    if field in self.tokens:
+      return self.token_rows(field, [value])
+    if field not in self._lookup:
+      lookup = {}
+      for code, category in enumerate(dataset.categories[field]):
+        try:
+          lookup.setdefault(category, code)
+        except TypeError:
+          pass
+      self._lookup[field] = lookup
+    code = self._lookup[field].get(value)
+    if code is None:
+      return np.zeros(0, dtype=np.int64)
+    return self.rows(field, [code])
+
+  def save(self, path: str) -> None:
+    """Store the index in a .npz file (next to the dataset)"""
+    arrays = {'n_rows': np.asarray(self.n_rows)}
+    for field, (order, offsets) in self.postings.items():
+      arrays['order/' + field] = order
+      arrays['offsets/' + field] = offsets
+    for field, table in self.tokens.items():
+      names = sorted(table)
+      sizes = [len(table[name]) for name in names]
+      arrays['tokens/' + field] = np.asarray(names, dtype=str)
+      arrays['token_offsets/' + field] = np.concatenate(
+          [[0], np.cumsum(sizes)]).astype(np.int64)
+      arrays['token_codes/' + field] = np.concatenate(
+          [table[name] for name in names] + [np.zeros(0, dtype=np.int64)])
+    with open(path, 'wb') as f:
+      np.savez(f, **arrays)
+
+  @classmethod
+  def load(cls, path: str) -> 'MetadataIndex':
+    """Read an index written by save"""
+    postings = {}
+    tokens = {}
+    with np.load(path, allow_pickle=False) as arrays:
+      n_rows = int(arrays['n_rows'])
+      for key in arrays.files:
+        kind, _, field = key.partition('/')
+        if kind == 'order':
+          postings[field] = (arrays[key], arrays['offsets/' + field])
+        elif kind == 'tokens':
+          names = arrays[key]
+          offsets = arrays['token_offsets/' + field]
+          codes = arrays['token_codes/' + field]
+          tokens[field] = {
+              str(name): codes[offsets[i]:offsets[i + 1]]
+              for i, name in enumerate(names)
+          }
+    return cls(n_rows, postings, tokens)
+
+  def check(self, dataset) -> None:
+    """Assert that the index was built for dataset"""
+    assert self.n_rows == len(dataset), "The index does not match the dataset"
+    for field in dataset.fields:
+      assert field in self.postings, "{} is not indexed".format(field)
+      assert len(self.postings[field][1]) == len(dataset.categories[field]) + 1, \
+          "The index does not match the categories of {}".format(field)
@@ -0,0 +1,353 @@
+"""
+Stage instrumentation.
+
+The parsers, loaders and filters run their steps inside stage() blocks,
+e.g. 'read_metadata', 'read_gctx' and 'assemble' within
+'parsing_level3_cp'. When instrumentation is enabled, every stage emits a
+StageEvent with its wall time, the number of rows (profiles) it processed
+and the peak memory (RSS) of the process while it ran. Events go to the
+registered hooks (callables) and, optionally, to a JSON log with one
+event per line.
+
+Instrumentation is disabled, and silent, by default. Enable it with
+configure(), or with the environment variables LINCS_INSTRUMENT=1 (print
+the events to stderr) and LINCS_INSTRUMENT_LOG=<path> (JSON log).
+
+Example:
+  >>> from src import instrument
+  >>> events = []
+  >>> instrument.configure(hook=events.append)
+  >>> data = parsing_level3_cp(...)
+  >>> [(e.path, e.wall_s) for e in events]
+  [('parsing_level3_cp/read_metadata', 3.1), ('parsing_level3_cp/read_gctx', 41.0), ...]
+"""
+from __future__ import unicode_literals, print_function, division
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+  import resource
+except ImportError:  # Windows
+  resource = None
+
+__author__ = "Hosein Fooladi"
+__email__ = "fooladi.hosein@gmail.com"
+
+
+def _status_mb(key: str) -> Optional[float]:
+  """A memory figure of /proc/self/status (e.g. VmRSS), in MB"""
+  try:
+    with open('/proc/self/status') as f:
+      for line in f:
+        if line.startswith(key + ':'):
+          return int(line.split()[1]) / 1024
+  except (OSError, ValueError, IndexError):
+    pass
+  return None
+
+
+def rss_mb() -> Optional[float]:
+  """Current resident memory of the process in MB (None if unknown)"""
+  return _status_mb('VmRSS')
+
+
+def peak_rss_mb() -> Optional[float]:
+  """Peak resident memory of the process in MB since the last reset"""
+  peak = _status_mb('VmHWM')
+  if peak is None and resource is not None:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    peak = peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+  return peak
+
+
+def reset_peak_rss() -> bool:
+  """Reset the peak resident memory to the current one (Linux only)"""
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')
+    return True
+  except OSError:
+    return False
+
+
+class StageEvent(object):
+  """Measurements of one run of a stage
+
+  Attributes
+  ----------
+  name: str
+    Name of the stage, e.g. 'read_gctx'.
+  path: str
+    Names of the enclosing stages and of the stage, e.g.
+    'parsing_level3_cp/read_gctx'.
+  start: float
+    Start time (seconds since the epoch).
+  wall_s: float
+    Wall time in seconds.
+  rows: int
+    Number of rows (profiles) processed, or None.
+  rss_mb: float
+    Resident memory at the start of the stage in MB, or None.
+  peak_rss_mb: float
+    Peak resident memory of the process during the stage in MB, or None.
+  info: Dict[str, Any]
+    Other values recorded by the stage.
+  error: str
+    Type of the exception that ended the stage, or None.
+  """
+
+  def __init__(self, name: str, path: str, start: float, wall_s: float,
+               rows: Optional[int], rss_mb: Optional[float],
+               peak_rss_mb: Optional[float], info: Dict[str, Any],
+               error: Optional[str]):
+    self.name = name
+    self.path = path
+    self.start = start
+    self.wall_s = wall_s
+    self.rows = rows
+    self.rss_mb = rss_mb
+    self.peak_rss_mb = peak_rss_mb
+    self.info = info
+    self.error = error
+
+  @property
+  def rows_per_s(self) -> Optional[float]:
+    if self.rows is None or self.wall_s <= 0:
+      return None
+    return self.rows / self.wall_s
+
+  def to_dict(self) -> Dict[str, Any]:
+    return {
+        'stage': self.path,
+        'start': self.start,
+        'wall_s': self.wall_s,
+        'rows': self.rows,
+        'rows_per_s': self.rows_per_s,
+        'rss_mb': self.rss_mb,
+        'peak_rss_mb': self.peak_rss_mb,
+        'info': self.info,
+        'error': self.error,
+    }
+
+  def __repr__(self) -> str:
+    text = '{}: {:.3f} s'.format(self.path, self.wall_s)
+    if self.rows is not None:
+      text += ', {} rows'.format(self.rows)
+      if self.rows_per_s is not None:
+        text += ' ({:.0f} rows/s)'.format(self.rows_per_s)
+    if self.peak_rss_mb is not None:
+      text += ', peak {:.0f} MB'.format(self.peak_rss_mb)
+    if self.error is not None:
+      text += ', failed ({})'.format(self.error)
+    return text
+
+
+class Stage(object):
+  """A running stage: set rows (and info) as they become known"""
+
+  def __init__(self, name: str, rows: Optional[int] = None, **info):
+    self.name = name
+    self.rows = rows
+    self.info = info
+    self.peak = None  # type: Optional[float]
+
+
+class _NullStage(object):
+  """Stage of a disabled instrumentation: records nothing"""
+
+  name = None
+
+  @property
+  def rows(self) -> None:
+    return None
+
+  @rows.setter
+  def rows(self, value) -> None:
+    pass
+
+  @property
+  def info(self) -> Dict:
+    return {}
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Instrumentation(object):
+  """Registry of the hooks and JSON log receiving the stage events"""
+
+  def __init__(self):
+    self.enabled = False
+    self.hooks = []  # type: List[Callable[[StageEvent], None]]
+    self.log_path = None  # type: Optional[str]
+    self._local = threading.local()
+
+  def _stack(self) -> List[Stage]:
+    if not hasattr(self._local, 'stack'):
+      self._local.stack = []
+    return self._local.stack
+
+  def emit(self, event: StageEvent) -> None:
+    for hook in list(self.hooks):
+      hook(event)
+    if self.log_path is not None:
+      with open(self.log_path, 'a') as f:
+        f.write(json.dumps(event.to_dict(), default=str) + '\n')
+
+  @contextlib.contextmanager
+  def stage(self, name: str, rows: Optional[int] = None,
+            **info) -> Iterator[Stage]:
+    if not self.enabled:
+      yield _NULL_STAGE
+      return
+
+    stack = self._stack()
+    # The peak memory is reset for this stage: record the peak reached so
+    # far by the enclosing stages first.
+    peak = peak_rss_mb()
+    for outer in stack:
+      outer.peak = peak if outer.peak is None else max(outer.peak, peak or 0)
+    reset_peak_rss()
+
+    current = Stage(name, rows, **info)
+    stack.append(current)
+    start, begin, rss = time.time(), time.perf_counter(), rss_mb()
+    error = None
+    try:
+      yield current
+    except BaseException as e:
+      error = type(e).__name__
+      raise
+    finally:
+      wall = time.perf_counter() - begin
+      stack.pop()
+      peak = peak_rss_mb()
+      if peak is not None and current.peak is not None:
+        peak = max(peak, current.peak)
+      if stack and peak is not None:
+        outer = stack[-1]
+        outer.peak = peak if outer.peak is None else max(outer.peak, peak)
+      path = '/'.join([s.name for s in stack] + [name])
+      self.emit(
+          StageEvent(name, path, start, wall, current.rows, rss, peak,
+                     current.info, error))
+
+
+instrumentation = Instrumentation()
+
+
+def configure(enabled: bool = True,
+              log_path: Optional[str] = None,
+              hook: Optional[Callable[[StageEvent], None]] = None) -> None:
+  """Enable (or disable) the instrumentation
+
+  Parameters
+  ----------
+  enabled: bool, optional (default True)
+    Whether stages emit events.
+  log_path: str, optional
+    JSON log (one event per line, appended to). Default=None (no log)
+  hook: Callable[[StageEvent], None], optional
+    A hook to add, e.g. print_event or a list's append method.
+  """
+  instrumentation.enabled = enabled
+  instrumentation.log_path = log_path
+  if hook is not None:
+    add_hook(hook)
+
+
+def add_hook(hook: Callable[[StageEvent], None]) -> None:
+  """Call hook with every stage event"""
+  if hook not in instrumentation.hooks:
+    instrumentation.hooks.append(hook)
+
+
+def remove_hook(hook: Callable[[StageEvent], None]) -> None:
+  if hook in instrumentation.hooks:
+    instrumentation.hooks.remove(hook)
+
+
+def print_event(event: StageEvent) -> None:
+  """Hook printing the events to stderr"""
+  print('[stage] {!r}'.format(event), file=sys.stderr)
+
+
+def stage(name: str, rows: Optional[int] = None, **info):
+  """Context manager running a stage
+
+  E.g.,
+    with stage('read_gctx') as s:
+      gctoo = parse(...)
+      s.rows = gctoo.data_df.shape[1]
+  """
+  return instrumentation.stage(name, rows, **info)
+
+
+def instrumented(name: Optional[str] = None) -> Callable:
+  """Decorator running a function as a stage (named after the function)
+
+  The number of rows of the stage is the length of the result, unless
+  the function sets it.
+  """
+
+  def decorator(function: Callable) -> Callable:
+    stage_name = name or function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      if not instrumentation.enabled:
+        return function(*args, **kwargs)
+      with stage(stage_name) as current:
+        result = function(*args, **kwargs)
+        if current.rows is None and hasattr(result, '__len__'):
+          current.rows = len(result)
+        return result
+
+    return wrapper
+
+  return decorator
+
+
+def iter_stages(iterable: Iterable,
+                name: str,
+                rows: Optional[Callable[[Any], int]] = None) -> Iterator:
+  """Items of iterable, the production of each one run as a stage
+
+  E.g., the blocks of a streaming reader, with rows=len. Items are
+  yielded outside of the stage, so that the work of the consumer is not
+  counted in it.
+  """
+  iterator = iter(iterable)
+  while True:
+    with stage(name) as current:
+      try:
+        item = next(iterator)
+      except StopIteration:
+        current.info['exhausted'] = True
+        return
+      if rows is not None:
+        current.rows = rows(item)
+    yield item
+
+
+def current_stage():
+  """The innermost running stage (a no-op stage if there is none)"""
+  if not instrumentation.enabled:
+    return _NULL_STAGE
+  stack = instrumentation._stack()
+  return stack[-1] if stack else _NULL_STAGE
+
+
+if os.environ.get('LINCS_INSTRUMENT_LOG') or \
+    os.environ.get('LINCS_INSTRUMENT', '0') not in ('', '0'):
+  configure(log_path=os.environ.get('LINCS_INSTRUMENT_LOG') or None,
+            hook=print_event if os.environ.get('LINCS_INSTRUMENT', '0') not in
+            ('', '0') else None)
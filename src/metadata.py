@@ -0,0 +1,238 @@
+"""
+Typed, cached loading of the LINCS metadata files.
+
+inst_info alone has 1.3M rows, and every parsing function used to read it
+with pd.read_csv and let pandas infer the type of every column again.
+read_metadata reads a file once with explicit dtypes (identifiers as
+strings, repetitive annotations such as cell_id or pert_type as
+categoricals) and stores the parsed table next to the source, in a hidden
+'.<name>.lincs.pkl' file keyed on the modification time and size of the
+source. Later loads, also in new processes, read the binary table back,
+and loads in the same process are served from memory (see cache.py).
+"""
+from __future__ import unicode_literals, print_function, division
+from typing import Dict, Optional, Sequence
+
+import os
+import pickle
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from .cache import dataset_cache, file_stamp
+
+__author__ = "Hosein Fooladi"
+__email__ = "fooladi.hosein@gmail.com"
+
+_SUFFIX = '.lincs.pkl'
+_VERSION = 1
+
+# Annotations shared by the instance and signature tables
+_ANNOTATIONS = {
+    'cell_id': 'category',
+    'pert_id': 'category',
+    'pert_iname': 'category',
+    'pert_type': 'category',
+    'pert_dose': 'float64',
+    'pert_dose_unit': 'category',
+    'pert_time_unit': 'category',
+    'pert_idose': 'category',
+    'pert_itime': 'category',
+}
+
+# kind: (words of the file name, read_csv options). Columns that are not
+# listed in the dtype of a kind are inferred.
+KINDS = {
+    'inst_info': (('inst_info',),
+                  dict(sep='\t',
+                       dtype=dict(_ANNOTATIONS,
+                                  inst_id=str,
+                                  rna_plate='category',
+                                  rna_well='category',
+                                  det_plate='category',
+                                  det_well='category'))),
+    'sig_info': (('sig_info', 'sig_metrics'),
+                 dict(sep='\t', dtype=dict(_ANNOTATIONS,
+                                           sig_id=str,
+                                           distil_id=str))),
+    'gene_info': (('gene_info',), dict(sep='\t', dtype=str)),
+    'pert_info': (('pert_info',),
+                  dict(sep='\t',
+                       dtype={
+                           'pert_id': str,
+                           'pert_iname': str,
+                           'pert_type': 'category',
+                           'canonical_smiles': str,
+                           'inchi_key': str,
+                       })),
+    'drug_info': (('repurposing_drugs', 'drug_info'),
+                  dict(sep='\t',
+                       skiprows=9,
+                       encoding='latin-1',
+                       dtype={
+                           'pert_iname': str,
+                           'clinical_phase': 'category',
+                       })),
+}  # type: Dict[str, tuple]
+
+
+def guess_kind(path: str) -> Optional[str]:
+  """Kind of a metadata file from its name (None if unknown)"""
+  name = os.path.basename(path).lower()
+  for kind, (words, _) in KINDS.items():
+    if any(word in name for word in words):
+      return kind
+  return None
+
+
+def cache_path(path: str) -> str:
+  """Path of the parsed table stored next to the metadata file"""
+  directory, name = os.path.split(os.path.abspath(path))
+  return os.path.join(directory, '.' + name + _SUFFIX)
+
+
+def _parse(path: str, kind: Optional[str],
+           usecols: Optional[Sequence[str]] = None) -> pd.DataFrame:
+  options = dict(KINDS[kind][1]) if kind is not None else dict(sep='\t')
+  if usecols is not None:
+    options['usecols'] = list(usecols)
+  return pd.read_csv(path, **options)
+
+
+def _load_binary(path: str, kind: Optional[str]) -> Optional[pd.DataFrame]:
+  try:
+    with open(cache_path(path), 'rb') as f:
+      entry = pickle.load(f)
+  except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+          ImportError):
+    return None
+  if not isinstance(entry, dict) or entry.get('version') != _VERSION or \
+      entry.get('kind') != kind or entry.get('stamp') != file_stamp(path):
+    return None
+  return entry['frame']
+
+
+def _store_binary(path: str, kind: Optional[str], frame: pd.DataFrame,
+                  stamp) -> None:
+  target = cache_path(path)
+  try:
+    # Written to a temporary file first: concurrent readers never see a
+    # partial table.
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.tmp')
+  except OSError:
+    return  # read-only directory: parse the source every time
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      pickle.dump(
+          {
+              'version': _VERSION,
+              'kind': kind,
+              'stamp': stamp,
+              'frame': frame
+          },
+          f,
+          protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, target)
+  except OSError:
+    if os.path.exists(tmp):
+      os.remove(tmp)
+
+
+def _load(path: str, kind: Optional[str]) -> pd.DataFrame:
+  frame = _load_binary(path, kind)
+  if frame is None:
+    stamp = file_stamp(path)
+    frame = _parse(path, kind)
+    _store_binary(path, kind, frame, stamp)
+  return frame
+
+
+def read_metadata(path: str,
+                  kind: Optional[str] = None,
+                  usecols: Optional[Sequence[str]] = None,
+                  cache: bool = True) -> pd.DataFrame:
+  """Read a LINCS metadata file (inst_info, sig_info, gene_info, ...)
+
+  Parameters
+  ----------
+  path: str
+    The metadata file. E.g., './Data/inst_info.txt'
+  kind: str, optional
+    One of KINDS ('inst_info', 'sig_info', 'gene_info', 'pert_info' or
+    'drug_info'). Default: guessed from the file name; files of an unknown
+    kind are read as tab separated with inferred dtypes.
+  usecols: Sequence[str], optional
+    Columns to return. Default=None (all of them). With the cache, the whole
+    table is parsed once and the columns are selected from it; without it,
+    only these columns are parsed.
+  cache: bool, optional (default True)
+    Whether to use the parsed table cached next to the file and in memory.
+    The cache is rebuilt whenever the file changes.
+
+  Returns
+  -------
+  pd.DataFrame
+    The table. It is a copy of the cached one, so it can be edited in place.
+  """
+  assert isinstance(path, str), "The path must be a string object"
+  if kind is None:
+    kind = guess_kind(path)
+  assert kind is None or kind in KINDS, \
+      "kind must be one of {}".format(list(KINDS))
+
+  if not cache:
+    return _parse(path, kind, usecols)
+
+  frame = dataset_cache.get(path,
+                            lambda path: _load(path, kind),
+                            kind='metadata:{}'.format(kind))
+  if usecols is not None:
+    frame = frame[list(usecols)]
+  return frame.copy(deep=True)
+
+
+def invalidate_metadata(path: str) -> None:
+  """Delete the cached table of a metadata file"""
+  dataset_cache.invalidate(path)
+  if os.path.exists(cache_path(path)):
+    os.remove(cache_path(path))
+
+
+# Gene subsets of gene_info: column flagging them, or None for every gene
+GENE_SUBSETS = {'landmark': 'is_lm', 'bing': 'is_bing', 'all': None}
+
+
+def gene_subset(gene_info_dir: str, subset: str = 'landmark') -> np.ndarray:
+  """Identifiers of a subset of the genes of gene_info
+
+  Both the GSE70138 (gene_id, is_lm, ...) and the GSE92742 (pr_gene_id,
+  pr_is_lm, pr_is_bing) column names are supported.
+
+  Parameters
+  ----------
+  gene_info_dir: str
+    The gene_info file. E.g., './Data/gene_info.txt'
+  subset: str, optional (default 'landmark')
+    'landmark' (978 measured genes), 'bing' (best inferred genes, which
+    include the landmarks) or 'all'.
+
+  Returns
+  -------
+  np.ndarray
+    The gene identifiers (str), in the order of gene_info.
+  """
+  assert subset in GENE_SUBSETS, \
+      "subset must be one of {}".format(list(GENE_SUBSETS))
+  gene_info = read_metadata(gene_info_dir, kind='gene_info')
+
+  def column(name: str) -> pd.Series:
+    for prefix in ('', 'pr_'):
+      if prefix + name in gene_info.columns:
+        return gene_info[prefix + name]
+    raise KeyError("gene_info has no {} column".format(name))
+
+  gene_ids = column('gene_id').to_numpy(dtype=str)
+  if GENE_SUBSETS[subset] is None:
+    return gene_ids
+  return gene_ids[(column(GENE_SUBSETS[subset]) == '1').to_numpy()]
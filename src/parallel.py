@@ -0,0 +1,24 @@
+"""
+Helpers shared by the functions that can use several processes.
+"""
+from __future__ import unicode_literals, print_function, division
+from typing import Optional
+
+import os
+
+__author__ = "Hosein Fooladi"
+__email__ = "fooladi.hosein@gmail.com"
+
+
+def effective_n_jobs(n_jobs: Optional[int] = None) -> int:
+  """Number of worker processes for an n_jobs argument
+
+  None or 1 means no parallelism, -1 all the CPUs, -2 all but one, etc.
+  """
+  if n_jobs is None:
+    return 1
+  assert isinstance(n_jobs, int) and n_jobs != 0, \
+      "n_jobs must be a non-zero integer"
+  if n_jobs < 0:
+    return max(1, (os.cpu_count() or 1) + 1 + n_jobs)
+  return n_jobs
@@ -1,21 +1,41 @@
 from __future__ import unicode_literals, print_function, division
 
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
 from collections import Counter
 from cmapPy.pandasGEXpress.parse import parse
 import cmapPy.pandasGEXpress.write_gctx as wg
-from typing import List, Tuple, Optional
+from typing import Dict, Iterator, List, Tuple, Optional, Sequence, Union
+
+from . import gctx
+from .dataset import FIELDS, LincsDataset
+from .gctx import GctxReader
+from .helper import augment_dose_time
+from .instrument import current_stage, instrumented, iter_stages, stage
+from .metadata import read_metadata
+from .parallel import effective_n_jobs
+from .partition import partition_path, write_manifest
+from .storage import save_dataset
 
 __author__ = "Hosein Fooladi"
 __email__ = "fooladi.hosein@gmail.com"
 
 
+@instrumented()
 def parsing_level3_cp(dataset_dir: str,
                       inst_info_dir: str,
                       gene_info_dir: str,
                       pert_type: str = "trt_cp",
-                      landmarks: bool = True) -> List[List]:
+                      landmarks: bool = True,
+                      as_dataset: bool = False,
+                      chunk_size: Optional[int] = None,
+                      memory_budget: Optional[int] = None,
+                      copy: bool = True,
+                      n_jobs: Optional[int] = None,
+                      fields: Optional[Sequence[str]] = None) -> Union[List[List], LincsDataset]:
   """Parsing the data to keep desired sig_ids
   
   This function takes the directory of dataset, perturbation type, and
@@ -42,6 +62,27 @@ def parsing_level3_cp(dataset_dir: str,
   landmarks: bool
     boolean which determines whether you want to just keep landmark genes
     after parsing or you want to keep all the genes. Default=True
+  as_dataset: bool (default=False)
+    If True, return a LincsDataset (float32 expression matrix and
+    categorical-coded metadata) instead of the list format.
+  chunk_size: int, optional
+    If given (or if memory_budget is given), the GCTX file is read in
+    blocks of chunk_size profiles (see iter_level3_cp) instead of with a
+    single cmapPy parse, which bounds the memory used while reading.
+  memory_budget: int, optional
+    Approximate number of bytes a block may use (instead of chunk_size).
+  copy: bool (default=True)
+    If False, the expression vectors (or the LincsDataset matrix) are
+    views into the matrix read from the GCTX file instead of a copy of it.
+  n_jobs: int, optional
+    Number of processes reading the GCTX file (-1: one per CPU). The
+    selected profiles are split into shards (of at most chunk_size
+    profiles, if given) read in parallel, and the output is the same
+    whatever the number of processes. Default=None (single process)
+  fields: Sequence[str], optional
+    inst_info columns kept as fields of the LincsDataset (as_dataset
+    only), e.g. FIELDS + ('rna_plate',) to normalize profiles per plate
+    (see aggregate.py). Default=FIELDS
 
   Returns
   ------
@@ -60,29 +101,252 @@ def parsing_level3_cp(dataset_dir: str,
 
   assert isinstance(pert_type, str), "pert_type must be a string object"
   assert isinstance(landmarks, bool), "landmarks must be a boolean object"
+  assert isinstance(as_dataset, bool), "as_dataset must be a boolean object"
+  assert fields is None or as_dataset, "fields needs as_dataset=True"
+
+  if effective_n_jobs(n_jobs) > 1:
+    return _parse_parallel(dataset_dir,
+                           inst_info_dir,
+                           gene_info_dir,
+                           pert_type=pert_type,
+                           landmarks=landmarks,
+                           as_dataset=as_dataset,
+                           chunk_size=chunk_size,
+                           memory_budget=memory_budget,
+                           n_jobs=n_jobs,
+                           fields=fields)
+
+  if chunk_size is not None or memory_budget is not None:
+    return _collect_chunks(
+        iter_level3_cp(dataset_dir,
+                       inst_info_dir,
+                       gene_info_dir,
+                       pert_type=pert_type,
+                       landmarks=landmarks,
+                       chunk_size=chunk_size,
+                       memory_budget=memory_budget,
+                       as_dataset=as_dataset,
+                       fields=fields), as_dataset)
+
+  query_trt, landmark_gene_row_ids = _level3_query(inst_info_dir,
+                                                   gene_info_dir, pert_type)
+  query_ids = query_trt.inst_id
 
-  gene_info = pd.read_csv(gene_info_dir, sep="\t", dtype=str)
-  print("Number of measured genes in the dataset: {}".format(
-      gene_info.shape[0]))
+  with stage('read_gctx', rows=len(query_ids)) as current:
+    if landmarks:
+      query_gctoo = parse(dataset_dir, rid=landmark_gene_row_ids, cid=query_ids)
+    else:
+      query_gctoo = parse(dataset_dir, cid=query_ids)
+    current.info['shape'] = query_gctoo.data_df.shape
+
+  with stage('assemble', rows=len(query_ids)):
+    query_trt = query_trt.set_index(query_trt.inst_id)
+    query_trt = query_trt.reindex(query_gctoo.data_df.columns)
+
+    return _assemble(query_trt,
+                     query_gctoo.data_df.to_numpy().T,
+                     query_gctoo.data_df.index,
+                     as_dataset,
+                     copy=copy,
+                     fields=fields)
+
+
+def iter_level3_cp(dataset_dir: str,
+                   inst_info_dir: str,
+                   gene_info_dir: str,
+                   pert_type: str = "trt_cp",
+                   landmarks: bool = True,
+                   chunk_size: Optional[int] = None,
+                   memory_budget: Optional[int] = None,
+                   as_dataset: bool = False,
+                   fields: Optional[Sequence[str]] = None
+                  ) -> Iterator[Union[List[List], LincsDataset]]:
+  """Streaming version of parsing_level3_cp
+
+  The GCTX matrix is read directly (without cmapPy) in blocks of
+  chunk_size profiles, and every block is yielded as soon as it is read,
+  so the memory footprint is bounded by one block instead of the whole
+  selection. Profiles come out in the same order as parsing_level3_cp.
 
-  landmark_gene_row_ids = gene_info["gene_id"][gene_info["is_lm"] == "1"]
-  print("Number of landmark genes in the dataset: {}".format(
-      landmark_gene_row_ids.shape[0]))
+  Parameters
+  ----------
+  dataset_dir: str
+    It must be string file that shows the directory of the dataset.
+    dataset should be a gctx file. e.g., valid argument is something like this:
+    './Data/Level3_INF_mlr12k_n1319138x12328.gctx'
+  param inst_info_dir: str
+    directory of inst_info. For example: './Data/inst_info.txt'
+  gene_info_dir: str
+    directory of gene_info. For example: './Data/gene_info.txt'
+  pert_type: str (default= "trt_cp")
+    String object that determine which perturbation type you want to parse.
+    Default='trt_cp'
+  landmarks: bool
+    boolean which determines whether you want to just keep landmark genes
+    after parsing or you want to keep all the genes. Default=True
+  chunk_size: int, optional
+    Number of profiles per block.
+  memory_budget: int, optional
+    Approximate number of bytes a block may use; it determines the
+    chunk_size when chunk_size is not given. Default block: 10000 profiles.
+  as_dataset: bool (default=False)
+    Whether the blocks are LincsDataset objects or lists in the
+    parsing_level3_cp format.
+  fields: Sequence[str], optional
+    inst_info columns kept as fields of the LincsDataset blocks (as_dataset
+    only). Default=FIELDS
+
+  Yields
+  ------
+  Union[List, LincsDataset]
+    Consecutive blocks of the parsed profiles.
+  """
+
+  assert isinstance(pert_type, str), "pert_type must be a string object"
+  assert isinstance(landmarks, bool), "landmarks must be a boolean object"
+  assert isinstance(as_dataset, bool), "as_dataset must be a boolean object"
+  assert fields is None or as_dataset, "fields needs as_dataset=True"
+
+  query_trt, landmark_gene_row_ids = _level3_query(inst_info_dir,
+                                                   gene_info_dir, pert_type)
+
+  with GctxReader(dataset_dir) as reader:
+    ridx = np.sort(reader.row_index(landmark_gene_row_ids)) \
+        if landmarks else None
+    gene_ids = reader.row_ids if ridx is None else reader.row_ids[ridx]
+    cidx = np.sort(reader.col_index(query_trt.inst_id))
+    query_trt = query_trt.set_index(query_trt.inst_id)
+
+    chunks = reader.iter_chunks(cidx,
+                                ridx,
+                                chunk_size=chunk_size,
+                                memory_budget=memory_budget)
+    for block_idx, block in iter_stages(chunks, 'read_gctx',
+                                        rows=lambda chunk: len(chunk[0])):
+      with stage('assemble', rows=len(block_idx)):
+        meta = query_trt.reindex(reader.col_ids[block_idx])
+        chunk = _assemble(meta, block, gene_ids, as_dataset, copy=False,
+                          fields=fields)
+      yield chunk
+
+
+def _parse_parallel(dataset_dir: str,
+                    inst_info_dir: str,
+                    gene_info_dir: str,
+                    pert_type: str,
+                    landmarks: bool,
+                    as_dataset: bool,
+                    chunk_size: Optional[int],
+                    memory_budget: Optional[int],
+                    n_jobs: int,
+                    fields: Optional[Sequence[str]] = None) -> Union[List[List], LincsDataset]:
+  """parsing_level3_cp with the GCTX file read by n_jobs processes"""
+
+  query_trt, landmark_gene_row_ids = _level3_query(inst_info_dir,
+                                                   gene_info_dir, pert_type)
+
+  with GctxReader(dataset_dir) as reader:
+    ridx = np.sort(reader.row_index(landmark_gene_row_ids)) \
+        if landmarks else None
+    gene_ids = reader.row_ids if ridx is None else reader.row_ids[ridx]
+    cidx = np.sort(reader.col_index(query_trt.inst_id))
+    with stage('read_gctx', rows=len(cidx), n_jobs=n_jobs) as current:
+      block = reader.read_parallel(cidx,
+                                   ridx,
+                                   n_jobs=n_jobs,
+                                   chunk_size=chunk_size,
+                                   memory_budget=memory_budget)
+      current.info['shape'] = block.T.shape
+    col_ids = reader.col_ids[cidx]
+
+  with stage('assemble', rows=len(cidx)):
+    query_trt = query_trt.set_index(query_trt.inst_id).reindex(col_ids)
+    # block is a new contiguous float32 matrix: no need to copy it again
+    return _assemble(query_trt, block, gene_ids, as_dataset, copy=False,
+                     fields=fields)
+
+
+def _assemble(query_trt: pd.DataFrame,
+              block: np.ndarray,
+              gene_ids: np.ndarray,
+              as_dataset: bool,
+              copy: bool = True,
+              float_dose: bool = False,
+              fields: Optional[Sequence[str]] = None) -> Union[List[List], LincsDataset]:
+  """Parse output (list or LincsDataset) of a block of profiles
+
+  The metadata columns are extracted once each, and the expression matrix
+  is converted with a single bulk copy (or none at all if copy=False, in
+  which case the profiles are views into block).
+
+  Parameters
+  ----------
+  query_trt: pd.DataFrame
+    inst_info / sig_info rows, in the same order as the rows of block.
+  block: np.ndarray
+    (profiles x genes) expression matrix.
+  gene_ids: np.ndarray
+    Identifiers of the columns of block.
+  as_dataset: bool
+    Whether to return a LincsDataset or the list format.
+  copy: bool (default=True)
+    Whether to copy block into a new contiguous float32 matrix.
+  float_dose: bool (default=False)
+    Whether the doses are converted to float (level 5 format).
+  fields: Sequence[str], optional
+    Columns of query_trt kept as fields of the LincsDataset. Default=FIELDS
+  """
+  if copy:
+    block = np.array(block, dtype=np.float32, order='C')
+  if float_dose:
+    query_trt = query_trt.assign(pert_dose=query_trt.pert_dose.astype(float))
+
+  if as_dataset:
+    return LincsDataset.from_frame(query_trt, block, columns=fields,
+                                   gene_ids=gene_ids)
+
+  columns = [query_trt[field].to_numpy() for field in FIELDS]
+  if float_dose:
+    columns[3] = query_trt.pert_dose.tolist()
+  return [[meta, vector] for meta, vector in zip(zip(*columns), block)]
+
+
+def _collect_chunks(chunks: Iterator,
+                    as_dataset: bool) -> Union[List[List], LincsDataset]:
+  """Concatenate the blocks yielded by a streaming parser"""
+  if not as_dataset:
+    parse_list = []
+    for chunk in chunks:
+      parse_list.extend(chunk)
+    return parse_list
+
+  return LincsDataset.concat(list(chunks))
+
+
+def _level3_query(inst_info_dir: str, gene_info_dir: str,
+                  pert_type: str) -> Tuple[pd.DataFrame, pd.Series]:
+  """Select the inst_info rows and landmark genes parsed at level 3"""
+
+  with stage('read_metadata') as current:
+    gene_info = read_metadata(gene_info_dir, kind='gene_info')
+    # GSE70138 metadata only has pert_idose / pert_itime ('10 uM', '24 h'):
+    # units are normalized to the 'um' / 'h' of GSE92742
+    inst_info = augment_dose_time(
+        read_metadata(inst_info_dir, kind='inst_info'), normalize=True)
+    current.rows = inst_info.shape[0]
+    current.info['n_genes'] = gene_info.shape[0]
+    current.info['pert_types'] = list(inst_info.pert_type.unique())
 
-  inst_info = pd.read_csv(inst_info_dir, sep="\t")
-  print("Number of availbale gene expression profiles: {}".format(
-      inst_info.shape[0]))
-  print("Unique perturbation types: {}".format(inst_info.pert_type.unique()))
+  landmark_gene_row_ids = gene_info["gene_id"][gene_info["is_lm"] == "1"]
 
   assert pert_type in inst_info.pert_type.unique(), "pert_type is not valid!!"
 
   query_trt = inst_info[inst_info["pert_type"] == pert_type]
-  print("Number of availbale gene expression profiles of {}: {}".format(
-      pert_type, query_trt.shape[0]))
 
-  print((query_trt == '-666').sum())
-  print("Number of different pert_dose_units: {}".format(
-      Counter(query_trt.pert_dose_unit)))
+  current = current_stage()
+  current.info['n_landmarks'] = landmark_gene_row_ids.shape[0]
+  current.info['n_' + pert_type] = query_trt.shape[0]
+  current.info['pert_dose_units'] = dict(Counter(query_trt.pert_dose_unit))
 
   ## It needs to be better. I am supposed to modify this part!
   if pert_type == 'trt_cp':
@@ -91,41 +355,20 @@ def parsing_level3_cp(dataset_dir: str,
   else:
     pass
 
-  query_ids = query_trt.inst_id
-  print("Number of samples at the end: {}".format(query_ids.shape[0]))
-
-  print("=================================================================")
-  print("Please wait while we are parsing the data ...")
-
-  if landmarks:
-    query_gctoo = parse(dataset_dir, rid=landmark_gene_row_ids, cid=query_ids)
-  else:
-    query_gctoo = parse(dataset_dir, cid=query_ids)
-
-  print("Parse Completed")
-  print("Size of the data after parsing: {}".format(query_gctoo.data_df.shape))
-
-  query_trt = query_trt.set_index(query_trt.inst_id)
-  query_trt = query_trt.reindex(query_gctoo.data_df.columns)
+  current.info['n_selected'] = query_trt.shape[0]
 
-  parse_list = []
-  for i in range(query_trt.shape[0]):
-    parse_list.append([
-        (query_trt.cell_id[i], query_trt.pert_id[i], query_trt.pert_type[i],
-         query_trt.pert_dose[i], query_trt.pert_dose_unit[i],
-         query_trt.pert_time[i], query_trt.pert_time_unit[i]),
-        np.array(query_gctoo.data_df.iloc[:, i])
-    ])
-
-  return parse_list
+  return query_trt, landmark_gene_row_ids
 
 
+@instrumented()
 def parsing_level5_cp(dataset_dir: str,
                       sig_info_dir: str,
                       gene_info_dir: str,
                       pert_type: str = 'trt_cp',
                       landmarks: bool = True,
-                      cell_line: Optional[str] = None) -> List[List]:
+                      cell_line: Optional[Union[str, Sequence[str]]] = None,
+                      as_dataset: bool = False,
+                      copy: bool = True) -> Union[List[List], LincsDataset]:
   """Parsing the data to keep desired sig_ids
   
   This function takes the directory of dataset, perturbation type, and
@@ -152,9 +395,17 @@ def parsing_level5_cp(dataset_dir: str,
   landmarks: bool (default=True)
     boolean which determines whether you want to just keep landmark genes
     after parsing or you want to keep all the genes. Default=True
-  cell_line: str (default=None)
-    Whether you want to select a particular cell_line and parse data just
-    for that cell line or not. Default=None Which means parse information of all the cell lines.
+  cell_line: Union[str, Sequence[str]] (default=None)
+    Whether you want to select a particular cell_line (or a list of cell
+    lines) and parse data just for them or not. Default=None Which means
+    parse information of all the cell lines. See parsing_level5_partitioned
+    to parse many cell lines into separate partitions.
+  as_dataset: bool (default=False)
+    If True, return a LincsDataset (float32 expression matrix and
+    categorical-coded metadata) instead of the list format.
+  copy: bool (default=True)
+    If False, the expression vectors (or the LincsDataset matrix) are
+    views into the matrix read from the GCTX file instead of a copy of it.
 
   Returns
   -------
@@ -173,29 +424,176 @@ def parsing_level5_cp(dataset_dir: str,
 
   assert isinstance(pert_type, str), "pert_type must be a string object"
   assert isinstance(landmarks, bool), "landmarks must be a boolean object"
+  assert isinstance(as_dataset, bool), "as_dataset must be a boolean object"
 
-  gene_info = pd.read_csv(gene_info_dir, sep="\t", dtype=str)
-  print("Number of measured genes in the dataset: {}".format(
-      gene_info.shape[0]))
+  query_trt, landmark_gene_row_ids = _level5_query(sig_info_dir,
+                                                   gene_info_dir, pert_type)
 
-  landmark_gene_row_ids = gene_info["gene_id"][gene_info["is_lm"] == "1"]
-  print("Number of landmark genes in the dataset: {}".format(
-      landmark_gene_row_ids.shape[0]))
+  if cell_line is not None:
+    cell_lines = [cell_line] if isinstance(cell_line, str) else list(cell_line)
+    query_trt = query_trt[query_trt["cell_id"].isin(cell_lines)]
+
+  query_ids = query_trt.sig_id
+
+  with stage('read_gctx', rows=len(query_ids)) as current:
+    if landmarks:
+      query_gctoo = parse(dataset_dir, rid=landmark_gene_row_ids, cid=query_ids)
+    else:
+      query_gctoo = parse(dataset_dir, cid=query_ids)
+    current.info['shape'] = query_gctoo.data_df.shape
+
+  with stage('assemble', rows=len(query_ids)):
+    query_trt = query_trt.set_index(query_trt.sig_id)
+    query_trt = query_trt.reindex(query_gctoo.data_df.columns)
+
+    return _assemble(query_trt,
+                     query_gctoo.data_df.to_numpy().T,
+                     query_gctoo.data_df.index,
+                     as_dataset,
+                     copy=copy,
+                     float_dose=True)
+
+
+@instrumented()
+def parsing_level5_partitioned(dataset_dir: str,
+                               sig_info_dir: str,
+                               gene_info_dir: str,
+                               output_dir: str,
+                               pert_type: str = 'trt_cp',
+                               landmarks: bool = True,
+                               cell_lines: Optional[Sequence[str]] = None,
+                               n_jobs: Optional[int] = None,
+                               compression=None) -> Dict[str, int]:
+  """Parse many cell lines at once, one partition per cell line
+
+  The metadata is read once, then every cell line is read from the GCTX
+  file, converted and written to its own partition of a partitioned
+  dataset (see partition.py) by a pool of worker processes, each with its
+  own HDF5 handle. Every partition holds the same profiles as
+  parsing_level5_cp(..., cell_line=cell, as_dataset=True).
+
+  Parameters
+  ----------
+  dataset_dir: str
+    The level 5 gctx file. e.g., './Data/GSE70138_Broad_LINCS_Level5.gctx'
+  sig_info_dir: str
+    directory of sig_info. For example: './Data/sig_info.txt'
+  gene_info_dir: str
+    directory of gene_info. For example: './Data/gene_info.txt'
+  output_dir: str
+    Directory of the partitioned dataset. e.g., './Data/level5_trt_cp'
+  pert_type: str (default="trt_cp")
+    The perturbation type to parse.
+  landmarks: bool (default=True)
+    Whether to only keep the landmark genes.
+  cell_lines: Sequence[str], optional
+    Cell lines to parse. Default=None (all of them)
+  n_jobs: int, optional
+    Number of worker processes (-1: one per CPU). Default=None (1)
+  compression: Union[Compression, str], optional
+    Compression of the expression matrices (see storage.save_dataset).
+
+  Returns
+  -------
+  Dict[str, int]
+    Number of profiles of every cell line.
+  """
 
-  sig_info = pd.read_csv(sig_info_dir, sep="\t")
-  print("Number of availbale gene expression profiles: {}".format(
-      sig_info.shape[0]))
-  print("Unique perturbation types: {}".format(sig_info.pert_type.unique()))
+  assert isinstance(pert_type, str), "pert_type must be a string object"
+  assert isinstance(landmarks, bool), "landmarks must be a boolean object"
+  assert isinstance(output_dir, str), "The output_dir must be a string object"
+
+  query_trt, landmark_gene_row_ids = _level5_query(sig_info_dir,
+                                                   gene_info_dir, pert_type)
+  if cell_lines is not None:
+    missing = set(cell_lines) - set(query_trt["cell_id"])
+    assert not missing, "Unknown cell lines: {}".format(sorted(missing))
+    query_trt = query_trt[query_trt["cell_id"].isin(list(cell_lines))]
+
+  with GctxReader(dataset_dir) as reader:
+    ridx = np.sort(reader.row_index(landmark_gene_row_ids)) \
+        if landmarks else None
+    gene_ids = reader.row_ids if ridx is None else reader.row_ids[ridx]
+    positions = reader.col_index(query_trt.sig_id)
+    col_ids = reader.col_ids
+
+  tasks = {}
+  groups = query_trt.groupby("cell_id", observed=True, sort=True).indices
+  for cell, rows in groups.items():
+    cidx = np.sort(positions[rows])
+    meta = query_trt.iloc[rows]
+    meta = meta.set_index(meta.sig_id).reindex(col_ids[cidx])
+    path = partition_path(["cell_id"], [cell])
+    tasks[cell] = (meta, cidx, ridx, gene_ids,
+                   os.path.join(output_dir, path), compression)
+
+  # Largest cell lines first, so that the workers finish together
+  order = sorted(tasks, key=lambda cell: -len(tasks[cell][1]))
+  n_jobs = min(effective_n_jobs(n_jobs), max(len(tasks), 1))
+  if n_jobs == 1:
+    with GctxReader(dataset_dir) as reader:
+      counts = [_parse_partition(reader, *tasks[cell]) for cell in order]
+  else:
+    with ProcessPoolExecutor(max_workers=n_jobs,
+                             initializer=gctx._open_worker,
+                             initargs=(dataset_dir,)) as executor:
+      counts = list(executor.map(_write_partition,
+                                 [tasks[cell] for cell in order]))
+  n_profiles = dict(zip(order, counts))
+
+  write_manifest(output_dir, ["cell_id"], [{
+      'values': [cell],
+      'path': partition_path(["cell_id"], [cell]),
+      'n_profiles': n_profiles[cell]
+  } for cell in sorted(tasks)],
+                 dataset_fields=FIELDS)
+
+  current_stage().rows = sum(n_profiles.values())
+  current_stage().info['partitions'] = len(n_profiles)
+  return {cell: n_profiles[cell] for cell in sorted(n_profiles)}
+
+
+def _parse_partition(reader: GctxReader, meta: pd.DataFrame, cidx: np.ndarray,
+                     ridx: Optional[np.ndarray], gene_ids: np.ndarray,
+                     path: str, compression) -> int:
+  """Read, assemble and save the profiles of one partition"""
+  with stage('write_partition', rows=len(cidx), path=path):
+    block = reader.read(cidx, ridx)
+    dataset = _assemble(meta, block, gene_ids, True, copy=False,
+                        float_dose=True)
+    save_dataset(path, dataset, compression=compression)
+  return len(dataset)
+
+
+def _write_partition(task: Tuple) -> int:
+  """_parse_partition in a worker process (see gctx._open_worker)"""
+  return _parse_partition(gctx._worker_reader, *task)
+
+
+def _level5_query(sig_info_dir: str, gene_info_dir: str,
+                  pert_type: str) -> Tuple[pd.DataFrame, pd.Series]:
+  """Select the sig_info rows and landmark genes parsed at level 5"""
+
+  with stage('read_metadata') as current:
+    gene_info = read_metadata(gene_info_dir, kind='gene_info')
+    # GSE70138 metadata only has pert_idose / pert_itime ('10 uM', '24 h'):
+    # units are normalized to the 'um' / 'h' of GSE92742
+    sig_info = augment_dose_time(
+        read_metadata(sig_info_dir, kind='sig_info'), normalize=True)
+    current.rows = sig_info.shape[0]
+    current.info['n_genes'] = gene_info.shape[0]
+    current.info['pert_types'] = list(sig_info.pert_type.unique())
+
+  landmark_gene_row_ids = gene_info["gene_id"][gene_info["is_lm"] == "1"]
 
   assert pert_type in sig_info.pert_type.unique(), "pert_type is not valid!!"
 
   query_trt = sig_info[sig_info["pert_type"] == pert_type]
-  print("Number of availbale gene expression profiles of {}: {}".format(
-      pert_type, query_trt.shape[0]))
 
-  print((query_trt == '-666').sum())
-  print("Number of different pert_dose_units: {}".format(
-      Counter(query_trt.pert_dose_unit)))
+  current = current_stage()
+  current.info['n_landmarks'] = landmark_gene_row_ids.shape[0]
+  current.info['n_' + pert_type] = query_trt.shape[0]
+  current.info['pert_dose_units'] = dict(Counter(query_trt.pert_dose_unit))
 
   ## It needs to be better. I am supposed to modify this part!
   if pert_type == 'trt_cp':
@@ -204,35 +602,6 @@ def parsing_level5_cp(dataset_dir: str,
   else:
     pass
 
-  if cell_line is not None:
-    query_trt = query_trt[sig_info["cell_id"] == cell_line]
-  else:
-    pass
-
-  query_ids = query_trt.sig_id
-  print("Number of samples at the end: {}".format(query_ids.shape[0]))
-
-  print("=================================================================")
-  print("Please wait while we are parsing the data ...")
-
-  if landmarks:
-    query_gctoo = parse(dataset_dir, rid=landmark_gene_row_ids, cid=query_ids)
-  else:
-    query_gctoo = parse(dataset_dir, cid=query_ids)
-
-  print("Parse Completed")
-  print("Size of the data after parsing: {}".format(query_gctoo.data_df.shape))
-
-  query_trt = query_trt.set_index(query_trt.sig_id)
-  query_trt = query_trt.reindex(query_gctoo.data_df.columns)
-
-  parse_list = []
-  for i in range(query_trt.shape[0]):
-    parse_list.append([
-        (query_trt.cell_id[i], query_trt.pert_id[i], query_trt.pert_type[i],
-         float(query_trt.pert_dose[i]), query_trt.pert_dose_unit[i],
-         query_trt.pert_time[i], query_trt.pert_time_unit[i]),
-        np.array(query_gctoo.data_df.iloc[:, i])
-    ])
+  current.info['n_selected'] = query_trt.shape[0]
 
-  return parse_list
+  return query_trt, landmark_gene_row_ids
@@ -0,0 +1,279 @@
+"""
+Partitioned datasets.
+
+A partitioned dataset is a directory holding one on-disk dataset (see
+storage.py) per value of its partition fields, e.g. one per cell line and
+time, and a manifest:
+  partitions.json                 partition fields and, for every
+                                  partition, its values, directory and
+                                  number of profiles
+  cell_id=MCF7/pert_time=24/      on-disk dataset of the MCF7, 24 h profiles
+  cell_id=MCF7/pert_time=6/       ...
+
+Every partition is a complete dataset, so it can be written by its own
+worker process and opened (memory-mapped) and processed on its own by
+parallel consumers. Readers given a predicate on the partition fields
+only open the partitions that can match it (partition pruning): a query
+on one cell line reads the bytes of that cell line only.
+"""
+from __future__ import unicode_literals, print_function, division
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple, Union
+
+import json
+import os
+from urllib.parse import quote
+
+import numpy as np
+
+from .dataset import LincsDataset
+from .query import And, FieldPredicate, Not, Or, Predicate, group_indices
+from .storage import open_dataset, read_header, save_dataset
+
+__author__ = "Hosein Fooladi"
+__email__ = "fooladi.hosein@gmail.com"
+
+FORMAT_NAME = 'lincs-partitioned'
+FORMAT_VERSION = 1
+MANIFEST_FILE = 'partitions.json'
+
+
+def is_partitioned(dataset_dir: str) -> bool:
+  """Whether dataset_dir is a partitioned dataset"""
+  return os.path.isfile(os.path.join(dataset_dir, MANIFEST_FILE))
+
+
+def _scalar(value: Any) -> Any:
+  """JSON-serializable version of a numpy scalar"""
+  return value.item() if hasattr(value, 'item') else value
+
+
+def partition_path(fields: Sequence[str], values: Sequence) -> str:
+  """Directory (relative) of a partition, e.g. 'cell_id=MCF7'"""
+  return os.path.join(*[
+      '{}={}'.format(field, quote(str(_scalar(value)), safe=''))
+      for field, value in zip(fields, values)
+  ])
+
+
+def write_manifest(dataset_dir: str,
+                   fields: Sequence[str],
+                   partitions: List[Dict],
+                   dataset_fields: Optional[Sequence[str]] = None) -> None:
+  """Write the manifest of a partitioned dataset
+
+  Parameters
+  ----------
+  dataset_dir: str
+    Directory of the partitioned dataset.
+  fields: Sequence[str]
+    Partition fields, e.g. ['cell_id'].
+  partitions: List[Dict]
+    One dict per partition with its 'values' (one per field), 'path'
+    (relative to dataset_dir) and 'n_profiles'.
+  dataset_fields: Sequence[str], optional
+    Metadata fields of the partitions (see dataset_fields).
+  """
+  manifest = {
+      'format': FORMAT_NAME,
+      'version': FORMAT_VERSION,
+      'fields': list(fields),
+      'dataset_fields': None if dataset_fields is None else list(dataset_fields),
+      'n_profiles': int(sum(p['n_profiles'] for p in partitions)),
+      'partitions': [{
+          'values': [_scalar(value) for value in p['values']],
+          'path': p['path'],
+          'n_profiles': int(p['n_profiles'])
+      } for p in partitions],
+  }
+  os.makedirs(dataset_dir, exist_ok=True)
+  with open(os.path.join(dataset_dir, MANIFEST_FILE), 'w') as f:
+    json.dump(manifest, f, indent=2)
+
+
+def read_manifest(dataset_dir: str) -> Dict:
+  """The manifest of a partitioned dataset"""
+  with open(os.path.join(dataset_dir, MANIFEST_FILE)) as f:
+    manifest = json.load(f)
+  assert manifest.get('format') == FORMAT_NAME, \
+      "{} is not a partitioned LINCS dataset".format(dataset_dir)
+  assert manifest.get('version', 0) <= FORMAT_VERSION, \
+      "Unsupported partitioned dataset version: {}".format(
+          manifest.get('version'))
+  return manifest
+
+
+def open_partition(dataset_dir: str, *values, **kwargs) -> LincsDataset:
+  """Open the partition with the given values of the partition fields
+
+  E.g., open_partition('./Data/level5_trt_cp', 'MCF7'). Keyword arguments
+  are passed to storage.open_dataset.
+  """
+  manifest = read_manifest(dataset_dir)
+  for partition in manifest['partitions']:
+    if list(partition['values']) == [_scalar(value) for value in values]:
+      return open_dataset(os.path.join(dataset_dir, partition['path']),
+                          **kwargs)
+  raise KeyError("No partition {} in {}".format(values, dataset_dir))
+
+
+def dataset_fields(dataset_dir: str) -> Tuple[str, ...]:
+  """Metadata fields of the partitions of a partitioned dataset"""
+  manifest = read_manifest(dataset_dir)
+  if manifest.get('dataset_fields') is not None:
+    return tuple(manifest['dataset_fields'])
+  assert manifest['partitions'], "{} has no partition".format(dataset_dir)
+  return tuple(
+      read_header(os.path.join(dataset_dir,
+                               manifest['partitions'][0]['path']))['fields'])
+
+
+def save_partitioned(dataset_dir: str,
+                     data: Union[LincsDataset, List],
+                     by: Sequence[str] = ('cell_id', 'pert_time'),
+                     index: bool = True,
+                     compression=None) -> Dict[Tuple, int]:
+  """Write a dataset as one on-disk dataset per value of the fields by
+
+  Parameters
+  ----------
+  dataset_dir: str
+    Directory of the partitioned dataset.
+    e.g., './Data/level3_trt_cp_landmark_partitioned'
+  data: Union[LincsDataset, List]
+    The dataset (a legacy list is converted with LincsDataset.from_list).
+    It can be memory-mapped: partitions are written one at a time.
+  by: Sequence[str], optional (default ('cell_id', 'pert_time'))
+    Partition fields.
+  index: bool, optional (default True)
+    Whether to store the metadata index of every partition.
+  compression: Union[Compression, str], optional
+    Compression of the expression matrices (see storage.save_dataset).
+
+  Returns
+  -------
+  Dict[Tuple, int]
+    Number of profiles of every partition (keyed by its values).
+  """
+  if isinstance(data, list):
+    data = LincsDataset.from_list(data)
+  assert isinstance(data, LincsDataset), "data must be a LincsDataset or a list"
+  by = list(by)
+
+  groups = group_indices(data, by)
+  partitions = []
+  for key, rows in groups.items():
+    values = list(key) if len(by) > 1 else [key]
+    path = partition_path(by, values)
+    save_dataset(os.path.join(dataset_dir, path),
+                 data.subset(rows),
+                 index=index,
+                 compression=compression)
+    partitions.append({'values': values, 'path': path, 'n_profiles': len(rows)})
+
+  partitions.sort(key=lambda p: p['path'])
+  # The manifest is written last: its presence marks a complete dataset.
+  write_manifest(dataset_dir, by, partitions, dataset_fields=data.fields)
+  return {tuple(p['values']): p['n_profiles'] for p in partitions}
+
+
+def _predicate_fields(predicate: Predicate) -> Optional[Set[str]]:
+  """Fields a predicate depends on (None if unknown)"""
+  if isinstance(predicate, FieldPredicate):
+    return {predicate.field}
+  if isinstance(predicate, (And, Or)):
+    fields = set()
+    for child in predicate.predicates:
+      child_fields = _predicate_fields(child)
+      if child_fields is None:
+        return None
+      fields |= child_fields
+    return fields
+  if isinstance(predicate, Not):
+    return _predicate_fields(predicate.predicate)
+  return None
+
+
+def _may_match(predicate: Predicate, table: LincsDataset) -> np.ndarray:
+  """Partitions (rows of table) that may hold profiles matching predicate
+
+  Predicates on the partition fields only are decided exactly; for the
+  others, every partition may match.
+  """
+  fields = _predicate_fields(predicate)
+  if fields is not None and fields <= set(table.fields):
+    return predicate.mask(table)
+  if isinstance(predicate, And):
+    result = np.ones(len(table), dtype=bool)
+    for child in predicate.predicates:
+      result &= _may_match(child, table)
+    return result
+  if isinstance(predicate, Or):
+    result = np.zeros(len(table), dtype=bool)
+    for child in predicate.predicates:
+      result |= _may_match(child, table)
+    return result
+  return np.ones(len(table), dtype=bool)
+
+
+def prune(dataset_dir: str, predicate: Optional[Predicate] = None) -> List[Dict]:
+  """Partitions of the manifest that may hold profiles matching predicate"""
+  manifest = read_manifest(dataset_dir)
+  partitions = manifest['partitions']
+  if predicate is None or not partitions:
+    return partitions
+  # One row per partition, with the values of the partition fields
+  table = LincsDataset.from_list(
+      [[tuple(p['values']), None] for p in partitions],
+      fields=manifest['fields'],
+      expression=False)
+  keep = _may_match(predicate, table)
+  return [p for p, k in zip(partitions, keep) if k]
+
+
+def open_partitioned(dataset_dir: str,
+                     predicate: Optional[Predicate] = None,
+                     mmap: bool = True,
+                     index: bool = True) -> LincsDataset:
+  """The partitions of a partitioned dataset, as one LincsDataset
+
+  Profiles come partition by partition, in the order of the manifest.
+
+  Parameters
+  ----------
+  dataset_dir: str
+    Directory of the partitioned dataset.
+  predicate: Predicate, optional
+    Only the partitions that may hold profiles matching predicate are
+    read (e.g. isin('cell_id', ['MCF7']) reads the MCF7 partitions only).
+    The profiles of these partitions are not filtered. Default=None (every
+    partition)
+  mmap: bool, optional (default True)
+    Whether the partitions are memory-mapped. A single partition is
+    returned as it is; several partitions are concatenated in memory.
+  index: bool, optional (default True)
+    Whether to attach a metadata index.
+
+  Returns
+  -------
+  LincsDataset
+  """
+  manifest = read_manifest(dataset_dir)
+  assert manifest['partitions'], "{} has no partition".format(dataset_dir)
+  partitions = prune(dataset_dir, predicate)
+  if not partitions:
+    # No partition can match: an empty dataset with the same fields / genes
+    first = manifest['partitions'][0]
+    return open_dataset(os.path.join(dataset_dir, first['path']),
+                        index=False).subset(slice(0, 0))
+  if len(partitions) == 1:
+    return open_dataset(os.path.join(dataset_dir, partitions[0]['path']),
+                        mmap=mmap,
+                        index=index)
+  parts = [
+      open_dataset(os.path.join(dataset_dir, p['path']), mmap=mmap, index=False)
+      for p in partitions
+  ]
+  dataset = LincsDataset.concat(parts)
+  if index:
+    dataset.build_index()
+  return dataset
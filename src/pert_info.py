@@ -1,7 +1,8 @@
 from typing import List, Dict, Tuple
-import pandas as pd
 from collections import Counter
 
+from .metadata import read_metadata
+
 __author__ = "Hosein Fooladi"
 __email__ = "fooladi.hosein@gmail.com"
 
@@ -26,7 +27,7 @@ def print_pert_statistics(pert_info_dir: str,
                     str), "The dataset_dir must be a string object"
   assert isinstance(pert_type, str), "The pert_type must be a string object"
 
-  pert_info = pd.read_csv(pert_info_dir, sep='\t')
+  pert_info = read_metadata(pert_info_dir, kind='pert_info')
 
   assert pert_type in pert_info.pert_type.unique(
   ), "pert_type should be in the list of available perturbations"
@@ -79,7 +80,7 @@ def pert_touchstone(pert_info_dir: str,
                     str), "The dataset_dir must be a string object"
   assert isinstance(pert_type, str), "The pert_type must be a string object"
 
-  pert_info = pd.read_csv(pert_info_dir, sep='\t')
+  pert_info = read_metadata(pert_info_dir, kind='pert_info')
 
   assert pert_type in pert_info.pert_type.unique(
   ), "pert_type should be in the list of available perturbations"
@@ -116,7 +117,7 @@ def duplicate_pert_name(pert_info_dir: str) -> List[str]:
   assert isinstance(pert_info_dir,
                     str), "The dataset_dir must be a string object"
 
-  pert_info = pd.read_csv(pert_info_dir, sep='\t')
+  pert_info = read_metadata(pert_info_dir, kind='pert_info')
 
   duplicate_list = [
       name for name, count in Counter(pert_info.pert_iname).items() if count > 1
@@ -146,7 +147,7 @@ def mapping_id_iname(pert_info_dir: str) -> Dict:
   assert isinstance(pert_info_dir,
                     str), "The dataset_dir must be a string object"
 
-  pert_info = pd.read_csv(pert_info_dir, sep='\t')
+  pert_info = read_metadata(pert_info_dir, kind='pert_info')
 
   mapping = dict(zip(pert_info.pert_id.values, pert_info.pert_iname.values))
 
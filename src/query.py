@@ -0,0 +1,378 @@
+"""
+Vectorized filtering of LincsDataset objects.
+
+A predicate is first evaluated once per category of a metadata field
+(a handful of cell lines, a few thousand compounds, ...) and the result is
+then broadcast to every profile through the integer category codes, so the
+cost per profile is a single array lookup. Predicates compose with
+& (AND), | (OR) and ~ (NOT), and select() returns the matching row indices
+instead of copying rows. When the dataset carries a metadata index
+(LincsDataset.build_index), predicates are answered by intersecting the
+posting lists of the index rather than by scanning the codes.
+"""
+from __future__ import unicode_literals, print_function, division
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from .dataset import LincsDataset
+from .index import split_tokens
+
+__author__ = "Hosein Fooladi"
+__email__ = "fooladi.hosein@gmail.com"
+
+
+class Predicate(object):
+  """Base class of all the filters"""
+
+  def mask(self, dataset: LincsDataset) -> np.ndarray:
+    """Boolean array with one entry per profile of dataset"""
+    raise NotImplementedError
+
+  def indices(self, dataset: LincsDataset) -> np.ndarray:
+    """Sorted row indices of the profiles that satisfy the predicate
+
+    If the metadata index of dataset has been built, the rows are
+    obtained from the index instead of scanning the codes.
+    """
+    if dataset.metadata_index is not None:
+      return self.lookup(dataset)
+    return np.flatnonzero(self.mask(dataset))
+
+  def lookup(self, dataset: LincsDataset) -> np.ndarray:
+    """Sorted row indices obtained from the metadata index of dataset"""
+    return np.flatnonzero(self.mask(dataset))
+
+  def key(self) -> str:
+    """Canonical text of the predicate (see query_cache.py)
+
+    Equivalent predicates written differently (values in another order,
+    operands of & and | swapped) have the same key.
+    """
+    raise NotImplementedError
+
+  def __and__(self, other: 'Predicate') -> 'Predicate':
+    return And(self, other)
+
+  def __or__(self, other: 'Predicate') -> 'Predicate':
+    return Or(self, other)
+
+  def __invert__(self) -> 'Predicate':
+    return Not(self)
+
+
+class FieldPredicate(Predicate):
+  """Predicate that only depends on the value of one metadata field"""
+
+  def __init__(self, field: str):
+    self.field = field
+
+  def test(self, value: Any) -> bool:
+    """Whether a single (decoded) value satisfies the predicate"""
+    raise NotImplementedError
+
+  def category_mask(self, dataset: LincsDataset) -> np.ndarray:
+    """Boolean array with one entry per category of the field"""
+    categories = dataset.categories[self.field]
+    return np.fromiter((self.test(x) for x in categories),
+                       dtype=bool,
+                       count=len(categories))
+
+  def mask(self, dataset: LincsDataset) -> np.ndarray:
+    assert self.field in dataset.fields, \
+        "{} is not a field of the dataset".format(self.field)
+    return self.category_mask(dataset)[dataset.codes[self.field]]
+
+  def lookup(self, dataset: LincsDataset) -> np.ndarray:
+    assert self.field in dataset.fields, \
+        "{} is not a field of the dataset".format(self.field)
+    codes = np.flatnonzero(self.category_mask(dataset))
+    return dataset.metadata_index.rows(self.field, codes)
+
+
+class Isin(FieldPredicate):
+  """The field value is one of values (same semantics as `x in values`)"""
+
+  def __init__(self, field: str, values: Iterable):
+    super(Isin, self).__init__(field)
+    self.values = list(values)
+    try:
+      self._lookup = set(self.values)
+    except TypeError:
+      self._lookup = self.values
+
+  def test(self, value: Any) -> bool:
+    try:
+      return value in self._lookup
+    except TypeError:
+      return value in self.values
+
+  def key(self) -> str:
+    return 'isin({!r}, {})'.format(self.field, _values_key(self.values))
+
+
+class Between(FieldPredicate):
+  """The field value lies between low and high
+
+  Parameters
+  ----------
+  field: str
+    Name of a numeric metadata field (e.g. pert_dose or pert_time).
+  low, high: optional
+    Bounds of the range. None means unbounded.
+  inclusive: bool (default False)
+    Whether the bounds themselves are accepted.
+
+  Values that cannot be compared with the bounds (e.g. '-666') never match.
+  """
+
+  def __init__(self,
+               field: str,
+               low: Optional[float] = None,
+               high: Optional[float] = None,
+               inclusive: bool = False):
+    super(Between, self).__init__(field)
+    self.low = low
+    self.high = high
+    self.inclusive = inclusive
+
+  def test(self, value: Any) -> bool:
+    try:
+      if self.inclusive:
+        return bool((self.low is None or value >= self.low) and
+                    (self.high is None or value <= self.high))
+      return bool((self.low is None or value > self.low) and
+                  (self.high is None or value < self.high))
+    except TypeError:
+      return False
+
+  def key(self) -> str:
+    return 'between({!r}, {}, {}, {!r})'.format(self.field,
+                                              _values_key([self.low]),
+                                              _values_key([self.high]),
+                                              bool(self.inclusive))
+
+
+class HasAny(FieldPredicate):
+  """At least one token of a `sep`-delimited multi-valued field is in values
+
+  This is used for the clinical phase, MOA and target fields, which are
+  stored as 'a|b|c' strings (possibly wrapped in a one-element sequence).
+  """
+
+  def __init__(self, field: str, values: Iterable, sep: str = '|'):
+    super(HasAny, self).__init__(field)
+    self.values = set(values)
+    self.sep = sep
+
+  def test(self, value: Any) -> bool:
+    return any(token in self.values for token in split_tokens(value, self.sep))
+
+  def lookup(self, dataset: LincsDataset) -> np.ndarray:
+    index = dataset.metadata_index
+    if self.sep != '|' or self.field not in index.tokens:
+      return super(HasAny, self).lookup(dataset)
+    return index.token_rows(self.field, self.values)
+
+  def key(self) -> str:
+    return 'has_any({!r}, {}, {!r})'.format(self.field,
+                                            _values_key(self.values), self.sep)
+
+
+class And(Predicate):
+  """All the predicates are satisfied"""
+
+  def __init__(self, *predicates: Predicate):
+    self.predicates = predicates
+
+  def mask(self, dataset: LincsDataset) -> np.ndarray:
+    result = np.ones(len(dataset), dtype=bool)
+    for predicate in self.predicates:
+      result &= predicate.mask(dataset)
+    return result
+
+  def lookup(self, dataset: LincsDataset) -> np.ndarray:
+    result = None
+    for predicate in self.predicates:
+      rows = predicate.indices(dataset)
+      result = rows if result is None else np.intersect1d(
+          result, rows, assume_unique=True)
+    if result is None:
+      return np.arange(len(dataset))
+    return result
+
+  def key(self) -> str:
+    keys = sorted(set(predicate.key() for predicate in self.predicates))
+    return keys[0] if len(keys) == 1 else 'and({})'.format(', '.join(keys))
+
+
+class Or(Predicate):
+  """At least one of the predicates is satisfied"""
+
+  def __init__(self, *predicates: Predicate):
+    self.predicates = predicates
+
+  def mask(self, dataset: LincsDataset) -> np.ndarray:
+    result = np.zeros(len(dataset), dtype=bool)
+    for predicate in self.predicates:
+      result |= predicate.mask(dataset)
+    return result
+
+  def lookup(self, dataset: LincsDataset) -> np.ndarray:
+    result = np.zeros(0, dtype=np.int64)
+    for predicate in self.predicates:
+      result = np.union1d(result, predicate.indices(dataset))
+    return result
+
+  def key(self) -> str:
+    keys = sorted(set(predicate.key() for predicate in self.predicates))
+    return keys[0] if len(keys) == 1 else 'or({})'.format(', '.join(keys))
+
+
+class Not(Predicate):
+  """The predicate is not satisfied"""
+
+  def __init__(self, predicate: Predicate):
+    self.predicate = predicate
+
+  def mask(self, dataset: LincsDataset) -> np.ndarray:
+    return ~self.predicate.mask(dataset)
+
+  def lookup(self, dataset: LincsDataset) -> np.ndarray:
+    return np.setdiff1d(np.arange(len(dataset)),
+                        self.predicate.indices(dataset),
+                        assume_unique=True)
+
+  def key(self) -> str:
+    return 'not({})'.format(self.predicate.key())
+
+
+def _values_key(values: Iterable) -> str:
+  """Sorted, deduplicated text of a collection of values"""
+  keys = sorted(set('{}:{!r}'.format(type(value).__name__, value)
+                    for value in values))
+  return '[{}]'.format(', '.join(keys))
+
+
+def isin(field: str, values: Iterable) -> Isin:
+  return Isin(field, values)
+
+
+def between(field: str,
+            low: Optional[float] = None,
+            high: Optional[float] = None,
+            inclusive: bool = False) -> Between:
+  return Between(field, low, high, inclusive)
+
+
+def has_any(field: str, values: Iterable, sep: str = '|') -> HasAny:
+  return HasAny(field, values, sep)
+
+
+def select(dataset: LincsDataset, predicate: Predicate) -> np.ndarray:
+  """Row indices of dataset that satisfy predicate
+
+  Parameters
+  ----------
+  dataset: LincsDataset
+    The dataset to filter (it can be metadata-only).
+  predicate: Predicate
+    E.g., isin('cell_id', ['MCF7', 'A375']) & between('pert_dose', 0, 5)
+
+  Returns
+  -------
+  np.ndarray
+    Sorted int64 array of the matching row indices.
+  """
+  assert isinstance(dataset, LincsDataset), "dataset must be a LincsDataset"
+  assert isinstance(predicate, Predicate), "predicate must be a Predicate"
+  return predicate.indices(dataset)
+
+
+def group_bounds(dataset: LincsDataset, fields: Sequence[str]
+                ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[np.ndarray]]:
+  """Rows of the dataset sorted by group, and the bounds of every group
+
+  Parameters
+  ----------
+  dataset: LincsDataset
+    The dataset to partition (it can be metadata-only).
+  fields: Sequence[str]
+    The fields defining the groups, e.g. ['cell_id', 'pert_id'].
+
+  Returns
+  -------
+  order: np.ndarray
+    int64 row indices, grouped (and sorted within every group).
+  starts, ends: np.ndarray
+    Every group is order[starts[g]:ends[g]]. Groups are ordered by
+    category codes.
+  field_codes: List[np.ndarray]
+    Category code of every group, one array per field.
+  """
+  assert isinstance(dataset, LincsDataset), "dataset must be a LincsDataset"
+  fields = list(fields)
+  assert len(fields) > 0, "At least one field is needed"
+  for field in fields:
+    assert field in dataset.fields, "{} is not a field of the dataset".format(
+        field)
+
+  index = dataset.metadata_index
+  if len(fields) == 1 and index is not None:
+    order, offsets = index.postings[fields[0]]
+    group_codes = np.flatnonzero(np.diff(offsets))
+    return (np.asarray(order, dtype=np.int64), offsets[group_codes],
+            offsets[group_codes + 1], [group_codes])
+
+  sizes = [max(len(dataset.categories[field]), 1) for field in fields]
+  assert np.prod([float(size) for size in sizes]) < 2**62, \
+      "Too many combinations of values to group by"
+  combined = np.ravel_multi_index(
+      [np.asarray(dataset.codes[field], dtype=np.int64) for field in fields],
+      sizes)
+  order = np.argsort(combined, kind='stable')
+  combined = combined[order]
+  starts = np.flatnonzero(np.r_[True, combined[1:] != combined[:-1]])
+  ends = np.r_[starts[1:], len(combined)]
+  return order, starts, ends, list(np.unravel_index(combined[starts], sizes))
+
+
+def group_indices(dataset: LincsDataset,
+                  fields: Union[str, Sequence[str]],
+                  keys: Optional[Iterable] = None) -> Dict[Any, np.ndarray]:
+  """Row indices of every distinct value of one or several fields
+
+  The dataset is partitioned in a single pass over the category codes
+  (one stable sort of the combined codes), instead of one scan per value.
+
+  Parameters
+  ----------
+  dataset: LincsDataset
+    The dataset to partition (it can be metadata-only).
+  fields: Union[str, Sequence[str]]
+    A field, e.g. 'pert_id', or several, e.g. ['cell_id', 'pert_id'].
+    The values of the fields must be hashable.
+  keys: Iterable, optional
+    Only return the groups of these keys. Default=None (every group)
+
+  Returns
+  -------
+  Dict[Any, np.ndarray]
+    Mapping from the value (a tuple of values if several fields are given)
+    to the sorted int64 row indices having it. Groups are ordered by
+    category code, i.e. by first appearance in the dataset.
+  """
+  single = isinstance(fields, str)
+  fields = [fields] if single else list(fields)
+  order, starts, ends, field_codes = group_bounds(dataset, fields)
+
+  values = [dataset.categories[field][codes]
+            for field, codes in zip(fields, field_codes)]
+  group_keys = values[0] if single else list(zip(*values))
+  if keys is not None:
+    keys = set(keys)
+  groups = {}
+  for key, start, end in zip(group_keys, starts, ends):
+    if keys is None or key in keys:
+      groups[key] = order[start:end]
+  return groups
@@ -0,0 +1,165 @@
+"""
+On-disk cache of filter results.
+
+Pipelines often run the same selection (e.g. cells MCF7 and A375 at 24 h)
+many times against an unchanged dataset. QueryCache stores the selected row
+indices in a directory, under a name derived from the fingerprint of the
+dataset metadata (LincsDataset.fingerprint) and the canonical key of the
+predicate (Predicate.key), so a repeated selection is read back instead of
+being recomputed. Any change of the metadata changes the fingerprint, hence
+stale results are never returned. The least recently used entries are
+deleted once the directory exceeds a size limit.
+
+The cache is disabled until a directory is given, either with the
+LINCS_QUERY_CACHE_DIR environment variable or with configure().
+"""
+from __future__ import unicode_literals, print_function, division
+from typing import Optional
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+from .dataset import LincsDataset
+from .query import Predicate, select
+
+__author__ = "Hosein Fooladi"
+__email__ = "fooladi.hosein@gmail.com"
+
+_SUFFIX = '.npy'
+
+
+class QueryCache(object):
+  """Directory of cached filter results
+
+  Parameters
+  ----------
+  directory: str, optional
+    Directory of the cache (created if needed). None disables the cache.
+  max_bytes: int, optional
+    Size limit of the cache. Default: the LINCS_QUERY_CACHE_MAX_BYTES
+    environment variable, or 1 GiB.
+  """
+
+  def __init__(self,
+               directory: Optional[str] = None,
+               max_bytes: Optional[int] = None):
+    if max_bytes is None:
+      max_bytes = int(os.environ.get('LINCS_QUERY_CACHE_MAX_BYTES', 1024**3))
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+
+  @property
+  def enabled(self) -> bool:
+    return self.directory is not None and self.max_bytes > 0
+
+  def _path(self, fingerprint: str, key: str) -> str:
+    name = hashlib.sha256('{}\n{}'.format(fingerprint,
+                                          key).encode('utf-8')).hexdigest()
+    return os.path.join(self.directory, name + _SUFFIX)
+
+  def get(self, fingerprint: str, key: str) -> Optional[np.ndarray]:
+    """Cached row indices, or None"""
+    if not self.enabled:
+      return None
+    path = self._path(fingerprint, key)
+    try:
+      indices = np.load(path).astype(np.int64)
+    except (OSError, ValueError):
+      self.misses += 1
+      return None
+    try:
+      # The modification time records the last use (LRU eviction)
+      os.utime(path)
+    except OSError:
+      pass
+    self.hits += 1
+    return indices
+
+  def put(self, fingerprint: str, key: str, indices: np.ndarray) -> None:
+    """Store the row indices of a selection"""
+    if not self.enabled:
+      return
+    os.makedirs(self.directory, exist_ok=True)
+    indices = np.asarray(indices)
+    dtype = np.int32 if len(indices) == 0 or indices.max() < 2**31 \
+        else np.int64
+    # Written to a temporary file first: concurrent readers never see a
+    # partial entry.
+    fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        np.save(f, indices.astype(dtype, copy=False))
+      os.replace(tmp, self._path(fingerprint, key))
+    except OSError:
+      if os.path.exists(tmp):
+        os.remove(tmp)
+      return
+    self._evict()
+
+  def _evict(self) -> None:
+    entries = []
+    for name in os.listdir(self.directory):
+      if name.endswith(_SUFFIX):
+        try:
+          stat = os.stat(os.path.join(self.directory, name))
+        except OSError:
+          continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(entry[1] for entry in entries)
+    for _, size, name in sorted(entries):
+      if total <= self.max_bytes:
+        break
+      try:
+        os.remove(os.path.join(self.directory, name))
+      except OSError:
+        pass
+      total -= size
+
+  def clear(self) -> None:
+    """Delete every cached result"""
+    if self.directory is None or not os.path.isdir(self.directory):
+      return
+    for name in os.listdir(self.directory):
+      if name.endswith(_SUFFIX):
+        os.remove(os.path.join(self.directory, name))
+
+
+# Cache used by utils.parse_list, utils.parse_list_v2 and filtering.py
+query_cache = QueryCache(os.environ.get('LINCS_QUERY_CACHE_DIR'))
+
+
+def configure(directory: Optional[str], max_bytes: Optional[int] = None) -> None:
+  """Set the directory (None disables the cache) and size limit of the cache"""
+  query_cache.directory = directory
+  if max_bytes is not None:
+    query_cache.max_bytes = max_bytes
+
+
+def cached_select(dataset: LincsDataset, predicate: Predicate) -> np.ndarray:
+  """select(dataset, predicate), read from / stored in the query cache
+
+  Parameters
+  ----------
+  dataset: LincsDataset
+    The dataset to filter (it can be metadata-only).
+  predicate: Predicate
+    E.g., isin('cell_id', ['MCF7', 'A375']) & isin('pert_time', [24])
+
+  Returns
+  -------
+  np.ndarray
+    Sorted array of the matching row indices.
+  """
+  if not query_cache.enabled:
+    return select(dataset, predicate)
+  fingerprint, key = dataset.fingerprint(), predicate.key()
+  indices = query_cache.get(fingerprint, key)
+  if indices is None:
+    indices = select(dataset, predicate)
+    query_cache.put(fingerprint, key, indices)
+  return indices
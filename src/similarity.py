@@ -0,0 +1,400 @@
+"""
+Similarity (connectivity) search over parsed profiles.
+
+search() finds, for a batch of query signatures, the k profiles of a
+dataset that are most similar to each of them, instead of looping over
+the line[1] vectors in Python. The profiles are scored block by block
+with one matrix multiplication per block (at most memory_budget bytes of
+intermediate data), and only the running top-k of every query is kept.
+
+Metrics:
+  cosine      cosine of the query and the profile
+  pearson     Pearson correlation (cosine of the centered vectors)
+  spearman    Spearman correlation (Pearson correlation of the gene ranks).
+              The ranks of the dataset are computed once and cached on it.
+  wtcs        weighted connectivity score of CMap (Subramanian et al.,
+              2017): the query is summarized by its n_set most up- and
+              down-regulated genes, and every profile is scored by the
+              weighted Kolmogorov-Smirnov enrichment of the two sets in its
+              ranked gene list, (ES_up - ES_down) / 2 when the enrichments
+              have opposite signs and 0 otherwise.
+
+The search can be restricted to the profiles matching a predicate of the
+metadata (see query.py), e.g. isin('cell_id', ['MCF7']).
+"""
+from __future__ import unicode_literals, print_function, division
+from typing import Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from .dataset import LincsDataset
+from .instrument import current_stage, instrumented
+from .query import Predicate
+from .query_cache import cached_select
+
+__author__ = "Hosein Fooladi"
+__email__ = "fooladi.hosein@gmail.com"
+
+METRICS = ('cosine', 'pearson', 'spearman', 'wtcs')
+
+# Intermediate data of a block of profiles (default 256 MiB)
+DEFAULT_MEMORY_BUDGET = 256 * 1024**2
+
+
+class SearchResult(object):
+  """Top-k profiles of every query
+
+  Attributes
+  ----------
+  indices: np.ndarray
+    (queries x k) rows of the dataset, from the most to the least similar.
+  scores: np.ndarray
+    (queries x k) float32 scores of these rows.
+  metric: str
+    The metric of the scores.
+  """
+
+  def __init__(self, indices: np.ndarray, scores: np.ndarray, metric: str):
+    self.indices = indices
+    self.scores = scores
+    self.metric = metric
+
+  def __len__(self) -> int:
+    return len(self.indices)
+
+  def to_frame(self, dataset: Optional[LincsDataset] = None) -> pd.DataFrame:
+    """One row per (query, rank), with the metadata of the profiles
+
+    Parameters
+    ----------
+    dataset: LincsDataset, optional
+      The searched dataset; its metadata fields are added as columns.
+    """
+    n_queries, k = self.indices.shape
+    frame = pd.DataFrame({
+        'query': np.repeat(np.arange(n_queries), k),
+        'rank': np.tile(np.arange(k), n_queries),
+        'index': self.indices.ravel(),
+        'score': self.scores.ravel(),
+    })
+    if dataset is not None:
+      for field in dataset.fields:
+        frame[field] = dataset.column(field)[frame['index'].to_numpy()]
+    return frame
+
+  def __repr__(self) -> str:
+    return 'SearchResult(metric={}, queries={}, k={})'.format(
+        self.metric, *self.indices.shape)
+
+
+def _unit_rows(x: np.ndarray, center: bool = False) -> np.ndarray:
+  """Rows of x (float32) scaled to unit norm (zero rows stay zero)"""
+  x = np.array(x, dtype=np.float32)
+  if center:
+    x -= x.mean(axis=1, keepdims=True)
+  norm = np.sqrt(np.einsum('ij,ij->i', x, x))
+  norm[norm == 0] = 1
+  x /= norm[:, None]
+  return x
+
+
+def rank_rows(x: np.ndarray) -> np.ndarray:
+  """Rank (1..n_genes, ties averaged) of every value within its row"""
+  x = np.asarray(x)
+  n, g = x.shape
+  # Ties get the same (average) rank, so the sort need not be stable
+  order = np.argsort(x, axis=1)
+  values = np.take_along_axis(x, order, axis=1)
+  position = np.arange(g)
+  start = np.ones((n, g), dtype=bool)
+  start[:, 1:] = values[:, 1:] != values[:, :-1]
+  ranks = np.empty((n, g), dtype=np.float32)
+  np.put_along_axis(ranks, order, np.arange(1, g + 1, dtype=np.float32),
+                    axis=1)
+  tied = np.flatnonzero(~start.all(axis=1))
+  if not len(tied):
+    return ranks
+  # Ties are averaged, in the rows that have some
+  start, order = start[tied], order[tied]
+  end = np.ones(start.shape, dtype=bool)
+  end[:, :-1] = start[:, 1:]
+  # First and last position of the run of equal values of every position
+  first = np.maximum.accumulate(np.where(start, position, 0), axis=1)
+  last = np.minimum.accumulate(np.where(end, position, g - 1)[:, ::-1],
+                               axis=1)[:, ::-1]
+  tied_ranks = np.empty(start.shape, dtype=np.float32)
+  np.put_along_axis(tied_ranks, order, (first + last) / 2 + 1, axis=1)
+  ranks[tied] = tied_ranks
+  return ranks
+
+
+def _prepare(block: np.ndarray, metric: str) -> np.ndarray:
+  """Rows of block transformed so that the score is a dot product"""
+  if metric == 'cosine':
+    return _unit_rows(block)
+  if metric == 'pearson':
+    return _unit_rows(block, center=True)
+  return _unit_rows(rank_rows(block), center=True)
+
+
+def _block_rows(n_genes: int, n_queries: int, metric: str,
+                memory_budget: Optional[int], block_size: Optional[int],
+                n_set: int = 50) -> int:
+  if block_size is not None:
+    assert isinstance(block_size, int) and block_size > 0, \
+        "block_size must be a positive integer"
+    return block_size
+  budget = DEFAULT_MEMORY_BUDGET if memory_budget is None else memory_budget
+  assert budget > 0, "memory_budget must be positive"
+  if metric == 'wtcs':
+    # ranked list and weights, positions and weights of the gene sets
+    per_row = 4 * (4 * n_genes + 12 * n_queries * n_set)
+  else:
+    # block copy, transformed block and scores
+    per_row = 4 * (2 * n_genes + n_queries)
+  return max(1, int(budget // per_row))
+
+
+def standardized_ranks(dataset: LincsDataset,
+                       block_size: int = 10000) -> np.ndarray:
+  """Centered, unit-norm gene ranks of every profile (cached on dataset)
+
+  The Spearman correlation of two profiles is the dot product of their
+  standardized ranks.
+  """
+  if dataset._ranks is None:
+    ranks = np.empty(dataset.expression.shape, dtype=np.float32)
+    for start in range(0, len(dataset), block_size):
+      block = dataset.expression[start:start + block_size]
+      ranks[start:start + block_size] = _prepare(block, 'spearman')
+    dataset._ranks = ranks
+  return dataset._ranks
+
+
+def _enrichment(positions: np.ndarray, weights: np.ndarray,
+                n_genes: int) -> np.ndarray:
+  """Weighted Kolmogorov-Smirnov enrichment score of gene sets
+
+  The running sum only rises at the genes of the set and falls in
+  between, so its extremes are at a hit or just before one: only the
+  positions of the set in the ranked list are needed.
+
+  positions: (... x set size) positions of the genes of the set in the
+  ranked list of a profile (0: the most up-regulated gene).
+  weights: (... x set size) absolute values of these genes in the profile.
+  """
+  n_set = positions.shape[-1]
+  order = np.argsort(positions, axis=-1)
+  positions = np.take_along_axis(positions, order, axis=-1)
+  weights = np.take_along_axis(weights, order, axis=-1)
+  total = weights.sum(axis=-1, keepdims=True)
+  total[total == 0] = 1
+  hit = np.cumsum(weights, axis=-1) / total
+  miss = (positions - np.arange(n_set)) / max(n_genes - n_set, 1)
+  at_hit = hit - miss
+  before_hit = at_hit - weights / total
+  highest = at_hit.max(axis=-1)
+  lowest = before_hit.min(axis=-1)
+  return np.where(highest >= -lowest, highest, lowest)
+
+
+def _wtcs_sets(queries: np.ndarray, n_set: int) -> Tuple[np.ndarray, np.ndarray]:
+  """Genes of the up- and down-regulated sets of every query"""
+  n_set = min(n_set, queries.shape[1] // 2)
+  assert n_set > 0, "The queries need at least 2 genes"
+  order = np.argsort(queries, axis=1, kind='stable')
+  return order[:, -n_set:], order[:, :n_set]
+
+
+def _wtcs(block: np.ndarray, up: np.ndarray, down: np.ndarray) -> np.ndarray:
+  """(queries x profiles) weighted connectivity scores"""
+  block = np.asarray(block, dtype=np.float32)
+  n, g = block.shape
+  # Position of every gene in the ranked list of its profile
+  ranks = np.empty((n, g), dtype=np.int64)
+  np.put_along_axis(ranks, np.argsort(-block, axis=1, kind='stable'),
+                    np.arange(g), axis=1)
+  weights = np.abs(block)
+  es = [
+      _enrichment(ranks[:, genes], weights[:, genes], g)
+      for genes in (up, down)
+  ]  # (profiles x queries)
+  scores = np.where(np.sign(es[0]) != np.sign(es[1]), (es[0] - es[1]) / 2, 0)
+  return scores.T.astype(np.float32)
+
+
+def _as_dataset(data: Union[str, List, LincsDataset]) -> LincsDataset:
+  if isinstance(data, str):
+    from .utils import load_dataset
+    return load_dataset(data, build_index=False)
+  if isinstance(data, list):
+    return LincsDataset.from_list(data)
+  assert isinstance(data, LincsDataset), \
+      "The data should be string, list or LincsDataset object"
+  return data
+
+
+def _as_queries(queries: Union[np.ndarray, List, LincsDataset],
+                dataset: LincsDataset) -> Tuple[np.ndarray, LincsDataset]:
+  """Query matrix, and the dataset projected on the genes of the queries"""
+  if isinstance(queries, LincsDataset):
+    if queries.gene_ids is not None and dataset.gene_ids is not None and \
+        not np.array_equal(queries.gene_ids.astype(str),
+                           dataset.gene_ids.astype(str)):
+      dataset = dataset.select_genes(queries.gene_ids)
+    queries = queries.expression
+  elif isinstance(queries, list) and queries and isinstance(queries[0], list):
+    queries = [line[1] for line in queries]  # legacy list format
+  queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+  assert queries.ndim == 2, "queries must be a vector or a (queries x genes) matrix"
+  assert queries.shape[1] == dataset.n_genes, \
+      "The queries have {} genes, the profiles {}".format(queries.shape[1],
+                                                          dataset.n_genes)
+  return queries, dataset
+
+
+def _iter_scores(dataset: LincsDataset, queries: np.ndarray, metric: str,
+                 rows: Optional[np.ndarray], block_rows: int, n_set: int,
+                 cache: bool) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+  """(rows, queries x rows scores) of consecutive blocks of profiles"""
+  assert metric in METRICS, "metric must be one of {}".format(METRICS)
+  assert dataset.expression is not None, "The dataset has no expression matrix"
+  n = len(dataset) if rows is None else len(rows)
+
+  if metric == 'wtcs':
+    up, down = _wtcs_sets(queries, n_set)
+  else:
+    prepared = _prepare(queries, metric)
+  ranks = standardized_ranks(dataset) \
+      if metric == 'spearman' and cache else None
+
+  for start in range(0, n, block_rows):
+    if rows is None:
+      block_idx = np.arange(start, min(start + block_rows, n))
+      select = slice(start, start + block_rows)
+    else:
+      block_idx = rows[start:start + block_rows]
+      select = block_idx
+    if metric == 'wtcs':
+      yield block_idx, _wtcs(dataset.expression[select], up, down)
+    elif ranks is not None:
+      yield block_idx, prepared @ ranks[select].T
+    else:
+      yield block_idx, prepared @ _prepare(dataset.expression[select], metric).T
+
+
+def _candidates(dataset: LincsDataset,
+                predicate: Optional[Predicate]) -> Optional[np.ndarray]:
+  if predicate is None:
+    return None
+  assert isinstance(predicate, Predicate), "predicate must be a Predicate"
+  return np.asarray(cached_select(dataset, predicate), dtype=np.int64)
+
+
+def similarity_matrix(data: Union[str, List, LincsDataset],
+                      queries: Union[np.ndarray, List, LincsDataset],
+                      metric: str = 'cosine',
+                      predicate: Optional[Predicate] = None,
+                      memory_budget: Optional[int] = None,
+                      n_set: int = 50,
+                      cache: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+  """Scores of every query against every (selected) profile
+
+  Returns
+  -------
+  Tuple[np.ndarray, np.ndarray]
+    The rows of the dataset and the (queries x rows) float32 scores. See
+    search for the parameters.
+  """
+  dataset = _as_dataset(data)
+  queries, dataset = _as_queries(queries, dataset)
+  rows = _candidates(dataset, predicate)
+  block_rows = _block_rows(dataset.n_genes, len(queries), metric,
+                           memory_budget, None, n_set)
+  blocks = list(
+      _iter_scores(dataset, queries, metric, rows, block_rows, n_set, cache))
+  if not blocks:
+    return np.zeros(0, dtype=np.int64), np.zeros((len(queries), 0),
+                                                 dtype=np.float32)
+  return (np.concatenate([idx for idx, _ in blocks]),
+          np.concatenate([scores for _, scores in blocks], axis=1))
+
+
+@instrumented()
+def search(data: Union[str, List, LincsDataset],
+           queries: Union[np.ndarray, List, LincsDataset],
+           k: int = 10,
+           metric: str = 'cosine',
+           predicate: Optional[Predicate] = None,
+           largest: bool = True,
+           memory_budget: Optional[int] = None,
+           block_size: Optional[int] = None,
+           n_set: int = 50,
+           cache: bool = True) -> SearchResult:
+  """The k profiles most similar to every query
+
+  Parameters
+  ----------
+  data: Union[str, List, LincsDataset]
+    The searched profiles: a dataset directory (see utils.load_dataset),
+    a list in the parsing format or a LincsDataset.
+  queries: Union[np.ndarray, List, LincsDataset]
+    A signature, a (queries x genes) matrix, a list in the parsing format
+    or a LincsDataset (the profiles are then projected on its genes). The
+    genes must be in the order of the profiles.
+  k: int, optional (default 10)
+    Number of profiles returned per query (fewer if fewer match).
+  metric: str, optional (default 'cosine')
+    One of METRICS: 'cosine', 'pearson', 'spearman' or 'wtcs'.
+  predicate: Predicate, optional
+    Only search the profiles matching it, e.g. isin('cell_id', ['MCF7']).
+    Default=None (every profile)
+  largest: bool, optional (default True)
+    Whether to return the highest scores, or the lowest ones (e.g. the
+    profiles reversing the query).
+  memory_budget: int, optional
+    Approximate bytes of intermediate data per block of profiles. Default:
+    DEFAULT_MEMORY_BUDGET.
+  block_size: int, optional
+    Number of profiles per block (overrides memory_budget).
+  n_set: int, optional (default 50)
+    Size of the up- and down-regulated gene sets of the queries (wtcs).
+  cache: bool, optional (default True)
+    Whether the gene ranks of the dataset are computed once and kept on
+    it (spearman).
+
+  Returns
+  -------
+  SearchResult
+    Rows of the dataset and scores, from the best to the worst.
+  """
+  assert isinstance(k, int) and k > 0, "k must be a positive integer"
+  dataset = _as_dataset(data)
+  queries, dataset = _as_queries(queries, dataset)
+  rows = _candidates(dataset, predicate)
+  n = len(dataset) if rows is None else len(rows)
+  current_stage().rows = n
+  block_rows = _block_rows(dataset.n_genes, len(queries), metric,
+                           memory_budget, block_size, n_set)
+
+  sign = 1 if largest else -1
+  best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+  best_idx = np.zeros((len(queries), 0), dtype=np.int64)
+  for block_idx, scores in _iter_scores(dataset, queries, metric, rows,
+                                        block_rows, n_set, cache):
+    scores = np.hstack([best_scores, sign * scores.astype(np.float32)])
+    idx = np.hstack([best_idx, np.broadcast_to(block_idx, scores.shape[:1] +
+                                               block_idx.shape)])
+    if scores.shape[1] > k:
+      top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+      scores = np.take_along_axis(scores, top, axis=1)
+      idx = np.take_along_axis(idx, top, axis=1)
+    best_scores, best_idx = scores, idx
+
+  # Best first; ties in the order of the rows
+  order = np.lexsort((best_idx, -best_scores), axis=1) if best_idx.size else \
+      np.zeros(best_idx.shape, dtype=np.int64)
+  return SearchResult(np.take_along_axis(best_idx, order, axis=1),
+                      sign * np.take_along_axis(best_scores, order, axis=1),
+                      metric)
@@ -0,0 +1,155 @@
+"""
+Frequency statistics of the metadata fields of a dataset.
+
+The print_* and *_frequent functions of utils used to decode a column,
+then build set() and Counter() objects from it (several times for the same
+column). Here the counts of a field are computed once, in one vectorized
+pass over its category codes, and cached on the dataset.
+"""
+from __future__ import unicode_literals, print_function, division
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .dataset import LincsDataset
+
+__author__ = "Hosein Fooladi"
+__email__ = "fooladi.hosein@gmail.com"
+
+
+class FieldCounts(object):
+  """Number of profiles of every distinct value of one metadata field
+
+  Values are sorted by decreasing count, ties in order of first appearance
+  in the dataset, i.e. the order of collections.Counter.most_common.
+
+  Parameters
+  ----------
+  field: str
+    Name of the metadata field.
+  values: np.ndarray
+    Object array of the distinct values present in the dataset.
+  counts: np.ndarray
+    Number of profiles of every value.
+  codes: np.ndarray
+    Category code of every value.
+  """
+
+  def __init__(self, field: str, values: np.ndarray, counts: np.ndarray,
+               codes: np.ndarray):
+    self.field = field
+    self.values = values
+    self.counts = counts
+    self.codes = codes
+
+  @property
+  def n_unique(self) -> int:
+    """Number of distinct values"""
+    return len(self.values)
+
+  def most_common(self, n: Optional[int] = None) -> List[Tuple[Any, int]]:
+    """(value, count) pairs of the n most frequent values (all if n is None)"""
+    stop = self.n_unique if n is None else max(n, 0)
+    return [(value, int(count))
+            for value, count in zip(self.values[:stop], self.counts[:stop])]
+
+  def top(self, start: int = 0, end: Optional[int] = None) -> List:
+    """Values ranked start to end (excluded) by frequency"""
+    return list(self.values[start:end])
+
+  def __repr__(self) -> str:
+    return "FieldCounts(field={!r}, n_unique={})".format(
+        self.field, self.n_unique)
+
+
+class DatasetSummary(object):
+  """Counts of several metadata fields of a dataset
+
+  Parameters
+  ----------
+  n_profiles: int
+    Number of profiles of the dataset.
+  fields: Dict[str, FieldCounts]
+    Counts of every summarized field.
+  """
+
+  def __init__(self, n_profiles: int, fields: Dict[str, FieldCounts]):
+    self.n_profiles = n_profiles
+    self.fields = fields
+
+  def __getitem__(self, field: str) -> FieldCounts:
+    return self.fields[field]
+
+  def __contains__(self, field: str) -> bool:
+    return field in self.fields
+
+  def __repr__(self) -> str:
+    return "DatasetSummary(n_profiles={}, n_unique={})".format(
+        self.n_profiles,
+        {field: counts.n_unique for field, counts in self.fields.items()})
+
+
+def _count_codes(dataset: LincsDataset,
+                 field: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+  """(codes present, their counts, row of their first appearance)"""
+  index = dataset.metadata_index
+  if index is not None:
+    # The posting lists are stable-sorted by code: the first row of every
+    # code is at the start of its list.
+    order, offsets = index.postings[field]
+    counts = np.diff(offsets)
+    codes = np.flatnonzero(counts)
+    return codes, counts[codes], order[offsets[codes]]
+  codes, first, counts = np.unique(np.asarray(dataset.codes[field]),
+                                   return_index=True,
+                                   return_counts=True)
+  return codes, counts, first
+
+
+def field_counts(dataset: LincsDataset, field: str) -> FieldCounts:
+  """Counts of the values of field (cached on the dataset)
+
+  Parameters
+  ----------
+  dataset: LincsDataset
+    The dataset (its expression matrix is not used).
+  field: str
+    Name of the metadata field.
+
+  Returns
+  -------
+  FieldCounts
+  """
+  assert isinstance(dataset, LincsDataset), "dataset must be a LincsDataset"
+  assert field in dataset.fields, "{} is not a field of the dataset".format(field)
+  cached = dataset._stats.get(field)
+  if cached is not None:
+    return cached
+
+  codes, counts, first = _count_codes(dataset, field)
+  order = np.lexsort((first, -counts))
+  codes = codes[order].astype(np.int32, copy=False)
+  result = FieldCounts(field, dataset.categories[field][codes],
+                       counts[order].astype(np.int64, copy=False), codes)
+  dataset._stats[field] = result
+  return result
+
+
+def summarize(dataset: LincsDataset,
+              fields: Optional[Sequence[str]] = None) -> DatasetSummary:
+  """Counts of several metadata fields of a dataset
+
+  Parameters
+  ----------
+  dataset: LincsDataset
+    The dataset (its expression matrix is not used).
+  fields: Sequence[str], optional
+    Fields to summarize. Default=all the fields of the dataset.
+
+  Returns
+  -------
+  DatasetSummary
+  """
+  fields = dataset.fields if fields is None else fields
+  return DatasetSummary(len(dataset),
+                        {field: field_counts(dataset, field) for field in fields})
@@ -0,0 +1,461 @@
+"""
+Native on-disk format of LincsDataset objects.
+
+A dataset is a directory with:
+  header.json        format version, shape, dtype and metadata fields
+  expression.npy     (profiles x genes) expression matrix, or
+  expression.bin     the same matrix in compressed blocks (see
+                     compression.py) and expression_blocks.npy their offsets
+  codes/<field>.npy  int32 category codes of every metadata field
+  categories.pkl     distinct values of every field (small)
+  gene_ids.npy       identifiers of the expression columns (optional)
+  index.npz          metadata index (optional, see index.MetadataIndex)
+
+Every array is a plain .npy file, so open_dataset maps them with np.memmap
+in constant time: filters and statistics only touch the pages they need,
+and processes opening the same dataset share one copy in the page cache.
+A compressed expression matrix is smaller on disk (faster to copy over the
+network and to read cold) but is decoded into memory by open_dataset.
+"""
+from __future__ import unicode_literals, print_function, division
+from typing import Dict, Iterable, List, Optional, Sequence, Union
+
+import json
+import os
+import pickle
+import struct
+
+import numpy as np
+
+from .compression import Compression, decode_blocks, encode_block
+from .dataset import LincsDataset
+from .index import MetadataIndex
+
+__author__ = "Hosein Fooladi"
+__email__ = "fooladi.hosein@gmail.com"
+
+FORMAT_NAME = 'lincs-dataset'
+FORMAT_VERSION = 1
+HEADER_FILE = 'header.json'
+
+# Size of the .npy headers written by DatasetWriter. The header is written
+# before the number of rows is known, and rewritten in place on close.
+_NPY_HEADER_SIZE = 128
+
+
+def is_dataset_dir(dataset_dir: str) -> bool:
+  """Whether dataset_dir is a dataset written by save_dataset"""
+  return os.path.isfile(os.path.join(dataset_dir, HEADER_FILE))
+
+
+def _npy_header(shape: Sequence[int], dtype) -> bytes:
+  """Fixed-size .npy (version 1.0) header"""
+  header = "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+      np.dtype(dtype).str, tuple(int(x) for x in shape))
+  padding = _NPY_HEADER_SIZE - 10 - len(header) - 1
+  assert padding >= 0, "Shape is too large for the reserved .npy header"
+  return (b'\x93NUMPY\x01\x00' + struct.pack('<H', _NPY_HEADER_SIZE - 10) +
+          header.encode('latin1') + b' ' * padding + b'\n')
+
+
+class _ArrayStream(object):
+  """.npy file written row block by row block"""
+
+  def __init__(self, path: str, row_shape: Sequence[int], dtype):
+    self.path = path
+    self.row_shape = tuple(row_shape)
+    self.dtype = np.dtype(dtype)
+    self.n_rows = 0
+    self._file = open(path, 'wb')
+    self._file.write(_npy_header((0,) + self.row_shape, self.dtype))
+
+  def write(self, block: np.ndarray) -> None:
+    block = np.ascontiguousarray(block, dtype=self.dtype)
+    assert block.shape[1:] == self.row_shape, "Unexpected block shape"
+    block.tofile(self._file)
+    self.n_rows += block.shape[0]
+
+  def close(self) -> None:
+    self._file.seek(0)
+    self._file.write(_npy_header((self.n_rows,) + self.row_shape, self.dtype))
+    self._file.close()
+
+
+class _CompressedStream(object):
+  """Expression matrix written in compressed blocks"""
+
+  def __init__(self, dataset_dir: str, n_genes: int, dtype,
+               compression: Compression):
+    self.dataset_dir = dataset_dir
+    self.n_genes = n_genes
+    self.dtype = np.dtype(dtype)
+    self.compression = compression
+    self.n_rows = 0
+    self._offsets = [0]
+    self._pending = []
+    self._n_pending = 0
+    self._file = open(os.path.join(dataset_dir, 'expression.bin'), 'wb')
+
+  def write(self, block: np.ndarray) -> None:
+    block = np.asarray(block, dtype=self.dtype)
+    assert block.shape[1:] == (self.n_genes,), "Unexpected block shape"
+    self._pending.append(block)
+    self._n_pending += len(block)
+    self.n_rows += len(block)
+    rows = self.compression.chunk_rows
+    if self._n_pending >= rows:
+      pending = np.concatenate(self._pending)
+      for start in range(0, len(pending) - rows + 1, rows):
+        self._flush(pending[start:start + rows])
+      rest = pending[len(pending) - len(pending) % rows:]
+      self._pending, self._n_pending = [rest], len(rest)
+
+  def _flush(self, block: np.ndarray) -> None:
+    payload = encode_block(block, self.compression)
+    self._file.write(payload)
+    self._offsets.append(self._offsets[-1] + len(payload))
+
+  def close(self) -> None:
+    if self._n_pending > 0:
+      self._flush(np.concatenate(self._pending))
+    self._pending = []
+    self._file.close()
+    np.save(os.path.join(self.dataset_dir, 'expression_blocks.npy'),
+            np.asarray(self._offsets, dtype=np.int64))
+
+
+def _read_compressed(dataset_dir: str, header: Dict,
+                     n_jobs: Optional[int]) -> np.ndarray:
+  offsets = np.load(os.path.join(dataset_dir, 'expression_blocks.npy'))
+  with open(os.path.join(dataset_dir, 'expression.bin'), 'rb') as f:
+    payloads = [f.read(int(end - start))
+                for start, end in zip(offsets[:-1], offsets[1:])]
+  return decode_blocks(payloads,
+                       Compression.from_dict(header['compression']),
+                       header['n_genes'],
+                       np.dtype(header['dtype']),
+                       n_jobs=n_jobs)
+
+
+def _gene_order(gene_ids: Sequence[str],
+                leading_genes: Sequence[str]) -> np.ndarray:
+  """Permutation of the columns putting leading_genes first"""
+  ids = np.asarray(gene_ids).astype(str)
+  position = {gene: i for i, gene in enumerate(ids)}
+  leading = []
+  for gene in np.asarray(leading_genes).astype(str):
+    assert gene in position, "Unknown gene in leading_genes: {}".format(gene)
+    leading.append(position.pop(gene))
+  rest = np.ones(len(ids), dtype=bool)
+  rest[leading] = False
+  return np.concatenate([np.asarray(leading, dtype=np.intp),
+                         np.flatnonzero(rest)])
+
+
+class DatasetWriter(object):
+  """Incremental writer of the on-disk dataset format
+
+  Blocks (LincsDataset objects with the same fields and genes) are appended
+  one after the other, so a dataset larger than memory can be written from
+  a stream of chunks (e.g. parser.iter_level3_cp).
+
+  Parameters
+  ----------
+  dataset_dir: str
+    Directory of the output dataset (created if needed).
+  fields: Sequence[str]
+    Metadata fields of the blocks.
+  n_genes: int
+    Number of expression columns.
+  gene_ids: Sequence[str], optional
+    Identifiers of the expression columns.
+  dtype: optional (default np.float32)
+    dtype of the stored expression matrix.
+  compression: Compression, optional
+    If given, the expression matrix is stored in compressed blocks
+    (see compression.py). Default=None (plain, memory-mappable .npy)
+  leading_genes: Sequence[str], optional
+    Identifiers of genes stored first, in this order, followed by the
+    other genes (e.g. the landmark genes). Projecting the dataset on them
+    (LincsDataset.select_genes) is then a view of the memory map instead
+    of a copy. Requires gene_ids.
+  """
+
+  def __init__(self,
+               dataset_dir: str,
+               fields: Sequence[str],
+               n_genes: int,
+               gene_ids: Optional[Sequence[str]] = None,
+               dtype=np.float32,
+               compression: Optional[Compression] = None,
+               leading_genes: Optional[Sequence[str]] = None):
+    assert isinstance(dataset_dir, str), "The dataset_dir must be a string object"
+    self.dataset_dir = dataset_dir
+    self.fields = tuple(fields)
+    self.n_genes = n_genes
+    self.gene_ids = gene_ids
+    self._order = None
+    if leading_genes is not None:
+      assert gene_ids is not None, "leading_genes requires gene_ids"
+      self._order = _gene_order(gene_ids, leading_genes)
+      self.gene_ids = np.asarray(gene_ids)[self._order]
+    self.dtype = np.dtype(dtype)
+    self.compression = compression
+
+    os.makedirs(os.path.join(dataset_dir, 'codes'), exist_ok=True)
+    # Files of a previous dataset in the same directory must not survive.
+    for name in (HEADER_FILE, 'index.npz', 'gene_ids.npy', 'expression.npy',
+                 'expression.bin', 'expression_blocks.npy'):
+      if os.path.exists(os.path.join(dataset_dir, name)):
+        os.remove(os.path.join(dataset_dir, name))
+    if compression is None:
+      self._expression = _ArrayStream(
+          os.path.join(dataset_dir, 'expression.npy'), (n_genes,), self.dtype)
+    else:
+      self._expression = _CompressedStream(dataset_dir, n_genes, self.dtype,
+                                           compression)
+    self._codes = {
+        field: _ArrayStream(
+            os.path.join(dataset_dir, 'codes', field + '.npy'), (), np.int32)
+        for field in self.fields
+    }
+    self._categories = {field: [] for field in self.fields}  # type: Dict[str, List]
+    self._lookup = {field: {} for field in self.fields}  # type: Dict[str, Dict]
+
+  def _recode(self, field: str, categories: np.ndarray) -> np.ndarray:
+    """Codes, in this writer, of the categories of an incoming block"""
+    lookup = self._lookup[field]
+    known = self._categories[field]
+    mapping = np.empty(len(categories), dtype=np.int32)
+    for i, value in enumerate(categories):
+      try:
+        code = lookup.get(value)
+        if code is None:
+          code = lookup[value] = len(known)
+          known.append(value)
+      except TypeError:
+        # Unhashable values (e.g. moa stored as a list): linear search
+        for code, other in enumerate(known):
+          if type(other) is type(value) and np.array_equal(other, value):
+            break
+        else:
+          code = len(known)
+          known.append(value)
+      mapping[i] = code
+    return mapping
+
+  @property
+  def n_profiles(self) -> int:
+    """Number of profiles appended so far"""
+    return self._expression.n_rows
+
+  def append(self, block: LincsDataset) -> None:
+    """Append the profiles of block"""
+    assert isinstance(block, LincsDataset), "block must be a LincsDataset"
+    assert block.fields == self.fields, "block fields do not match"
+    assert block.expression is not None, "block has no expression matrix"
+    assert block.n_genes == self.n_genes, "block genes do not match"
+    if len(block) == 0:
+      return
+    if self._order is None:
+      self._expression.write(block.expression)
+    else:
+      self._expression.write(block.expression[:, self._order])
+    for field in self.fields:
+      mapping = self._recode(field, block.categories[field])
+      self._codes[field].write(mapping[block.codes[field]])
+
+  def close(self) -> None:
+    """Finalize the files; the dataset is readable only after close"""
+    self._expression.close()
+    for stream in self._codes.values():
+      stream.close()
+
+    categories = {}
+    for field in self.fields:
+      arr = np.empty(len(self._categories[field]), dtype=object)
+      for i, value in enumerate(self._categories[field]):
+        arr[i] = value
+      categories[field] = arr
+    with open(os.path.join(self.dataset_dir, 'categories.pkl'), 'wb') as f:
+      pickle.dump(categories, f)
+
+    if self.gene_ids is not None:
+      np.save(os.path.join(self.dataset_dir, 'gene_ids.npy'),
+              np.asarray(self.gene_ids, dtype=str))
+
+    header = {
+        'format': FORMAT_NAME,
+        'version': FORMAT_VERSION,
+        'n_profiles': self._expression.n_rows,
+        'n_genes': self.n_genes,
+        'dtype': self.dtype.str,
+        'fields': list(self.fields),
+    }
+    if self.compression is not None:
+      header['compression'] = self.compression.to_dict()
+    # The header is written last: its presence marks a complete dataset.
+    with open(os.path.join(self.dataset_dir, HEADER_FILE), 'w') as f:
+      json.dump(header, f, indent=2)
+
+  def __enter__(self) -> 'DatasetWriter':
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback) -> None:
+    if exc_type is None:
+      self.close()
+
+
+def save_dataset(dataset_dir: str,
+                 data: LincsDataset,
+                 index: bool = True,
+                 dtype=None,
+                 compression: Optional[Union[Compression, str]] = None,
+                 leading_genes: Optional[Sequence[str]] = None) -> None:
+  """Write a LincsDataset (or a legacy list) in the on-disk format
+
+  Parameters
+  ----------
+  dataset_dir: str
+    Directory of the output dataset. e.g., './Data/level3_trt_cp_landmark'
+  data: LincsDataset
+    The dataset. A legacy list is converted with LincsDataset.from_list.
+  index: bool, optional (default True)
+    Whether to also store the metadata index.
+  dtype: optional
+    dtype of the stored expression matrix. Default: dtype of data.
+  compression: Union[Compression, str], optional
+    Compression of the expression matrix: a Compression or a codec name
+    (e.g. 'zlib' or 'zstd', with byte shuffle). Default=None (uncompressed)
+  leading_genes: Sequence[str], optional
+    Genes stored first, e.g. the landmark genes of a full 12328-gene
+    dataset (see DatasetWriter).
+  """
+  if isinstance(data, list):
+    data = LincsDataset.from_list(data)
+  assert isinstance(data, LincsDataset), "data must be a LincsDataset or a list"
+  assert data.expression is not None, "data has no expression matrix"
+
+  dtype = data.expression.dtype if dtype is None else dtype
+  if isinstance(compression, str):
+    compression = Compression(compression)
+  with DatasetWriter(dataset_dir,
+                     data.fields,
+                     data.n_genes,
+                     gene_ids=data.gene_ids,
+                     dtype=dtype,
+                     compression=compression,
+                     leading_genes=leading_genes) as writer:
+    writer.append(data)
+
+  if index:
+    open_dataset(dataset_dir, index=False).build_index().save(
+        os.path.join(dataset_dir, 'index.npz'))
+
+
+def write_chunks(dataset_dir: str,
+                 chunks: Iterable[LincsDataset],
+                 index: bool = True,
+                 compression: Optional[Union[Compression, str]] = None,
+                 leading_genes: Optional[Sequence[str]] = None) -> int:
+  """Write a stream of LincsDataset blocks as one on-disk dataset
+
+  compression and leading_genes are as in save_dataset.
+
+  Returns
+  -------
+  int
+    Number of profiles written.
+  """
+  if isinstance(compression, str):
+    compression = Compression(compression)
+  writer = None
+  for chunk in chunks:
+    if writer is None:
+      writer = DatasetWriter(dataset_dir,
+                             chunk.fields,
+                             chunk.n_genes,
+                             gene_ids=chunk.gene_ids,
+                             dtype=chunk.expression.dtype,
+                             compression=compression,
+                             leading_genes=leading_genes)
+    writer.append(chunk)
+  assert writer is not None, "No chunk to write"
+  writer.close()
+
+  if index:
+    open_dataset(dataset_dir, index=False).build_index().save(
+        os.path.join(dataset_dir, 'index.npz'))
+  return writer.n_profiles
+
+
+def read_header(dataset_dir: str) -> Dict:
+  """The header.json of an on-disk dataset"""
+  with open(os.path.join(dataset_dir, HEADER_FILE)) as f:
+    header = json.load(f)
+  assert header.get('format') == FORMAT_NAME, \
+      "{} is not a LINCS dataset".format(dataset_dir)
+  assert header.get('version', 0) <= FORMAT_VERSION, \
+      "Unsupported dataset version: {}".format(header.get('version'))
+  return header
+
+
+def open_dataset(dataset_dir: str,
+                 mmap: bool = True,
+                 index: bool = True,
+                 n_jobs: Optional[int] = None,
+                 genes: Optional[Sequence[str]] = None) -> LincsDataset:
+  """Open a dataset written by save_dataset / DatasetWriter
+
+  Parameters
+  ----------
+  dataset_dir: str
+    Directory of the dataset.
+  mmap: bool, optional (default True)
+    Whether the arrays are memory-mapped (read-only, loaded lazily by the
+    OS) or read into memory.
+  index: bool, optional (default True)
+    Whether to attach the stored metadata index (if there is one).
+  n_jobs: int, optional
+    Number of threads decoding a compressed expression matrix.
+    Default=None (one per CPU)
+  genes: Sequence[str], optional
+    Only keep these genes (see LincsDataset.select_genes). Default=None
+    (all of them)
+
+  Returns
+  -------
+  LincsDataset
+  """
+  assert isinstance(dataset_dir, str), "The dataset_dir must be a string object"
+  header = read_header(dataset_dir)
+  mmap_mode = 'r' if mmap else None
+
+  if 'compression' in header:
+    expression = _read_compressed(dataset_dir, header, n_jobs)
+  else:
+    expression = np.load(os.path.join(dataset_dir, 'expression.npy'),
+                         mmap_mode=mmap_mode)
+  codes = {
+      field: np.load(os.path.join(dataset_dir, 'codes', field + '.npy'),
+                     mmap_mode=mmap_mode) for field in header['fields']
+  }
+  with open(os.path.join(dataset_dir, 'categories.pkl'), 'rb') as f:
+    categories = pickle.load(f)
+
+  gene_ids = None
+  if os.path.exists(os.path.join(dataset_dir, 'gene_ids.npy')):
+    gene_ids = np.load(os.path.join(dataset_dir, 'gene_ids.npy'))
+
+  dataset = LincsDataset(expression,
+                         codes,
+                         categories,
+                         fields=header['fields'],
+                         gene_ids=gene_ids)
+
+  index_dir = os.path.join(dataset_dir, 'index.npz')
+  if index and os.path.exists(index_dir):
+    dataset.attach_index(MetadataIndex.load(index_dir))
+  if genes is not None:
+    dataset = dataset.select_genes(genes)
+  return dataset
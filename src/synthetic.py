@@ -0,0 +1,356 @@
+"""
+Synthetic LINCS data.
+
+generate() writes a deterministic, scaled-down imitation of the LINCS
+release files, so parsers, filters and benchmarks can run without the
+real (50 GB) GCTX files:
+  level3.gctx               expression of every instance (profile)
+  level5.gctx               z-score signature of every replicate group
+  inst_info.txt             GSE92742 layout (pert_dose, pert_dose_unit, ...)
+  sig_info.txt              GSE70138 layout (pert_idose '10 uM', pert_itime
+                            '24 h', distil_id listing the replicates)
+  gene_info.txt             gene_id, gene_symbol, is_lm, is_bing
+  pert_info.txt             pert_id, pert_iname, pert_type, is_touchstone, ...
+  repurposing_drugs.txt     drug repurposing hub annotations
+
+Cell lines and compounds follow Zipf-like frequencies (a few of them are
+very common, as in LINCS), instances are grouped on 384-well plates of
+one cell line and time with vehicle controls on every plate, and the
+expression has a low-rank structure (gene baseline + cell line effect +
+dose-scaled compound signature + plate effect + noise).
+
+Example:
+  python -m src.synthetic Data/synthetic --n_profiles 100000 --n_genes 978
+"""
+from __future__ import unicode_literals, print_function, division
+from typing import Dict, Iterator, Optional, Sequence
+
+import argparse
+import os
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from .gctx import cid_node, data_node, rid_node
+
+__author__ = "Hosein Fooladi"
+__email__ = "fooladi.hosein@gmail.com"
+
+CELL_LINES = ('MCF7', 'PC3', 'A375', 'A549', 'HT29', 'HA1E', 'VCAP',
+              'HCC515', 'HEPG2', 'NPC', 'ASC', 'NEU', 'SKB', 'HUVEC', 'HL60')
+DOSES = (0.04, 0.12, 0.37, 1.11, 3.33, 10.0)  # um
+TIMES = (6, 24)  # h
+MOAS = tuple('MOA-{:02d} inhibitor'.format(i) for i in range(40))
+PHASES = ('Launched', 'Phase 3', 'Phase 2', 'Phase 1', 'Preclinical',
+          'Withdrawn')
+PLATE_SIZE = 384
+
+# Profiles generated at a time (the values do not depend on the scale of
+# the run, only on the seed and the position of the block)
+_BLOCK = 4096
+_RANK = 16
+_NOISE = 0.3
+
+
+def zipf_choice(rng: np.random.Generator, n: int, size: int,
+                skew: float) -> np.ndarray:
+  """size draws of 0..n-1 with probability proportional to 1 / (k+1)**skew"""
+  weights = 1.0 / np.arange(1, n + 1)**skew
+  return rng.choice(n, size=size, p=weights / weights.sum())
+
+
+def _wells(n: int) -> np.ndarray:
+  rows = np.array(list('ABCDEFGHIJKLMNOP'))
+  k = np.arange(n) % PLATE_SIZE
+  return np.char.add(rows[k // 24], np.char.zfill((k % 24 + 1).astype(str), 2))
+
+
+def _names(prefix: str, n: int, width: int) -> np.ndarray:
+  return np.char.add(prefix, np.char.zfill(np.arange(n).astype(str), width))
+
+
+def write_gctx(path: str, col_ids: Sequence[str], row_ids: Sequence[str],
+               blocks: Iterator[np.ndarray]) -> None:
+  """Write a GCTX file block by block
+
+  Parameters
+  ----------
+  path: str
+    The output file.
+  col_ids: Sequence[str]
+    Profile (column) identifiers.
+  row_ids: Sequence[str]
+    Gene (row) identifiers.
+  blocks: Iterator[np.ndarray]
+    Consecutive (profiles x genes) float32 blocks covering every column.
+  """
+  n_cols, n_rows = len(col_ids), len(row_ids)
+  with h5py.File(path, 'w') as f:
+    f.attrs['version'] = 'GCTX1.0'
+    f.attrs['src'] = os.path.basename(path)
+    chunk = (max(1, min(n_cols, (1 << 18) // max(n_rows, 1))), max(n_rows, 1))
+    matrix = f.create_dataset(data_node, shape=(n_cols, n_rows),
+                              dtype=np.float32, chunks=chunk if n_cols else None)
+    start = 0
+    for block in blocks:
+      matrix[start:start + len(block)] = block
+      start += len(block)
+    assert start == n_cols, "The blocks must cover every column"
+    f.create_dataset(cid_node, data=np.asarray(col_ids, dtype='S'))
+    f.create_dataset(rid_node, data=np.asarray(row_ids, dtype='S'))
+
+
+def _instances(rng: np.random.Generator, n_profiles: int, n_cells: int,
+               n_compounds: int, skew: float,
+               control_fraction: float) -> pd.DataFrame:
+  cell_names = np.array(list(CELL_LINES[:n_cells]) + [
+      'CL{:03d}'.format(i) for i in range(max(0, n_cells - len(CELL_LINES)))
+  ])
+  cell = zipf_choice(rng, n_cells, n_profiles, skew)
+  time = rng.choice(len(TIMES), n_profiles, p=[0.35, 0.65])
+  control = rng.random(n_profiles) < control_fraction
+  compound = zipf_choice(rng, n_compounds, n_profiles, skew)
+  dose = rng.choice(len(DOSES), n_profiles)
+
+  # Plates of PLATE_SIZE wells, each of one cell line and one time
+  frame = pd.DataFrame({'cell': cell, 'time': time})
+  order = np.lexsort((np.arange(n_profiles), time, cell))
+  rank = frame.iloc[order].groupby(['cell', 'time']).cumcount().to_numpy()
+  group = frame.iloc[order].groupby(['cell', 'time']).ngroup().to_numpy()
+  plate = np.empty(n_profiles, dtype=np.int64)
+  plate[order] = pd.factorize(group * (n_profiles + 1) + rank // PLATE_SIZE)[0]
+  well = np.empty(n_profiles, dtype=object)
+  well[order] = _wells(n_profiles)[rank % PLATE_SIZE] if n_profiles else []
+
+  rna_plate = np.char.add('SYN', np.char.zfill(plate.astype(str), 5))
+  pert_id = np.where(control, 'DMSO', _names('BRD-K', n_compounds, 8)[compound])
+  return pd.DataFrame({
+      'inst_id': np.char.add(np.char.add(rna_plate, ':'), well.astype(str)),
+      'rna_plate': rna_plate,
+      'rna_well': well,
+      'pert_id': pert_id,
+      'pert_iname': np.where(control, 'DMSO',
+                             _names('cpd-', n_compounds, 5)[compound]),
+      'pert_type': np.where(control, 'ctl_vehicle', 'trt_cp'),
+      'pert_dose': np.where(control, -666.0, np.array(DOSES)[dose]),
+      'pert_dose_unit': np.where(control, '-666', 'um'),
+      'pert_time': np.array(TIMES)[time],
+      'pert_time_unit': 'h',
+      'cell_id': cell_names[cell],
+      # codes used to generate the expression
+      '_cell': cell,
+      '_compound': np.where(control, -1, compound),
+      '_dose': np.where(control, 0.0, np.log10(np.array(DOSES)[dose]) + 2),
+      '_plate': plate,
+  })
+
+
+def _model(seed: int, n_genes: int, n_cells: int, n_compounds: int,
+           n_plates: int) -> Dict[str, np.ndarray]:
+  """Parameters of the expression model"""
+  rng = np.random.default_rng([seed, 1])
+  return {
+      'baseline': rng.uniform(4, 12, n_genes).astype(np.float32),
+      'cell': rng.normal(0, 0.5, (n_cells, n_genes)).astype(np.float32),
+      'loadings': rng.normal(0, 1, (n_compounds, _RANK)).astype(np.float32),
+      'programs': rng.normal(0, 0.25, (_RANK, n_genes)).astype(np.float32),
+      'plate': rng.normal(0, 0.2, max(n_plates, 1)).astype(np.float32),
+  }
+
+
+def _compound_effect(model: Dict[str, np.ndarray],
+                     compound: np.ndarray) -> np.ndarray:
+  """Signature of every compound (0 for the controls, coded -1)"""
+  signature = model['loadings'][np.maximum(compound, 0)] @ model['programs']
+  signature[compound < 0] = 0
+  return signature
+
+
+def _level3_blocks(inst: pd.DataFrame, seed: int,
+                   model: Dict[str, np.ndarray]) -> Iterator[np.ndarray]:
+  for b, start in enumerate(range(0, len(inst), _BLOCK)):
+    rows = inst.iloc[start:start + _BLOCK]
+    noise = np.random.default_rng([seed, 2, b])
+    block = (model['baseline'] + model['cell'][rows['_cell'].to_numpy()] +
+             rows['_dose'].to_numpy()[:, None] *
+             _compound_effect(model, rows['_compound'].to_numpy()) +
+             model['plate'][rows['_plate'].to_numpy()][:, None] +
+             noise.normal(0, _NOISE, (len(rows), len(model['baseline']))))
+    yield block.astype(np.float32)
+
+
+def _signatures(inst: pd.DataFrame) -> pd.DataFrame:
+  """One signature per group of replicates (cell, compound, dose, time)"""
+  keys = ['cell_id', 'pert_id', 'pert_dose', 'pert_time']
+  groups = inst.groupby(keys, sort=True)
+  sig = groups.agg(
+      pert_iname=('pert_iname', 'first'),
+      pert_type=('pert_type', 'first'),
+      distil_id=('inst_id', '|'.join),
+      _cell=('_cell', 'first'),
+      _compound=('_compound', 'first'),
+      _dose=('_dose', 'first'),
+      _n=('inst_id', 'size'),
+  ).reset_index()
+  sig.insert(
+      0, 'sig_id',
+      ['SYN_{}_{}H:{}:{:g}'.format(c, t, p, d) for c, p, d, t in zip(
+          sig.cell_id, sig.pert_id, sig.pert_dose, sig.pert_time)])
+  sig['pert_idose'] = np.where(sig.pert_dose == -666, '-666',
+                               ['{:g} uM'.format(d) for d in sig.pert_dose])
+  sig['pert_itime'] = ['{} h'.format(t) for t in sig.pert_time]
+  return sig
+
+
+def _level5_blocks(sig: pd.DataFrame, seed: int,
+                   model: Dict[str, np.ndarray]) -> Iterator[np.ndarray]:
+  # The compound signatures of the level 3 data in units of the noise,
+  # stronger with more replicates
+  for b, start in enumerate(range(0, len(sig), _BLOCK)):
+    rows = sig.iloc[start:start + _BLOCK]
+    noise = np.random.default_rng([seed, 3, b])
+    block = (rows['_dose'].to_numpy()[:, None] / _NOISE *
+             np.sqrt(rows['_n'].to_numpy())[:, None] *
+             _compound_effect(model, rows['_compound'].to_numpy()) +
+             noise.normal(0, 1, (len(rows), len(model['baseline']))))
+    yield block.astype(np.float32)
+
+
+def generate(output_dir: str,
+             n_profiles: int = 10000,
+             n_genes: int = 978,
+             n_landmarks: Optional[int] = None,
+             n_cells: int = 10,
+             n_compounds: int = 500,
+             skew: float = 1.1,
+             control_fraction: float = 0.1,
+             seed: int = 0,
+             level5: bool = True) -> Dict[str, str]:
+  """Write a synthetic LINCS release
+
+  Parameters
+  ----------
+  output_dir: str
+    Directory of the files (created if needed).
+  n_profiles: int, optional (default 10000)
+    Number of level 3 instances.
+  n_genes: int, optional (default 978)
+    Number of genes (rows) of the GCTX files.
+  n_landmarks: int, optional
+    Number of landmark genes (is_lm). Default: every gene if n_genes <=
+    978, 978 otherwise.
+  n_cells: int, optional (default 10)
+    Number of cell lines.
+  n_compounds: int, optional (default 500)
+    Number of compounds.
+  skew: float, optional (default 1.1)
+    Zipf exponent of the cell line and compound frequencies (0: uniform).
+  control_fraction: float, optional (default 0.1)
+    Fraction of vehicle controls (pert_type 'ctl_vehicle', pert_id 'DMSO').
+  seed: int, optional (default 0)
+    Seed of the generator; the files only depend on it and the sizes.
+  level5: bool, optional (default True)
+    Whether to write level5.gctx and sig_info.txt.
+
+  Returns
+  -------
+  Dict[str, str]
+    Path of every file, e.g. paths['level3'] and paths['inst_info'].
+  """
+  assert n_profiles >= 0 and n_genes > 0, "Invalid sizes"
+  assert n_cells > 0 and n_compounds > 0, "Invalid cardinalities"
+  if n_landmarks is None:
+    n_landmarks = min(n_genes, 978)
+  assert 0 < n_landmarks <= n_genes, "n_landmarks must be in 1..n_genes"
+  os.makedirs(output_dir, exist_ok=True)
+  paths = {
+      name: os.path.join(output_dir, file_name) for name, file_name in [
+          ('level3', 'level3.gctx'), ('level5', 'level5.gctx'),
+          ('inst_info', 'inst_info.txt'), ('sig_info', 'sig_info.txt'),
+          ('gene_info', 'gene_info.txt'), ('pert_info', 'pert_info.txt'),
+          ('drug_info', 'repurposing_drugs.txt')
+      ]
+  }
+  rng = np.random.default_rng(seed)
+
+  # Genes: landmarks spread over the rows, BING genes = landmarks + 80 %
+  gene_ids = (np.arange(n_genes) + 1000).astype(str)
+  is_lm = np.zeros(n_genes, dtype=int)
+  is_lm[np.sort(rng.choice(n_genes, n_landmarks, replace=False))] = 1
+  is_bing = is_lm | (rng.random(n_genes) < 0.8).astype(int)
+  pd.DataFrame({
+      'gene_id': gene_ids,
+      'gene_symbol': _names('GENE', n_genes, 5),
+      'is_lm': is_lm,
+      'is_bing': is_bing,
+  }).to_csv(paths['gene_info'], sep='\t', index=False)
+
+  inst = _instances(rng, n_profiles, n_cells, n_compounds, skew,
+                    control_fraction)
+  inst[[c for c in inst.columns if not c.startswith('_')]].to_csv(
+      paths['inst_info'], sep='\t', index=False)
+  model = _model(seed, n_genes, n_cells, n_compounds,
+                 int(inst['_plate'].max()) + 1 if len(inst) else 0)
+  write_gctx(paths['level3'], inst.inst_id, gene_ids,
+             _level3_blocks(inst, seed, model))
+
+  if level5:
+    sig = _signatures(inst)
+    sig[[
+        'sig_id', 'pert_id', 'pert_iname', 'pert_type', 'cell_id',
+        'pert_idose', 'pert_itime', 'distil_id'
+    ]].to_csv(paths['sig_info'], sep='\t', index=False)
+    write_gctx(paths['level5'], sig.sig_id, gene_ids,
+               _level5_blocks(sig, seed, model))
+  else:
+    del paths['level5'], paths['sig_info']
+
+  # Perturbations and drug repurposing hub
+  names = _names('cpd-', n_compounds, 5)
+  pd.DataFrame({
+      'pert_id': np.append(_names('BRD-K', n_compounds, 8), 'DMSO'),
+      'pert_iname': np.append(names, 'DMSO'),
+      'pert_type': ['trt_cp'] * n_compounds + ['ctl_vehicle'],
+      'is_touchstone': np.append((rng.random(n_compounds) < 0.3).astype(int), 0),
+      'inchi_key': '-666',
+      'canonical_smiles': '-666',
+  }).to_csv(paths['pert_info'], sep='\t', index=False)
+
+  in_hub = rng.random(n_compounds) < 0.5
+  n_hub = int(in_hub.sum())
+  targets = rng.choice(gene_ids, (n_hub, 2))
+  hub = pd.DataFrame({
+      'pert_iname': names[in_hub],
+      'clinical_phase': rng.choice(PHASES, n_hub),
+      'moa': rng.choice(MOAS, n_hub),
+      'target': ['GENE{}|GENE{}'.format(a, b) for a, b in targets],
+      'disease_area': rng.choice(['oncology', 'neurology', 'cardiology'], n_hub),
+      'indication': '',
+  })
+  with open(paths['drug_info'], 'w', encoding='latin-1') as f:
+    for i in range(9):
+      f.write('!synthetic drug repurposing hub, header line {}\n'.format(i + 1))
+    hub.to_csv(f, sep='\t', index=False)
+  return paths
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+  parser = argparse.ArgumentParser(description='Synthetic LINCS data')
+  parser.add_argument('output_dir', type=str)
+  parser.add_argument('--n_profiles', type=int, default=10000)
+  parser.add_argument('--n_genes', type=int, default=978)
+  parser.add_argument('--n_landmarks', type=int, default=None)
+  parser.add_argument('--n_cells', type=int, default=10)
+  parser.add_argument('--n_compounds', type=int, default=500)
+  parser.add_argument('--skew', type=float, default=1.1)
+  parser.add_argument('--control_fraction', type=float, default=0.1)
+  parser.add_argument('--seed', type=int, default=0)
+  flags = parser.parse_args(argv)
+  paths = generate(**vars(flags))
+  for name, path in paths.items():
+    print("{:<10s} {}".format(name, path))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,86 @@
+"""
+Test the replicate aggregation.
+"""
+import unittest
+
+import numpy as np
+import pandas as pd
+from cmapPy.math.robust_zscore import robust_zscore as reference_zscore
+
+from ..aggregate import consensus, robust_zscore
+from ..dataset import LincsDataset
+from ..query import group_indices
+from .test_utils import make_data
+
+
+def modz(profiles, min_weight=0.01):
+  """MODZ of one group of replicates, as cmapPy.math.agg_wt_avg"""
+  if len(profiles) == 1:
+    return profiles[0], np.ones(1)
+  correlation = pd.DataFrame(profiles.T).corr(method='spearman').to_numpy()
+  np.fill_diagonal(correlation, np.nan)
+  raw = np.maximum(np.nanmean(np.maximum(correlation, 0), axis=1), min_weight)
+  weights = raw / raw.sum()
+  return weights @ profiles, weights
+
+
+class TestAggregate(unittest.TestCase):
+  """
+  Tests the z-scores and consensus signatures against per-group computations.
+  """
+
+  @classmethod
+  def setUpClass(cls):
+    # Groups of 10 and 11 replicates, 4 groups of cell line and time
+    cls.dataset = LincsDataset.from_list(make_data(n=125, n_genes=30))
+    cls.controls = LincsDataset.from_list(make_data(n=36, n_genes=30, seed=1))
+
+  def test_robust_zscore(self):
+    """Same z-scores as cmapPy, per group and against the controls"""
+    groups = group_indices(self.dataset, ['cell_id', 'pert_time'])
+    control_groups = group_indices(self.controls, ['cell_id', 'pert_time'])
+    # PC3 has no control: it falls back to its own profiles
+    without_pc3 = self.controls.subset(
+        np.flatnonzero(self.controls.column('cell_id') != 'PC3'))
+    for controls in (None, without_pc3):
+      zscores = robust_zscore(self.dataset, controls, n_jobs=2)
+      for key, rows in groups.items():
+        profiles = pd.DataFrame(self.dataset.expression[rows].T)
+        reference = None
+        if controls is not None and key[0] != 'PC3':
+          reference = pd.DataFrame(
+              self.controls.expression[control_groups[key]].T)
+        expected = reference_zscore(profiles, reference).to_numpy().T
+        self.assertTrue(np.allclose(zscores.expression[rows], expected,
+                                    atol=1e-3), key)
+    self.assertEqual(zscores.fields, self.dataset.fields)
+
+  def test_consensus(self):
+    """MODZ signatures and weights of every group of replicates"""
+    signatures, weights = consensus(self.dataset, memory_budget=4096,
+                                    return_weights=True)
+    groups = group_indices(self.dataset,
+                           ['cell_id', 'pert_id', 'pert_dose', 'pert_time'])
+    self.assertEqual(len(signatures), len(groups))
+    for i, (key, rows) in enumerate(groups.items()):
+      expected, expected_weights = modz(
+          self.dataset.expression[rows].astype(np.float64))
+      self.assertTrue(np.allclose(signatures.expression[i], expected,
+                                  atol=1e-5))
+      self.assertTrue(np.allclose(weights[rows], expected_weights, atol=1e-5))
+      self.assertEqual(
+          tuple(signatures.column(field)[i]
+                for field in ['cell_id', 'pert_id', 'pert_dose', 'pert_time']),
+          key)
+
+    means = consensus(self.dataset, by=['cell_id'], method='mean', n_jobs=2)
+    self.assertEqual(means.fields, ('cell_id', 'pert_type', 'pert_dose_unit',
+                                    'pert_time', 'pert_time_unit'))
+    self.assertTrue(np.allclose(
+        means.expression[0],
+        self.dataset.expression[self.dataset.column('cell_id') == 'HL60'].mean(
+            axis=0)))
+
+
+if __name__ == '__main__':
+  unittest.main()
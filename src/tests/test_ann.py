@@ -0,0 +1,64 @@
+"""
+Test the approximate nearest-neighbour index.
+"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from ..ann import IVFIndex, build_index
+from ..dataset import LincsDataset
+from ..similarity import search
+from .test_utils import make_data
+
+
+class TestIVFIndex(unittest.TestCase):
+  """
+  Tests the recall, incremental insertion and persistence of IVFIndex.
+  """
+
+  @classmethod
+  def setUpClass(cls):
+    # Profiles around 20 signatures, like the compounds of LINCS
+    rng = np.random.RandomState(0)
+    centers = rng.randn(20, 50)
+    cls.profiles = (centers[rng.randint(20, size=2000)] +
+                    0.5 * rng.randn(2000, 50)).astype(np.float32)
+    data = LincsDataset.from_list(make_data(n=2000))
+    cls.dataset = LincsDataset(cls.profiles, data.codes, data.categories)
+    cls.queries = (centers[:10] + 0.5 * rng.randn(10, 50)).astype(np.float32)
+
+  def test_recall(self):
+    """Visiting every list with exact refinement gives the exact top-k"""
+    index = build_index(self.dataset, metric='pearson', n_lists=16,
+                        n_components=16)
+    exact = search(self.dataset, self.queries, k=5, metric='pearson')
+    found = index.search(self.queries, k=5, nprobe=16, data=self.dataset,
+                         refine=200)
+    self.assertTrue(np.array_equal(found.indices, exact.indices))
+    self.assertTrue(np.allclose(found.scores, exact.scores, atol=1e-5))
+
+    approximate = index.search(self.queries, k=5, nprobe=2)
+    self.assertEqual(approximate.indices.shape, (10, 5))
+
+  def test_add_save_load(self):
+    """Added profiles are found, also after save and load"""
+    index = IVFIndex(n_lists=8, n_components=16).train(self.profiles)
+    index.add(self.profiles[:1500])
+    ids = index.add(self.profiles[1500:])
+    self.assertTrue(np.array_equal(ids, np.arange(1500, 2000)))
+
+    with tempfile.TemporaryDirectory() as tmp:
+      index.save(os.path.join(tmp, 'index'))
+      loaded = IVFIndex.load(os.path.join(tmp, 'index'))
+      self.assertEqual(len(loaded), 2000)
+      found = loaded.search(self.profiles[1990:], k=1, nprobe=8,
+                            data=self.dataset, refine=10)
+      self.assertTrue(np.array_equal(found.indices[:, 0], np.arange(1990, 2000)))
+      loaded.add(self.queries)
+      self.assertEqual(len(loaded), 2010)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,61 @@
+"""
+Test the process-level dataset cache.
+"""
+import os
+import tempfile
+import unittest
+
+from ..cache import DatasetCache, dataset_cache
+from ..utils import cell_line_list, print_statistics, write_pickle
+from .test_utils import make_data
+
+
+class TestCache(unittest.TestCase):
+  """
+  Tests that datasets are loaded once and reloaded when they change.
+  """
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.tmp.name, 'sample.pkl')
+    write_pickle(self.path, make_data())
+
+  def tearDown(self):
+    dataset_cache.invalidate()
+    self.tmp.cleanup()
+
+  def test_shared_load(self):
+    """Several utils calls on one path share one load"""
+    dataset_cache.invalidate()
+    hits, misses = dataset_cache.hits, dataset_cache.misses
+    print_statistics(self.path)
+    cell_line_list(self.path, ['MCF7'])
+    # One load of the pickle and one conversion of its metadata
+    self.assertEqual(dataset_cache.misses - misses, 2)
+    self.assertEqual(dataset_cache.hits - hits, 2)
+
+    write_pickle(self.path, make_data(n=8))
+    self.assertEqual(len(cell_line_list(self.path, ['HL60'])), 2)
+
+  def test_eviction(self):
+    """Entries above the memory cap are evicted (least recently used first)"""
+    cache = DatasetCache(max_bytes=10**9)
+    paths = []
+    for i in range(3):
+      paths.append(os.path.join(self.tmp.name, '{}.pkl'.format(i)))
+      write_pickle(paths[-1], make_data())
+    loads = []
+    loader = lambda path: loads.append(path) or make_data()
+    for path in paths:
+      cache.get(path, loader)
+    cache.set_max_bytes(cache.nbytes - 1)
+    self.assertNotIn(paths[0], cache)
+    self.assertIn(paths[2], cache)
+    cache.get(paths[2], loader)
+    self.assertEqual(len(loads), 3)
+    cache.invalidate(paths[2])
+    self.assertNotIn(paths[2], cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
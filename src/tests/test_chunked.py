@@ -0,0 +1,61 @@
+"""
+Test the chunked container of the legacy list format.
+"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from ..chunked import ChunkedReader, convert_pickle, is_chunked
+from ..utils import load_dataset, load_pickle, write_pickle
+from .test_utils import make_data
+
+
+class TestChunked(unittest.TestCase):
+  """
+  Tests that chunked files give back the rows of the pickle.
+  """
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.data = make_data(n=47)
+    write_pickle(os.path.join(self.tmp.name, 'data.pkl'), self.data)
+    self.path = os.path.join(self.tmp.name, 'data.lck')
+    convert_pickle(os.path.join(self.tmp.name, 'data.pkl'),
+                   self.path,
+                   block_size=10,
+                   progress=False)
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def assertRows(self, expected, output):
+    self.assertEqual(len(expected), len(output))
+    for line, other in zip(expected, output):
+      self.assertEqual(line[0], other[0])
+      self.assertTrue(np.array_equal(line[1], other[1]))
+
+  def test_reader(self):
+    """Row ranges, single rows and lazy blocks"""
+    self.assertTrue(is_chunked(self.path))
+    reader = ChunkedReader(self.path)
+    self.assertEqual((len(reader), reader.n_blocks), (47, 5))
+    self.assertRows(self.data[8:31], reader.read_range(8, 31))
+    self.assertRows(self.data[40:], reader[40:100])
+    self.assertRows([self.data[-1]], [reader[-1]])
+    self.assertEqual([len(block) for block in reader.iter_blocks()],
+                     [10, 10, 10, 10, 7])
+
+  def test_parallel_load(self):
+    """Parallel loads give the same rows as the monolithic pickle"""
+    self.assertRows(self.data, load_pickle(self.path, n_jobs=2))
+    dataset = ChunkedReader(self.path).read(n_jobs=2,
+                                            as_dataset=True,
+                                            progress=False)
+    self.assertRows(self.data, dataset.to_list())
+    self.assertRows(self.data, load_dataset(self.path).to_list())
+
+
+if __name__ == '__main__':
+    unittest.main()
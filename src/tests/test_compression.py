@@ -0,0 +1,49 @@
+"""
+Test the compressed expression storage.
+"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from ..compression import Compression, decode_block, encode_block
+from ..dataset import LincsDataset
+from ..storage import open_dataset, save_dataset
+from .test_utils import make_data
+
+
+class TestCompression(unittest.TestCase):
+  """
+  Tests that compressed datasets decode to the original values.
+  """
+
+  def test_lossless_roundtrip(self):
+    """Byte-shuffled blocks written by the dataset writer decode exactly"""
+    dataset = LincsDataset.from_list(make_data(n=50))
+    with tempfile.TemporaryDirectory() as tmp:
+      save_dataset(os.path.join(tmp, 'data'),
+                   dataset,
+                   compression=Compression('zlib', chunk_rows=8))
+      self.assertFalse(os.path.exists(os.path.join(tmp, 'data',
+                                                   'expression.npy')))
+      output = open_dataset(os.path.join(tmp, 'data'), n_jobs=2)
+    self.assertEqual(output.expression.dtype, np.float32)
+    self.assertTrue(np.array_equal(output.expression, dataset.expression))
+    self.assertEqual(output.to_list()[7][0], dataset.to_list()[7][0])
+
+  def test_quantization(self):
+    """Quantized values are within half a step; NaN is kept"""
+    block = np.random.RandomState(0).randn(20, 6).astype(np.float32)
+    block[2, 3] = np.nan
+    for bits in (8, 16):
+      compression = Compression('none', quantize=bits)
+      output = decode_block(encode_block(block, compression), compression, 6,
+                            np.float32)
+      step = (np.nanmax(block, axis=0) - np.nanmin(block, axis=0)) / (2**bits - 2)
+      self.assertTrue(np.isnan(output[2, 3]))
+      error = np.nan_to_num(np.abs(output - block))
+      self.assertTrue(np.all(error <= step / 2 + 1e-6))
+
+if __name__ == '__main__':
+    unittest.main()
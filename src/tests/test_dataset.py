@@ -0,0 +1,61 @@
+"""
+Test the columnar LincsDataset.
+"""
+import unittest
+
+import numpy as np
+
+from ..dataset import LincsDataset
+from .test_utils import make_data
+
+
+class TestDataset(unittest.TestCase):
+  """
+  Tests the conversion from and to the legacy list format.
+  """
+
+  def test_roundtrip(self):
+    """from_list followed by to_list is lossless"""
+    data = make_data()
+    dataset = LincsDataset.from_list(data)
+    self.assertEqual(dataset.expression.dtype, np.float32)
+    self.assertEqual(dataset.expression.shape, (len(data), 8))
+    output = dataset.to_list()
+    for line, out in zip(data, output):
+      self.assertEqual(line[0], out[0])
+      self.assertEqual([type(x) for x in line[0]], [type(x) for x in out[0]])
+      np.testing.assert_array_equal(line[1], out[1])
+
+    # float64 vectors are not downcast
+    data64 = [[meta, vector.astype(np.float64) / 3] for meta, vector in data]
+    output = LincsDataset.from_list(data64).to_list()
+    self.assertEqual(output[0][1].dtype, np.float64)
+    for line, out in zip(data64, output):
+      np.testing.assert_array_equal(line[1], out[1])
+
+  def test_allinfo_fields(self):
+    """Extra (unhashable) fields of the allinfo format are kept"""
+    data = [[line[0] + (1, ['Phase 2'], ['a|b'], ['X|Y']), line[1]]
+            for line in make_data(n=10)]
+    dataset = LincsDataset.from_list(data)
+    self.assertEqual(dataset.fields[-1], 'target')
+    self.assertEqual(dataset[3][0], data[3][0])
+    self.assertEqual(len(dataset[2:5]), 3)
+
+  def test_select_genes(self):
+    """Gene projection by identifier, as a view when possible"""
+    dataset = LincsDataset.from_list(make_data(n=10))
+    dataset.gene_ids = np.array(['g{}'.format(i) for i in range(8)])
+    view = dataset.select_genes(['g2', 'g4', 'g6'])
+    self.assertTrue(np.shares_memory(view.expression, dataset.expression))
+    np.testing.assert_array_equal(view.expression, dataset.expression[:, 2:7:2])
+    copy = dataset.select_genes(['g3', 'g0'])
+    np.testing.assert_array_equal(copy.expression, dataset.expression[:, [3, 0]])
+    self.assertEqual(list(copy.gene_ids), ['g3', 'g0'])
+    self.assertEqual(copy[4][0], dataset[4][0])
+    with self.assertRaises(AssertionError):
+      dataset.select_genes(['g9'])
+
+
+if __name__ == '__main__':
+    unittest.main()
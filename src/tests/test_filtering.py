@@ -0,0 +1,86 @@
+"""
+Test the streaming filtering command line.
+"""
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from ..chunked import ChunkedReader, write_chunked
+from ..filtering import main
+from ..query_cache import configure, query_cache
+from ..storage import open_dataset, save_dataset
+from ..utils import load_pickle, parse_list, write_pickle
+from .test_utils import make_data
+
+
+class TestFiltering(unittest.TestCase):
+  """
+  Tests that the fused streaming filter keeps the expected profiles.
+  """
+
+  def test_streaming_filters(self):
+    """Chunked output equals the sequential utils filters"""
+    data = make_data(n=50)
+    expected = parse_list(parse_list(data, 0, ['MCF7', 'PC3']), 2, [1.0])
+    with tempfile.TemporaryDirectory() as tmp:
+      write_pickle(os.path.join(tmp, 'in.pkl'), data)
+      save_dataset(os.path.join(tmp, 'in'), data)
+      for source, target in [('in.pkl', 'out'), ('in', 'out.pkl')]:
+        main([
+            '--dataset_dir', os.path.join(tmp, source), '--cells', 'MCF7',
+            'PC3', '--doses', '1.0', '--chunk-size', '7', '--output_dir',
+            os.path.join(tmp, target)
+        ])
+      output = open_dataset(os.path.join(tmp, 'out')).to_list()
+      self.assertEqual([line[0] for line in output],
+                       [line[0] for line in expected])
+      output = load_pickle(os.path.join(tmp, 'out.pkl'))
+      self.assertEqual([line[0] for line in output],
+                       [line[0] for line in expected])
+
+  def test_no_match(self):
+    """A filter without matches writes an empty dataset"""
+    data = make_data(n=20)
+    with tempfile.TemporaryDirectory() as tmp:
+      write_pickle(os.path.join(tmp, 'in.pkl'), data)
+      save_dataset(os.path.join(tmp, 'in'), data)
+      expected = open_dataset(os.path.join(tmp, 'in'))
+      for source in ('in', 'in.pkl'):
+        target = os.path.join(tmp, 'out_' + source.replace('.', '_'))
+        main([
+            '--dataset_dir', os.path.join(tmp, source), '--cells', 'NOPE',
+            '--output_dir', target
+        ])
+        output = open_dataset(target)
+        self.assertEqual(len(output), 0)
+        self.assertEqual(output.fields, expected.fields)
+        self.assertEqual(output.n_genes, expected.n_genes)
+        self.assertEqual(output.expression.dtype, expected.expression.dtype)
+
+  def test_cached_chunked_input(self):
+    """A repeated query on a chunked file is answered without decoding it"""
+    data = make_data(n=50)
+    expected = parse_list(data, 0, ['MCF7'])
+    with tempfile.TemporaryDirectory() as tmp:
+      write_chunked(os.path.join(tmp, 'in.chunked'), data, block_size=8)
+      hits = query_cache.hits
+      try:
+        for i in range(2):
+          with mock.patch.object(ChunkedReader, 'metadata') as metadata:
+            main([
+                '--dataset_dir', os.path.join(tmp, 'in.chunked'), '--cells',
+                'MCF7', '--cache-dir', os.path.join(tmp, 'cache'),
+                '--output_dir', os.path.join(tmp, 'out{}.pkl'.format(i))
+            ])
+          metadata.assert_not_called()
+          output = load_pickle(os.path.join(tmp, 'out{}.pkl'.format(i)))
+          self.assertEqual([line[0] for line in output],
+                           [line[0] for line in expected])
+      finally:
+        configure(None)
+      self.assertEqual(query_cache.hits - hits, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
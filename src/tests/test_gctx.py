@@ -0,0 +1,44 @@
+"""
+Test the chunked and parallel GCTX readers.
+"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from ..benchmarks.bench_assembly import make_gctx
+from ..gctx import GctxReader
+
+
+class TestGctxReader(unittest.TestCase):
+  """
+  Tests that every read mode returns the same profiles.
+  """
+
+  @classmethod
+  def setUpClass(cls):
+    cls.tmp = tempfile.TemporaryDirectory()
+    cls.path = os.path.join(cls.tmp.name, 'sample.gctx')
+    make_gctx(cls.path, n_profiles=101, n_genes=12)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.tmp.cleanup()
+
+  def test_parallel_read(self):
+    """read_parallel matches read, whatever the number of workers"""
+    with GctxReader(self.path) as reader:
+      cidx = np.arange(3, 101, 2)
+      ridx = np.array([0, 4, 5, 11])
+      expected = reader.read(cidx, ridx)
+      self.assertEqual(expected.shape, (len(cidx), 4))
+      for n_jobs, chunk_size in [(2, None), (3, 5)]:
+        block = reader.read_parallel(cidx, ridx, n_jobs=n_jobs,
+                                     chunk_size=chunk_size)
+        self.assertEqual(block.dtype, np.float32)
+        self.assertTrue(np.array_equal(block, expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+"""
+Test the dose / time parsing of the helper module.
+"""
+import unittest
+
+import pandas as pd
+
+from ..helper import dose_time_columns
+
+
+class TestHelper(unittest.TestCase):
+  """
+  Tests the vectorized pert_idose / pert_itime parser.
+  """
+
+  def test_dose_time_columns(self):
+    """Values, units, -666 and unit normalization"""
+    frame = pd.DataFrame({
+        'pert_idose': ['10 uM', '-666', '500 nM', '3 ng/ul', None],
+        'pert_itime': ['24 h', '-666', '30 m', '2 d', '6 h']
+    })
+    columns = dose_time_columns(frame)
+    self.assertEqual(list(columns.pert_dose), [10.0, -666.0, 500.0, 3.0, -666.0])
+    self.assertEqual(list(columns.pert_dose_unit),
+                     ['uM', '-666', 'nM', 'ng/ul', '-666'])
+    self.assertEqual(columns.pert_time.dtype, float)
+
+    columns = dose_time_columns(frame, normalize=True)
+    self.assertEqual(list(columns.pert_dose), [10.0, -666.0, 0.5, 3.0, -666.0])
+    self.assertEqual(list(columns.pert_dose_unit),
+                     ['um', '-666', 'um', 'ng/ul', '-666'])
+    self.assertEqual(list(columns.pert_time), [24.0, -666.0, 0.5, 48.0, 6.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
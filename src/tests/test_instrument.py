@@ -0,0 +1,74 @@
+"""
+Test the stage instrumentation.
+"""
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+
+from .. import instrument
+from ..instrument import instrumented, stage
+from ..utils import parse_list
+from .test_utils import make_data
+
+
+class TestInstrument(unittest.TestCase):
+  """
+  Tests the stage events of the hooks and of the JSON log.
+  """
+
+  def tearDown(self):
+    instrument.configure(enabled=False)
+    instrument.instrumentation.hooks.clear()
+
+  def test_disabled_by_default(self):
+    """Stages record nothing, and filters print nothing, by default"""
+    events = []
+    instrument.add_hook(events.append)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      with stage('outer') as current:
+        current.rows = 10
+        current.info['kept'] = 5
+      parse_list(make_data(n=8), 0, ['MCF7'])
+    self.assertEqual(events, [])
+    self.assertEqual(output.getvalue(), '')
+
+  def test_nested_stages(self):
+    """Events carry the stage path, rows and wall time, also in the log"""
+    events = []
+    with tempfile.TemporaryDirectory() as tmp:
+      log_path = os.path.join(tmp, 'stages.json')
+      instrument.configure(log_path=log_path, hook=events.append)
+
+      @instrumented()
+      def run():
+        with stage('inner', rows=3):
+          pass
+        return [1, 2]
+
+      self.assertEqual(run(), [1, 2])
+      with self.assertRaises(ValueError):
+        with stage('failing'):
+          raise ValueError()
+      output = parse_list(make_data(n=8), 0, ['MCF7'])
+
+      self.assertEqual([e.path for e in events], [
+          'run/inner', 'run', 'failing', 'parse_list/load', 'parse_list'
+      ])
+      self.assertEqual([e.rows for e in events], [3, 2, None, 8, 8])
+      self.assertEqual(events[-1].info, {
+          'field': 'cell_lines',
+          'kept': len(output)
+      })
+      self.assertEqual(events[2].error, 'ValueError')
+      self.assertTrue(all(e.wall_s >= 0 for e in events))
+      with open(log_path) as f:
+        logged = [json.loads(line) for line in f]
+    self.assertEqual([e['stage'] for e in logged], [e.path for e in events])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,62 @@
+"""
+Test the typed, cached metadata loader.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+from ..metadata import cache_path, read_metadata
+
+
+class TestMetadata(unittest.TestCase):
+  """
+  Tests read_metadata and its on-disk cache.
+  """
+
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmp, 'inst_info.txt')
+    pd.DataFrame({
+        'inst_id': ['i0', 'i1', 'i2'],
+        'cell_id': ['MCF7', 'A375', 'MCF7'],
+        'pert_dose': [10.0, -666.0, 1.0],
+        'pert_dose_unit': ['um', '-666', 'um'],
+        'pert_time': [24, 6, 24]
+    }).to_csv(self.path, sep='\t', index=False)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def test_typed_and_cached(self):
+    """Explicit dtypes, and a binary table that is rebuilt on change"""
+    frame = read_metadata(self.path)
+    self.assertEqual(frame.cell_id.dtype, 'category')
+    self.assertEqual(frame.inst_id.dtype, object)
+    self.assertEqual(list(frame.pert_dose_unit != '-666'), [True, False, True])
+    self.assertTrue(os.path.exists(cache_path(self.path)))
+    self.assertTrue(frame.equals(read_metadata(self.path, cache=False)))
+    self.assertEqual(list(read_metadata(self.path, usecols=['inst_id'])),
+                     ['inst_id'])
+
+    with open(self.path, 'a') as f:
+      f.write('i3\tPC3\t5.0\tum\t48\n')
+    self.assertEqual(list(read_metadata(self.path).cell_id),
+                     ['MCF7', 'A375', 'MCF7', 'PC3'])
+
+  def test_copy(self):
+    """In-place edits of a returned table do not reach the cache"""
+    frame = read_metadata(self.path)
+    frame.loc[0, 'pert_dose'] = 0.0
+    frame.loc[1, 'cell_id'] = 'MCF7'
+    columns = read_metadata(self.path, usecols=['inst_id', 'pert_dose'])
+    columns.loc[2, 'pert_dose'] = 0.0
+    frame = read_metadata(self.path)
+    self.assertEqual(list(frame.pert_dose), [10.0, -666.0, 1.0])
+    self.assertEqual(list(frame.cell_id), ['MCF7', 'A375', 'MCF7'])
+
+
+if __name__ == '__main__':
+  unittest.main()
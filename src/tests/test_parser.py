@@ -0,0 +1,114 @@
+"""
+Test the parsers on a synthetic LINCS release.
+"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from ..dataset import FIELDS
+from ..parser import parsing_level3_cp, parsing_level5_cp
+from ..synthetic import generate
+
+
+class TestParser(unittest.TestCase):
+  """
+  Tests the level 3 and level 5 parsers against the generated metadata.
+  """
+
+  @classmethod
+  def setUpClass(cls):
+    cls.tmp = tempfile.TemporaryDirectory()
+    cls.paths = generate(os.path.join(cls.tmp.name, 'synthetic'),
+                         n_profiles=600,
+                         n_genes=40,
+                         n_landmarks=12,
+                         n_cells=4,
+                         n_compounds=30)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.tmp.cleanup()
+
+  def test_generate_is_deterministic(self):
+    """The same seed gives the same files"""
+    paths = generate(os.path.join(self.tmp.name, 'again'),
+                     n_profiles=600,
+                     n_genes=40,
+                     n_landmarks=12,
+                     n_cells=4,
+                     n_compounds=30)
+    for name in ('inst_info', 'sig_info', 'gene_info', 'drug_info'):
+      with open(self.paths[name], 'rb') as f, open(paths[name], 'rb') as g:
+        self.assertEqual(f.read(), g.read())
+
+  def test_level3(self):
+    """Every parsing mode returns the trt_cp profiles on the landmarks"""
+    paths = self.paths
+    expected = parsing_level3_cp(paths['level3'], paths['inst_info'],
+                                 paths['gene_info'])
+    outputs = [
+        parsing_level3_cp(paths['level3'], paths['inst_info'],
+                          paths['gene_info'], **kwargs).to_list()
+        for kwargs in [dict(as_dataset=True),
+                       dict(as_dataset=True, chunk_size=64),
+                       dict(as_dataset=True, chunk_size=64, n_jobs=2)]
+    ]
+    plates = parsing_level3_cp(paths['level3'], paths['inst_info'],
+                               paths['gene_info'], as_dataset=True,
+                               fields=FIELDS + ('rna_plate',))
+
+    inst_info = pd.read_csv(paths['inst_info'], sep='\t')
+    self.assertEqual(len(expected), (inst_info.pert_type == 'trt_cp').sum())
+    self.assertEqual(len(expected[0][1]), 12)
+    for output in outputs:
+      self.assertEqual([line[0] for line in expected],
+                       [line[0] for line in output])
+      self.assertTrue(
+          np.array_equal(np.stack([line[1] for line in expected]),
+                         np.stack([line[1] for line in output])))
+    self.assertEqual(plates.fields, FIELDS + ('rna_plate',))
+    self.assertEqual(
+        sorted(plates.column('rna_plate')),
+        sorted(inst_info.rna_plate[inst_info.pert_type == 'trt_cp']))
+
+  def test_level3_gse70138(self):
+    """pert_idose / pert_itime units are normalized before the 'um' filter"""
+    paths = self.paths
+    inst_info = pd.read_csv(paths['inst_info'], sep='\t')
+    # GSE70138 format: '10 uM' or '500 nM' and '24 h' strings only
+    nano = np.arange(len(inst_info)) % 2 == 0
+    gse70138 = inst_info.drop(
+        columns=['pert_dose', 'pert_dose_unit', 'pert_time', 'pert_time_unit'])
+    gse70138['pert_idose'] = [
+        '{:g} nM'.format(dose * 1000) if n else '{:g} uM'.format(dose)
+        for dose, n in zip(inst_info.pert_dose, nano)
+    ]
+    gse70138['pert_itime'] = ['{} h'.format(t) for t in inst_info.pert_time]
+    gse70138_path = os.path.join(self.tmp.name, 'inst_info_gse70138.txt')
+    gse70138.to_csv(gse70138_path, sep='\t', index=False)
+
+    expected = parsing_level3_cp(paths['level3'], paths['inst_info'],
+                                 paths['gene_info'], as_dataset=True)
+    output = parsing_level3_cp(paths['level3'], gse70138_path,
+                               paths['gene_info'], as_dataset=True)
+    self.assertEqual(len(output), len(expected))
+    self.assertEqual(set(output.column('pert_dose_unit')), {'um'})
+    self.assertTrue(np.allclose(output.column('pert_dose').astype(float),
+                                expected.column('pert_dose').astype(float)))
+    self.assertTrue(np.array_equal(output.expression, expected.expression))
+
+  def test_level5(self):
+    """Signatures are parsed with doses and times from pert_idose / pert_itime"""
+    paths = self.paths
+    data = parsing_level5_cp(paths['level5'], paths['sig_info'],
+                             paths['gene_info'], as_dataset=True)
+    sig_info = pd.read_csv(paths['sig_info'], sep='\t')
+    self.assertEqual(len(data), (sig_info.pert_type == 'trt_cp').sum())
+    self.assertEqual(set(data.categories['pert_time']), {6, 24})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,91 @@
+"""
+Test the partitioned datasets written by the level 5 parser.
+"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from ..benchmarks.bench_assembly import make_gctx
+from ..parser import parsing_level5_cp, parsing_level5_partitioned
+from ..partition import (open_partition, open_partitioned, prune,
+                         read_manifest, save_partitioned)
+from ..query import isin
+from ..utils import cell_line_list
+from .test_utils import make_data
+
+
+class TestPartition(unittest.TestCase):
+  """
+  Tests the partitioned writers and partition pruning.
+  """
+
+  @classmethod
+  def setUpClass(cls):
+    cls.tmp = tempfile.TemporaryDirectory()
+    cls.gctx = os.path.join(cls.tmp.name, 'level5.gctx')
+    sig_info = make_gctx(cls.gctx, n_profiles=80, n_genes=10)
+    cls.sig_info = os.path.join(cls.tmp.name, 'sig_info.txt')
+    sig_info.rename(columns={'inst_id': 'sig_id'}).to_csv(cls.sig_info,
+                                                          sep='\t',
+                                                          index=False)
+    cls.gene_info = os.path.join(cls.tmp.name, 'gene_info.txt')
+    pd.DataFrame({
+        'gene_id': [str(i) for i in range(10)],
+        'is_lm': [1, 0] * 5
+    }).to_csv(cls.gene_info, sep='\t', index=False)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.tmp.cleanup()
+
+  def test_partitions_match_cell_lines(self):
+    """Every partition holds the profiles of one parsing_level5_cp call"""
+    output_dir = os.path.join(self.tmp.name, 'level5')
+    counts = parsing_level5_partitioned(self.gctx, self.sig_info,
+                                        self.gene_info, output_dir,
+                                        cell_lines=['MCF7', 'PC3', 'A375'],
+                                        n_jobs=2)
+    self.assertEqual(sorted(counts), ['A375', 'MCF7', 'PC3'])
+    self.assertEqual(read_manifest(output_dir)['n_profiles'],
+                     sum(counts.values()))
+    self.assertEqual(len(open_partitioned(output_dir)), sum(counts.values()))
+
+    for cell in counts:
+      expected = parsing_level5_cp(self.gctx, self.sig_info, self.gene_info,
+                                   cell_line=cell)
+      output = open_partition(output_dir, cell).to_list()
+      self.assertEqual([line[0] for line in expected],
+                       [line[0] for line in output])
+      self.assertTrue(
+          np.array_equal(np.stack([line[1] for line in expected]),
+                         np.stack([line[1] for line in output])))
+
+  def test_pruning(self):
+    """Only the partitions that can match a predicate are read"""
+    output_dir = os.path.join(self.tmp.name, 'level3')
+    data = make_data(n=80)
+    counts = save_partitioned(output_dir, data, by=('cell_id', 'pert_time'))
+    self.assertEqual(sum(counts.values()), len(data))
+
+    predicate = isin('cell_id', ['MCF7']) & isin('pert_id', ['BRD-A1'])
+    self.assertEqual([p['values'] for p in prune(output_dir, predicate)],
+                     [['MCF7', 24]])
+    self.assertEqual(len(prune(output_dir, ~isin('cell_id', ['MCF7']))),
+                     len(counts) - 1)
+    self.assertEqual(len(prune(output_dir, isin('pert_id', ['BRD-A1']))),
+                     len(counts))
+    self.assertIsInstance(
+        open_partitioned(output_dir, isin('cell_id', ['MCF7'])).expression,
+        np.memmap)
+
+    expected = cell_line_list(data, ['MCF7', 'PC3'])
+    output = cell_line_list(output_dir, ['MCF7', 'PC3']).to_list()
+    self.assertEqual(sorted(line[0] for line in expected),
+                     sorted(line[0] for line in output))
+
+
+if __name__ == '__main__':
+  unittest.main()
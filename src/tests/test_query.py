@@ -0,0 +1,54 @@
+"""
+Test the vectorized filtering engine.
+"""
+import unittest
+
+import numpy as np
+
+from ..dataset import LincsDataset
+from ..query import select, isin, between, has_any
+from .test_utils import make_data
+
+
+class TestQuery(unittest.TestCase):
+  """
+  Tests that predicates match the per-row list comprehensions.
+  """
+
+  def setUp(self):
+    self.data = make_data()
+    self.dataset = LincsDataset.from_list(self.data)
+
+  def test_composed_predicates(self):
+    """AND / OR / NOT give the same rows as the list comprehension"""
+    predicate = (isin('cell_id', ['MCF7', 'A375']) &
+                 between('pert_dose', 0, 5)) | ~isin('pert_time', [24])
+    expected = [
+        i for i, line in enumerate(self.data)
+        if (line[0][0] in ['MCF7', 'A375'] and 0 < line[0][3] < 5) or
+        line[0][5] not in [24]
+    ]
+    np.testing.assert_array_equal(select(self.dataset, predicate), expected)
+
+  def test_has_any(self):
+    """Multi-valued fields match on any of their tokens"""
+    data = [[line[0] + (1, ['Phase 2'], [['a|b', 'c', 'd'][i % 3]], ['X']),
+             line[1]] for i, line in enumerate(make_data(n=9))]
+    dataset = LincsDataset.from_list(data)
+    np.testing.assert_array_equal(
+        select(dataset, has_any('moa', ['b', 'd'])), [0, 2, 3, 5, 6, 8])
+
+  def test_index_lookup(self):
+    """Index intersections return the same rows as the mask scan"""
+    predicate = (isin('cell_id', ['MCF7', 'A375']) &
+                 between('pert_dose', 0, 5)) | ~isin('pert_time', [24])
+    expected = select(self.dataset, predicate)
+    self.dataset.build_index()
+    np.testing.assert_array_equal(select(self.dataset, predicate), expected)
+    np.testing.assert_array_equal(
+        self.dataset.metadata_index.get(self.dataset, 'cell_id', 'HL60'),
+        np.arange(0, len(self.data), 4))
+
+
+if __name__ == '__main__':
+    unittest.main()
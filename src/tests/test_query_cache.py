@@ -0,0 +1,61 @@
+"""
+Test the on-disk cache of filter results.
+"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from ..dataset import LincsDataset
+from ..query import isin
+from ..query_cache import QueryCache, cached_select, configure, query_cache
+from ..utils import parse_list
+from .test_utils import make_data
+
+
+class TestQueryCache(unittest.TestCase):
+  """
+  Tests that repeated selections are answered from the cache.
+  """
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    configure(os.path.join(self.tmp.name, 'queries'))
+
+  def tearDown(self):
+    configure(None)
+    self.tmp.cleanup()
+
+  def test_repeated_selection(self):
+    """Equivalent predicates hit the cache; other metadata misses it"""
+    data = make_data()
+    hits, misses = query_cache.hits, query_cache.misses
+    expected = parse_list(data, indicator=0, query=['MCF7', 'PC3'])
+    output = parse_list(data, indicator=0, query=['PC3', 'MCF7', 'PC3'])
+    self.assertEqual(query_cache.misses - misses, 1)
+    self.assertEqual(query_cache.hits - hits, 1)
+    self.assertEqual([line[0] for line in expected],
+                     [line[0] for line in output])
+
+    other = LincsDataset.from_list(make_data(n=30))
+    rows = cached_select(other, isin('cell_id', ['PC3', 'MCF7']))
+    self.assertEqual(query_cache.misses - misses, 2)
+    self.assertEqual(len(rows), 15)
+
+  def test_eviction(self):
+    """The least recently used entries are deleted above max_bytes"""
+    cache = QueryCache(os.path.join(self.tmp.name, 'small'), max_bytes=10**6)
+    for i in range(3):
+      cache.put('dataset', 'query{}'.format(i), np.arange(1000))
+      os.utime(cache._path('dataset', 'query{}'.format(i)), (i, i))
+    cache.max_bytes = 2 * 4200
+    cache.put('dataset', 'query3', np.arange(1000))
+    self.assertIsNone(cache.get('dataset', 'query0'))
+    self.assertIsNone(cache.get('dataset', 'query1'))
+    self.assertTrue(np.array_equal(cache.get('dataset', 'query3'),
+                                   np.arange(1000)))
+
+
+if __name__ == '__main__':
+    unittest.main()
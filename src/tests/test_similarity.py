@@ -0,0 +1,80 @@
+"""
+Test the similarity search.
+"""
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from ..dataset import LincsDataset
+from ..query import isin
+from ..similarity import search, similarity_matrix
+from .test_utils import make_data
+
+
+def enrichment(profile, genes):
+  """Weighted KS enrichment, computed along the whole ranked list"""
+  order = np.argsort(-profile, kind='stable')
+  hits = np.isin(order, genes)
+  weights = np.abs(profile[order]) * hits
+  deviation = np.cumsum(weights) / weights.sum() - \
+      np.cumsum(~hits) / (len(profile) - len(genes))
+  return deviation[np.argmax(np.abs(deviation))]
+
+
+def wtcs(query, profile, n_set):
+  order = np.argsort(query, kind='stable')
+  up, down = enrichment(profile, order[-n_set:]), enrichment(profile, order[:n_set])
+  return (up - down) / 2 if np.sign(up) != np.sign(down) else 0
+
+
+class TestSimilarity(unittest.TestCase):
+  """
+  Tests the scores and the top-k search against direct computations.
+  """
+
+  @classmethod
+  def setUpClass(cls):
+    rng = np.random.RandomState(0)
+    data = LincsDataset.from_list(make_data(n=120))
+    cls.dataset = LincsDataset(
+        rng.randn(120, 60).astype(np.float32), data.codes, data.categories)
+    cls.queries = rng.randn(3, 60).astype(np.float32)
+
+  def test_metrics(self):
+    """Every metric matches its definition"""
+    profiles = self.dataset.expression.astype(np.float64)
+    ranked = pd.DataFrame(profiles).rank(axis=1).to_numpy()
+    references = {
+        'cosine': lambda q, i: q @ profiles[i] / np.linalg.norm(q) /
+                  np.linalg.norm(profiles[i]),
+        'pearson': lambda q, i: np.corrcoef(q, profiles[i])[0, 1],
+        'spearman': lambda q, i: np.corrcoef(pd.Series(q).rank(), ranked[i])[0, 1],
+        'wtcs': lambda q, i: wtcs(q, profiles[i], 10),
+    }
+    for metric, reference in references.items():
+      rows, scores = similarity_matrix(self.dataset, self.queries, metric,
+                                       n_set=10)
+      expected = [[reference(q.astype(np.float64), i) for i in rows]
+                  for q in self.queries]
+      self.assertTrue(np.allclose(scores, expected, atol=1e-5), metric)
+
+  def test_top_k(self):
+    """Blocked top-k equals a full sort, within the selected profiles"""
+    rows, scores = similarity_matrix(self.dataset, self.queries, 'pearson')
+    result = search(self.dataset, self.queries, k=7, metric='pearson',
+                    block_size=16)
+    self.assertTrue(np.array_equal(result.indices,
+                                   np.argsort(-scores, axis=1)[:, :7]))
+    lowest = search(self.dataset, self.queries, k=3, metric='pearson',
+                    largest=False)
+    self.assertTrue(np.allclose(lowest.scores, np.sort(scores, axis=1)[:, :3]))
+
+    mcf7 = search(self.dataset, self.queries, k=500, metric='spearman',
+                  predicate=isin('cell_id', ['MCF7']))
+    self.assertEqual(mcf7.indices.shape, (3, 30))
+    self.assertEqual(set(mcf7.to_frame(self.dataset)['cell_id']), {'MCF7'})
+
+
+if __name__ == '__main__':
+  unittest.main()
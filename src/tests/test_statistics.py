@@ -0,0 +1,46 @@
+"""
+Test the frequency statistics engine.
+"""
+import unittest
+from collections import Counter
+
+import numpy as np
+
+from ..dataset import LincsDataset
+from ..statistics import field_counts, summarize
+from .test_utils import make_data
+
+
+class TestStatistics(unittest.TestCase):
+  """
+  Tests that the counts reproduce collections.Counter.
+  """
+
+  def test_counter_order(self):
+    """most_common matches Counter, ties included, with and without index"""
+    data = make_data(n=97, seed=3)
+    for dataset in (LincsDataset.from_list(data),
+                    LincsDataset.from_list(data).subset(np.arange(96, -1, -2))):
+      for k in (0, 1, 3, 5):
+        values = list(dataset.column(dataset.fields[k]))
+        expected = Counter(values).most_common()
+        self.assertEqual(field_counts(dataset, dataset.fields[k]).most_common(),
+                         expected)
+        dataset.build_index()
+        dataset._stats.clear()
+        self.assertEqual(field_counts(dataset, dataset.fields[k]).most_common(),
+                         expected)
+
+  def test_summary(self):
+    """summarize caches the counts of every field on the dataset"""
+    dataset = LincsDataset.from_list(make_data())
+    summary = summarize(dataset)
+    self.assertEqual(summary.n_profiles, 60)
+    self.assertEqual(summary['cell_id'].n_unique, 4)
+    self.assertIs(summarize(dataset)['pert_id'], summary['pert_id'])
+    self.assertEqual(summary['pert_dose'].top(0, 1),
+                     [Counter(dataset.column('pert_dose')).most_common(1)[0][0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""
+Test the on-disk dataset format.
+"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from ..dataset import LincsDataset
+from ..storage import DatasetWriter, open_dataset, save_dataset
+from ..utils import parse_list
+from .test_utils import make_data
+
+
+class TestStorage(unittest.TestCase):
+  """
+  Tests writing and memory-mapping datasets.
+  """
+
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.data = make_data()
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def test_roundtrip(self):
+    """save_dataset / open_dataset keep data and metadata"""
+    dataset_dir = os.path.join(self.tmp.name, 'sample')
+    save_dataset(dataset_dir, self.data)
+    dataset = open_dataset(dataset_dir)
+    self.assertIsInstance(dataset.expression, np.memmap)
+    self.assertIsNotNone(dataset.metadata_index)
+    for line, out in zip(self.data, dataset.to_list()):
+      self.assertEqual(line[0], out[0])
+      np.testing.assert_array_equal(line[1], out[1])
+
+    output = parse_list(dataset_dir, indicator=0, query=['MCF7'])
+    self.assertEqual(len(output), len(parse_list(self.data, 0, ['MCF7'])))
+
+  def test_writer_chunks(self):
+    """Blocks with different categories are recoded consistently"""
+    dataset_dir = os.path.join(self.tmp.name, 'chunks')
+    first = LincsDataset.from_list(self.data[:25])
+    second = LincsDataset.from_list(self.data[25:][::-1])
+    with DatasetWriter(dataset_dir, first.fields, first.n_genes) as writer:
+      writer.append(first)
+      writer.append(second)
+    dataset = open_dataset(dataset_dir)
+    expected = self.data[:25] + self.data[25:][::-1]
+    self.assertEqual([line[0] for line in expected],
+                     [line[0] for line in dataset.to_list()])
+
+  def test_leading_genes(self):
+    """Projection on the genes stored first is a view of the memory map"""
+    dataset_dir = os.path.join(self.tmp.name, 'genes')
+    dataset = LincsDataset.from_list(self.data)
+    dataset.gene_ids = np.array(['g{}'.format(i) for i in range(8)])
+    landmarks = ['g5', 'g1', 'g6']
+    save_dataset(dataset_dir, dataset, leading_genes=landmarks)
+    projection = open_dataset(dataset_dir, genes=landmarks)
+    self.assertIsInstance(projection.expression, np.memmap)
+    self.assertEqual(list(projection.gene_ids), landmarks)
+    np.testing.assert_array_equal(projection.expression,
+                                  dataset.expression[:, [5, 1, 6]])
+    self.assertIsNotNone(projection.metadata_index)
+
+
+if __name__ == '__main__':
+    unittest.main()
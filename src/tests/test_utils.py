@@ -3,10 +3,31 @@ Test that utils file works.
 """
 import unittest
 
-from ..utils import load_pickle
+import numpy as np
+
+from ..dataset import LincsDataset
 from ..utils import cell_line_list
+from ..utils import parse_list
+from ..utils import parse_dose_range
+from ..utils import to_dataframe
+from ..utils import iter_dataframe
+from ..utils import parse_many
+
+
+def make_data(n=60, n_genes=8, seed=0):
+  """Small list of profiles in the legacy format"""
+  rng = np.random.RandomState(seed)
+  cells = ['HL60', 'MCF7', 'A375', 'PC3']
+  compounds = ['BRD-A1', 'BRD-B2', 'BRD-C3']
+  data = []
+  for i in range(n):
+    meta = (cells[i % len(cells)], compounds[i % len(compounds)], 'trt_cp',
+            [0.5, 1.0, 10.0][i % 3], 'um', [6, 24][i % 2], 'h')
+    data.append([meta, rng.randn(n_genes).astype(np.float32)])
+  return data
+
 
-data = load_pickle("data/sample.pkl")
+data = make_data()
 
 
 class TestUtils(unittest.TestCase):
@@ -17,13 +38,65 @@ class TestUtils(unittest.TestCase):
   def test_cell_line_list(self):
     """Check the number of cell lines in output"""
     cells = ['HL60']
-    parse_data = cell_line_list("dummy", cells, data=data)
+    parse_data = cell_line_list(data, cells)
     output_cells = [line[0][0] for line in parse_data]
     self.assertEqual(len(cells), len(list(set(output_cells))))
-    
-    
+
+  def test_dataset_input(self):
+    """LincsDataset input gives the same selection as the list input"""
+    dataset = LincsDataset.from_list(data)
+    expected = parse_list(data, indicator=1, query=['BRD-B2'])
+    output = parse_list(dataset, indicator=1, query=['BRD-B2'])
+    self.assertIsInstance(output, LincsDataset)
+    self.assertEqual([line[0] for line in expected],
+                     [line[0] for line in output.to_list()])
+    # The index is only built on the second query of a dataset
+    self.assertIsNone(dataset.metadata_index)
+    parse_list(output, 0, ['MCF7'])
+    self.assertIsNone(output.metadata_index)
+
+    expected = parse_dose_range(data, 0, 5)
+    output = parse_dose_range(dataset, 0, 5)
+    self.assertIsNotNone(dataset.metadata_index)
+    self.assertEqual(len(expected), len(output))
+
+  def test_dataframe_without_copy(self):
+    """to_dataframe(copy=False) wraps the expression matrix"""
+    dataset = LincsDataset.from_list(data)
+    expected = to_dataframe(data)
+    self.assertEqual(list(expected.dtypes[-4:]),
+                     [object, object, np.float64, np.int64])
+    output = to_dataframe(dataset, copy=False, categorical=True)
+    self.assertEqual(list(expected.columns), list(output.columns))
+    self.assertTrue(np.shares_memory(output[0].to_numpy(), dataset.expression))
+    self.assertEqual(output['cell_lines'].dtype, 'category')
+    self.assertEqual(list(expected['doses']), list(output['doses']))
+
+    output = to_dataframe(dataset, copy=False)
+    self.assertEqual(list(output.dtypes), list(expected.dtypes))
+
+    chunks = list(iter_dataframe(dataset, chunk_size=25, categorical=False))
+    self.assertEqual(list(chunks[0].dtypes), list(expected.dtypes))
+    self.assertEqual([len(chunk) for chunk in chunks], [25, 25, 10])
+    self.assertEqual(chunks[2].index[0], 50)
+    self.assertTrue(np.array_equal(chunks[1].iloc[:, :8].to_numpy(),
+                                   expected.iloc[25:50, :8].to_numpy()))
+
+  def test_parse_many(self):
+    """One grouping pass gives the parse_list output of every value"""
+    groups = parse_many(data, indicator=1)
+    self.assertEqual(list(groups), ['BRD-A1', 'BRD-B2', 'BRD-C3'])
+    for compound, parse_data in groups.items():
+      expected = parse_list(data, indicator=1, query=[compound])
+      self.assertEqual([line[0] for line in expected],
+                       [line[0] for line in parse_data])
+
+    groups = parse_many(LincsDataset.from_list(data), [0, 3],
+                        query=[('MCF7', 24), ('PC3', 6)],
+                        as_indices=True)
+    self.assertEqual(list(groups), [('MCF7', 24)])
+    self.assertEqual(len(groups[('MCF7', 24)]), 15)
+
 
 if __name__ == '__main__':
     unittest.main()
-    
-
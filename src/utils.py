@@ -1,24 +1,41 @@
 from __future__ import unicode_literals, print_function, division
-from typing import List, Tuple, Union
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
 
+import os
 import pickle
-import random
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
-from collections import Counter
+
+from .dataset import LincsDataset
+from .index import MetadataIndex
+from .storage import is_dataset_dir, open_dataset
+from .cache import dataset_cache
+from .instrument import current_stage, instrumented, stage
+from .chunked import is_chunked, load_chunked
+from .query import select, isin, between, has_any, group_indices
+from .statistics import field_counts, summarize
+from .query_cache import cached_select
+from .partition import dataset_fields, is_partitioned, open_partitioned
 
 __author__ = "Hosein Fooladi"
 __email__ = "fooladi.hosein@gmail.com"
 
 
-def load_pickle(dataset_dir: str) -> List:
+@instrumented()
+def load_pickle(dataset_dir: str, n_jobs: Optional[int] = None) -> List:
   """Loading (reading) a pickle file
 
+  Files in the chunked container format (see chunked.py) are read block
+  by block, with a progress bar.
+
   Parameters
   ----------
   dataset_dir: str
     It must be string file that shows the directory of the dataset.
+  n_jobs: int, optional
+    Number of threads reading the blocks of a chunked file from disk
+    (they are unpickled one at a time, see ChunkedReader.read).
+    Default=None
 
   Returns
   -------
@@ -26,10 +43,13 @@ def load_pickle(dataset_dir: str) -> List:
   """
   assert isinstance(dataset_dir, str), "The dataset_dir must be a string object"
 
-  fp = open(dataset_dir, 'rb')
-  return pickle.load(fp)
+  if is_chunked(dataset_dir):
+    return load_chunked(dataset_dir, n_jobs=n_jobs)
+  with open(dataset_dir, 'rb') as fp:
+    return pickle.load(fp)
 
 
+@instrumented()
 def write_pickle(dataset_dir: str, data: List) -> None:
   """Writing a file (data) into a pickle file (dataset_dir)
 
@@ -42,11 +62,153 @@ def write_pickle(dataset_dir: str, data: List) -> None:
   """
   assert isinstance(dataset_dir, str), "The dataset_dir must be a string object"
 
-  fp = open(dataset_dir, 'wb')
-  pickle.dump(data, fp)
+  with open(dataset_dir, 'wb') as fp:
+    pickle.dump(data, fp)
+  dataset_cache.invalidate(dataset_dir)
+
+
+@instrumented()
+def load_dataset(dataset_dir: str,
+                 build_index: bool = True,
+                 genes: Optional[Sequence[str]] = None) -> LincsDataset:
+  """Load a dataset as a LincsDataset
 
+  Datasets in the on-disk format (see storage.save_dataset) are opened
+  memory-mapped, in constant time. Old pickles (list of tuples) are
+  converted to the columnar format, and their metadata index is read from
+  (or, the first time, built and written to) the file
+  dataset_dir + '.idx.npz' next to the pickle. The result is kept in the
+  process-level dataset cache (see cache.py).
 
-def print_statistics(data: Union[str, List]) -> None:
+  Parameters
+  ----------
+  dataset_dir: str
+    It must be string file that shows the directory of the dataset.
+  build_index: bool, optional (default True)
+    Whether to attach the metadata index to the dataset.
+  genes: Sequence[str], optional
+    Only keep these genes, e.g. metadata.gene_subset(gene_info_dir,
+    'landmark'). The projection shares the cached dataset (see
+    LincsDataset.select_genes). Default=None (all of them)
+
+  Returns
+  -------
+  LincsDataset
+  """
+  assert isinstance(dataset_dir, str), "The dataset_dir must be a string object"
+  if genes is not None:
+    return load_dataset(dataset_dir, build_index).select_genes(genes)
+  data = dataset_cache.get(dataset_dir, _load_dataset, kind='dataset')
+
+  if build_index and data.metadata_index is None:
+    if is_dataset_dir(dataset_dir):
+      data.build_index()
+      return data
+
+    index_dir = dataset_dir + '.idx.npz'
+    if os.path.exists(index_dir) and \
+        os.path.getmtime(index_dir) >= os.path.getmtime(dataset_dir):
+      data.attach_index(MetadataIndex.load(index_dir))
+    else:
+      try:
+        data.build_index().save(index_dir)
+      except OSError:
+        pass
+  return data
+
+
+def _load_dataset(dataset_dir: str) -> LincsDataset:
+  if is_dataset_dir(dataset_dir):
+    return open_dataset(dataset_dir)
+  if is_partitioned(dataset_dir):
+    return open_partitioned(dataset_dir)
+  if is_chunked(dataset_dir):
+    return load_chunked(dataset_dir, as_dataset=True)
+  data = load_pickle(dataset_dir)
+  if not isinstance(data, LincsDataset):
+    data = LincsDataset.from_list(data)
+  return data
+
+
+def _load_path(dataset_dir: str) -> Union[List, LincsDataset]:
+  if is_dataset_dir(dataset_dir):
+    return open_dataset(dataset_dir)
+  if is_partitioned(dataset_dir):
+    return open_partitioned(dataset_dir)
+  return load_pickle(dataset_dir)
+
+
+def _read_data(data: Union[str, List, LincsDataset]) -> Union[List, LincsDataset]:
+  """Return the dataset behind data (loading it if data is a directory)
+
+  On-disk datasets (see storage.save_dataset) are memory-mapped rather
+  than read, and pickles are unpickled. Loaded datasets are kept in the
+  process-level dataset cache, so calling several functions on the same
+  directory loads it only once.
+  """
+  assert isinstance(data, (str, list, LincsDataset)), \
+      "The data should be string, list or LincsDataset object"
+  if isinstance(data, str):
+    return dataset_cache.get(data, _load_path)
+  return data
+
+
+def _columns(train: Union[List, LincsDataset]) -> LincsDataset:
+  """Columnar (categorical-coded) view of the metadata of train
+
+  A LincsDataset gets its metadata index built (once) on its second query,
+  so that the filters answer repeated queries from the index. Building it
+  costs about one sort per field, more than the single mask scan of one
+  query: transient datasets (e.g. the subset returned by a filter) that
+  are queried once are scanned without an index.
+  """
+  if isinstance(train, LincsDataset):
+    train._n_queries += 1
+    if train._n_queries > 1:
+      train.build_index()
+    return train
+  return LincsDataset.from_list(train, expression=False)
+
+
+def _load(data: Union[str, List, LincsDataset],
+          prune: Optional[Tuple[int, List]] = None
+         ) -> Tuple[Union[List, LincsDataset], LincsDataset]:
+  """The dataset behind data and its columnar view
+
+  For a pickle given by its directory, the columnar view is cached along
+  with the pickle, so its statistics are computed only once.
+
+  prune: (k, values) of the isin filter on the k-th field that the caller
+  applies next. Partitions of a partitioned dataset (see partition.py)
+  that cannot hold such values are not read.
+  """
+  with stage('load') as current:
+    if isinstance(data, str) and prune is not None and is_partitioned(data):
+      predicate = isin(dataset_fields(data)[prune[0]], prune[1])
+      train = open_partitioned(data, predicate=predicate)
+      current.rows = len(train)
+      return train, train
+    train = _read_data(data)
+    current.rows = len(train)
+    if isinstance(data, str) and isinstance(train, list):
+      columns = dataset_cache.get(
+          data,
+          lambda path: LincsDataset.from_list(train, expression=False),
+          kind='columns')
+      return train, columns
+    return train, _columns(train)
+
+
+def _take(train: Union[List, LincsDataset],
+          indices: np.ndarray) -> Union[List, LincsDataset]:
+  """Keep the profiles at indices, in the same format as train"""
+  if isinstance(train, LincsDataset):
+    return train.subset(indices)
+  return [train[i] for i in indices]
+
+
+@instrumented()
+def print_statistics(data: Union[str, List, LincsDataset]) -> None:
   """Print data statistics
 
   This function takes the directory of dataset and
@@ -54,50 +216,39 @@ def print_statistics(data: Union[str, List]) -> None:
 
   Parameters
   ----------
-  data: Union[str, List]
+  data: Union[str, List, LincsDataset]
     the data can be a string which is the directory of the dataset.
     dataset should be a pickle file. e.g., valid argument is something like this:
     './Data/level3_trt_cp_landmark.pkl'
+    or a dataset directory written by storage.save_dataset (memory-mapped).
     or it can be a list which contains the gene expression and metadata.
     It must be a list of tuples with the following format:
     line[0]:(cell_line, drug, drug_type, does, does_type, time, time_type)
     line[1]: 978 or 12328-dimensional Vector(Gene_expression_profile)
+    or a LincsDataset.
 
   """
 
   print("=================================================================")
-  print("Data Loading..")
 
-  assert isinstance(data,
-                    (str, list)), "The data should be string or list object"
-  if isinstance(data, str):
-    with open(data, "rb") as f:
-      train = pickle.load(f)
-  else:
-    assert isinstance(data, list), "The data must be a list object"
-    train = data
+  train, columns = _load(data)
+  current_stage().rows = len(train)
 
   print("Data Statistics\n")
   print("Number of Train Data: {}".format(len(train)))
 
-  print("Please wait while we are retriving information ...")
-  cell_lines = []
-  compounds = []
-  doses = []
-  times = []
-  for i in range(len(train)):
-    cell_lines.append(train[i][0][0])
-    compounds.append(train[i][0][1])
-    doses.append(train[i][0][3])
-    times.append(train[i][0][5])
+  summary = summarize(columns, [columns.fields[k] for k in (0, 1, 3, 5)])
 
-  print("Number of unique Cell Lines: {}".format(len(set(cell_lines))))
-  print("Number of unique Compounds: {}".format(len(set(compounds))))
-  print("Number of unique doses: {}".format(len(set(doses))))
-  print("Number of unique times: {}".format(len(set(times))))
+  print("Number of unique Cell Lines: {}".format(
+      summary[columns.fields[0]].n_unique))
+  print("Number of unique Compounds: {}".format(
+      summary[columns.fields[1]].n_unique))
+  print("Number of unique doses: {}".format(summary[columns.fields[3]].n_unique))
+  print("Number of unique times: {}".format(summary[columns.fields[5]].n_unique))
 
 
-def print_most_frequent(data: Union[str, List], n: int = 3) -> None:
+@instrumented()
+def print_most_frequent(data: Union[str, List, LincsDataset], n: int = 3) -> None:
   """Print most frequent cell line, compounds, and does.
 
   This function takes the directory of dataset (or a list object) and integer n
@@ -106,14 +257,16 @@ def print_most_frequent(data: Union[str, List], n: int = 3) -> None:
 
   Parameters
   ----------
-  data: Union[str, List]
+  data: Union[str, List, LincsDataset]
     the data can be a string which is the directory of the dataset.
     dataset should be a pickle file. e.g., valid argument is something like this:
     './Data/level3_trt_cp_landmark.pkl'
+    or a dataset directory written by storage.save_dataset (memory-mapped).
     or it can be a list which contains the gene expression and metadata.
     It must be a list of tuples with the following format:
     line[0]:(cell_line, drug, drug_type, does, does_type, time, time_type)
     line[1]: 978 or 12328-dimensional Vector(Gene_expression_profile)
+    or a LincsDataset.
   n: int, optional (default 3)
     An integer which determine number of frequent statistics we want
     to retrieve. Default=3.
@@ -121,36 +274,23 @@ def print_most_frequent(data: Union[str, List], n: int = 3) -> None:
   """
 
   print("=================================================================")
-  print("Data Loading..")
 
   assert isinstance(n, int), "The parameter n must be an integer"
-  assert isinstance(data,
-                    (str, list)), "The data should be string or list object"
-  if isinstance(data, str):
-    with open(data, "rb") as f:
-      train = pickle.load(f)
-  else:
-    assert isinstance(data, list), "The data must be a list object"
-    train = data
-
-  print("Please wait while we are retriving information ...")
-  cell_lines = []
-  compounds = []
-  doses = []
-  for i in tqdm(range(len(train))):
-    cell_lines.append(train[i][0][0])
-    compounds.append(train[i][0][1])
-    doses.append(train[i][0][3])
+  train, columns = _load(data)
+  current_stage().rows = len(train)
 
-  print("loop finished !!!")
+  summary = summarize(columns, [columns.fields[k] for k in (0, 1, 3)])
 
   print("Most frequent Cell Lines: {}".format(
-      Counter(cell_lines).most_common(n)))
-  print("Most frequent Compounds: {}".format(Counter(compounds).most_common(n)))
-  print("Most frequent Doses: {}".format(Counter(doses).most_common(n)))
+      summary[columns.fields[0]].most_common(n)))
+  print("Most frequent Compounds: {}".format(
+      summary[columns.fields[1]].most_common(n)))
+  print("Most frequent Doses: {}".format(
+      summary[columns.fields[3]].most_common(n)))
 
 
-def cell_line_frequent(data: Union[str, List], n: int = 3) -> List:
+@instrumented()
+def cell_line_frequent(data: Union[str, List, LincsDataset], n: int = 3) -> List:
   """Returns list of data belongs to most frequent cell lines
 
   This function takes the directory of dataset (or a list object) and integer n,
@@ -159,14 +299,16 @@ def cell_line_frequent(data: Union[str, List], n: int = 3) -> List:
 
   Parameters
   ----------
-  data: Union[str, List]
+  data: Union[str, List, LincsDataset]
     the data can be a string which is the directory of the dataset.
     dataset should be a pickle file. e.g., valid argument is something like this:
     './Data/level3_trt_cp_landmark.pkl'
+    or a dataset directory written by storage.save_dataset (memory-mapped).
     or it can be a list which contains the gene expression and metadata.
     It must be a list of tuples with the following format:
     line[0]:(cell_line, drug, drug_type, does, does_type, time, time_type)
     line[1]: 978 or 12328-dimensional Vector(Gene_expression_profile)
+    or a LincsDataset (the output then is a LincsDataset as well).
 
   n: int, optional (default 3)
     An integer which determine number of frequent statistics we want
@@ -179,44 +321,30 @@ def cell_line_frequent(data: Union[str, List], n: int = 3) -> List:
 
   """
 
-  print("=================================================================")
-  print("Data Loading..")
-
   assert isinstance(n, int), "The parameter n must be an integer"
-  assert isinstance(data,
-                    (str, list)), "The data should be string or list object"
-  if isinstance(data, str):
-    with open(data, "rb") as f:
-      train = pickle.load(f)
-  else:
-    assert isinstance(data, list), "The data must be a list object"
-    train = data
+  train, columns = _load(data)
 
-  print("Please wait while we are retriving information ...")
-  cell_lines = []
+  cell_lines = field_counts(columns, columns.fields[0])
 
-  for i in tqdm(range(len(train))):
-    cell_lines.append(train[i][0][0])
+  current_stage().info['n_unique'] = cell_lines.n_unique
+  current_stage().info['most_common'] = cell_lines.most_common(n)
 
-  print("Number of unique Cell Lines: {}".format(len(set(cell_lines))))
-  print("Most frequent Cell Lines: {}".format(
-      Counter(cell_lines).most_common(n)))
-
-  if n > len(set(cell_lines)):
+  if n > cell_lines.n_unique:
     import warnings
     warnings.warn(
         "n is greater than number of unique cell lines available in the dataset"
     )
 
   # List of n most frequent cell lines
-  x = list(map(lambda x: x[0], Counter(cell_lines).most_common(n)))
+  x = cell_lines.top(0, n)
 
-  parse_data = [line for line in train if line[0][0] in x]
+  parse_data = _take(train, select(columns, isin(columns.fields[0], x)))
 
   return parse_data
 
 
-def cell_line_list(data: Union[str, List], cells: List[str] = ['MCF7']) -> List:
+@instrumented()
+def cell_line_list(data: Union[str, List, LincsDataset], cells: List[str] = ['MCF7']) -> List:
   """Filter data based on desired cell line list
 
   This function takes the directory of dataset (or alist object) and a list cells,
@@ -224,14 +352,16 @@ def cell_line_list(data: Union[str, List], cells: List[str] = ['MCF7']) -> List:
 
   Parameters
   ----------
-  data: Union[str, List]
+  data: Union[str, List, LincsDataset]
     the data can be a string which is the directory of the dataset.
     dataset should be a pickle file. e.g., valid argument is something like this:
     './Data/level3_trt_cp_landmark.pkl'
+    or a dataset directory written by storage.save_dataset (memory-mapped).
     or it can be a list which contains the gene expression and metadata.
     It must be a list of tuples with the following format:
     line[0]:(cell_line, drug, drug_type, does, does_type, time, time_type)
     line[1]: 978 or 12328-dimensional Vector(Gene_expression_profile)
+    or a LincsDataset (the output then is a LincsDataset as well).
 
   cells: List[str]
     list of cell lines that we want to keep their data to retrieve. Default=['MCF7']
@@ -245,27 +375,19 @@ def cell_line_list(data: Union[str, List], cells: List[str] = ['MCF7']) -> List:
 
   assert isinstance(cells, list), "The parameter cells must be a list"
 
-  print("=================================================================")
-  print("Data Loading..")
-
-  assert isinstance(data,
-                    (str, list)), "The data should be string or list object"
-  if isinstance(data, str):
-    with open(data, "rb") as f:
-      train = pickle.load(f)
-  else:
-    assert isinstance(data, list), "The data must be a list object"
-    train = data
+  # Partitioned datasets: only the partitions of cells are read
+  train, columns = _load(data, prune=(0, cells))
 
-  print("Number of Train Data: {}".format(len(train)))
+  current_stage().rows = len(train)
 
-  parse_data = [line for line in train if line[0][0] in cells]
+  parse_data = _take(train, select(columns, isin(columns.fields[0], cells)))
 
-  print("Number of Data after parsing: {}".format(len(parse_data)))
+  current_stage().info['kept'] = len(parse_data)
   return parse_data
 
 
-def parse_list(data: Union[str, List],
+@instrumented()
+def parse_list(data: Union[str, List, LincsDataset],
                indicator: int = 0,
                query=['MCF7']) -> List:
   """Filter the data based on compound, cell line, dose or time
@@ -278,14 +400,16 @@ def parse_list(data: Union[str, List],
 
   Parameters
   ----------
-  data: Union[str, List]
+  data: Union[str, List, LincsDataset]
     the data can be a string which is the directory of the dataset.
     dataset should be a pickle file. e.g., valid argument is something like this:
     './Data/level3_trt_cp_landmark.pkl'
+    or a dataset directory written by storage.save_dataset (memory-mapped).
     or it can be a list which contains the gene expression and metadata.
     It must be a list of tuples with the following format:
     line[0]:(cell_line, drug, drug_type, does, does_type, time, time_type)
     line[1]: 978 or 12328-dimensional Vector(Gene_expression_profile)
+    or a LincsDataset (the output then is a LincsDataset as well).
 
   indicator: int 
     it must be an integer from 0 1 2 and 3 that shows whether
@@ -313,32 +437,107 @@ def parse_list(data: Union[str, List],
                        3], "You should choose indicator from 0, 1, 2 range"
   assert isinstance(query, list), "The parameter query must be a list"
 
-  print("=================================================================")
-  print("Data Loading..")
-
-  assert isinstance(data,
-                    (str, list)), "The data should be string or list object"
-  if isinstance(data, str):
-    with open(data, "rb") as f:
-      train = pickle.load(f)
-  else:
-    assert isinstance(data, list), "The data must be a list object"
-    train = data
-
   mapping = {0: 0, 1: 1, 2: 3, 3: 5}
   k = mapping[indicator]
   mapping_name = {0: 'cell_lines', 1: 'compounds', 2: 'doses', 3: 'time'}
 
-  print("Number of Train Data: {}".format(len(train)))
-  print("You are parsing the data base on {}".format(mapping_name[indicator]))
+  # Partitioned datasets: only the partitions that can match are read
+  train, columns = _load(data, prune=(k, query))
+
+  current_stage().rows = len(train)
+  current_stage().info['field'] = mapping_name[indicator]
 
-  parse_data = [line for line in train if line[0][k] in query]
+  parse_data = _take(train,
+                     cached_select(columns, isin(columns.fields[k], query)))
 
-  print("Number of Data after parsing: {}".format(len(parse_data)))
+  current_stage().info['kept'] = len(parse_data)
   return parse_data
 
 
-def parse_most_frequent(data: Union[str, List],
+@instrumented()
+def parse_many(data: Union[str, List, LincsDataset],
+               indicator: Union[int, List[int]] = 1,
+               query: Optional[List] = None,
+               as_indices: bool = False) -> Dict:
+  """Filter the data for many values (or combinations of values) at once
+
+  This function partitions the dataset by cell line, compound, dose, time
+  (or a combination of them, e.g. cell line x compound x time) in a single
+  pass, and returns the parsed data of every value. It is equivalent to
+  calling parse_list once per value, without rescanning the dataset.
+
+  Parameters
+  ----------
+  data: Union[str, List, LincsDataset]
+    the data can be a string which is the directory of the dataset.
+    dataset should be a pickle file. e.g., valid argument is something like this:
+    './Data/level3_trt_cp_landmark.pkl'
+    or a dataset directory written by storage.save_dataset (memory-mapped).
+    or it can be a list which contains the gene expression and metadata.
+    It must be a list of tuples with the following format:
+    line[0]:(cell_line, drug, drug_type, does, does_type, time, time_type)
+    line[1]: 978 or 12328-dimensional Vector(Gene_expression_profile)
+    or a LincsDataset (the output then is a LincsDataset as well).
+
+  indicator: Union[int, List[int]], optional (default 1)
+    What the data is grouped by (same codes as parse_list_v2):
+    0: cell_lines
+    1: compounds
+    2: doses
+    3: time
+    4: touchstone
+    5: clinical phase
+    6: moa
+    7: target
+    A list (e.g. [0, 1, 3]) groups by the combination of the fields.
+    Default=1 (compounds)
+
+  query: List, optional
+    Values (tuples of values if indicator is a list) to keep. Default=None
+    which means every value present in the dataset.
+
+  as_indices: bool, optional (default False)
+    Whether to return the row indices of every group instead of the
+    parsed data.
+
+  Returns
+  -------
+  Dict
+    Mapping from every value (or tuple of values) to the data that belongs
+    to it (a list, or a LincsDataset if data is a LincsDataset), or to its
+    row indices if as_indices is True.
+
+  """
+
+  single = isinstance(indicator, int)
+  indicators = [indicator] if single else list(indicator)
+  assert all(isinstance(i, int) and i in range(8) for i in indicators), \
+      "You should choose indicator from 0, 1, 2, 3, 4, 5, 6, 7 range"
+  assert query is None or isinstance(query, list), \
+      "The parameter query must be a list"
+
+  train, columns = _load(data)
+
+  mapping = {0: 0, 1: 1, 2: 3, 3: 5, 4: 7, 5: 8, 6: 9, 7: 10}
+  assert all(mapping[i] < len(columns.fields) for i in indicators), \
+      "The data has no such field"
+  fields = [columns.fields[mapping[i]] for i in indicators]
+
+  current_stage().rows = len(train)
+  current_stage().info['fields'] = list(fields)
+
+  if query is not None and not single:
+    query = [tuple(key) for key in query]
+  groups = group_indices(columns, fields[0] if single else fields, keys=query)
+
+  current_stage().info['groups'] = len(groups)
+  if as_indices:
+    return groups
+  return {key: _take(train, rows) for key, rows in groups.items()}
+
+
+@instrumented()
+def parse_most_frequent(data: Union[str, List, LincsDataset],
                         indicator: int = 0,
                         n: int = 3) -> List:
   """Returns most frequent data (based on cell line, compound, ...)
@@ -350,14 +549,16 @@ def parse_most_frequent(data: Union[str, List],
 
   Parameters
   ----------
-  data: Union[str, List]
+  data: Union[str, List, LincsDataset]
     the data can be a string which is the directory of the dataset.
     dataset should be a pickle file. e.g., valid argument is something like this:
     './Data/level3_trt_cp_landmark.pkl'
+    or a dataset directory written by storage.save_dataset (memory-mapped).
     or it can be a list which contains the gene expression and metadata.
     It must be a list of tuples with the following format:
     line[0]:(cell_line, drug, drug_type, does, does_type, time, time_type)
     line[1]: 978 or 12328-dimensional Vector(Gene_expression_profile)
+    or a LincsDataset (the output then is a LincsDataset as well).
 
   indicator: int, optional (default n=0) 
     It must be an integer from 0 1 2 and 3 that shows whether
@@ -385,43 +586,29 @@ def parse_most_frequent(data: Union[str, List],
                        3], "You should choose indicator from 0, 1, 2, 3 range"
   assert isinstance(n, int), "The parameter n must be an integer"
 
-  print("=================================================================")
-  print("Data Loading..")
-
-  assert isinstance(data,
-                    (str, list)), "The data should be string or list object"
-  if isinstance(data, str):
-    with open(data, "rb") as f:
-      train = pickle.load(f)
-  else:
-    assert isinstance(data, list), "The data must be a list object"
-    train = data
+  train, columns = _load(data)
 
   mapping = {0: 0, 1: 1, 2: 3, 3: 5}
   k = mapping[indicator]
   mapping_name = {0: 'cell_lines', 1: 'compounds', 2: 'doses', 3: 'time'}
 
-  mylist = []
-
-  for i in tqdm(range(len(train))):
-    mylist.append(train[i][0][k])
+  counts = field_counts(columns, columns.fields[k])
 
-  print("Number of unique {}: {}".format(mapping_name[indicator],
-                                         len(set(mylist))))
-  print("Most frequent {}: {}".format(mapping_name[indicator],
-                                      Counter(mylist).most_common(n)))
+  current_stage().info['n_unique'] = counts.n_unique
+  current_stage().info['most_common'] = counts.most_common(n)
 
-  assert n <= len(set(mylist)), "n is out of valid range!"
+  assert n <= counts.n_unique, "n is out of valid range!"
 
   # List of n most frequent cell lines
-  y = list(map(lambda x: x[0], Counter(mylist).most_common(n)))
+  y = counts.top(0, n)
 
-  parse_data = [line for line in train if line[0][k] in y]
+  parse_data = _take(train, select(columns, isin(columns.fields[k], y)))
 
   return parse_data
 
 
-def parse_chunk_frequent(data: Union[str, List],
+@instrumented()
+def parse_chunk_frequent(data: Union[str, List, LincsDataset],
                          indicator: int = 0,
                          start: int = 0,
                          end: int = 3) -> List:
@@ -435,14 +622,16 @@ def parse_chunk_frequent(data: Union[str, List],
 
   Parameters
   ----------
-  data: Union[str, List]
+  data: Union[str, List, LincsDataset]
     the data can be a string which is the directory of the dataset.
     dataset should be a pickle file. e.g., valid argument is something like this:
     './Data/level3_trt_cp_landmark.pkl'
+    or a dataset directory written by storage.save_dataset (memory-mapped).
     or it can be a list which contains the gene expression and metadata.
     It must be a list of tuples with the following format:
     line[0]:(cell_line, drug, drug_type, does, does_type, time, time_type)
     line[1]: 978 or 12328-dimensional Vector(Gene_expression_profile)
+    or a LincsDataset (the output then is a LincsDataset as well).
 
   indicator: int, optional (default n=0) 
     It must be an integer from 0 1 2 and 3 that shows whether
@@ -472,43 +661,30 @@ def parse_chunk_frequent(data: Union[str, List],
   assert isinstance(end, int), "The parameter end must be an integer"
   assert start <= end, "The start should be less than the end!!"
 
-  print("=================================================================")
-  print("Data Loading..")
-
-  assert isinstance(data,
-                    (str, list)), "The data should be string or list object"
-  if isinstance(data, str):
-    with open(data, "rb") as f:
-      train = pickle.load(f)
-  else:
-    assert isinstance(data, list), "The data must be a list object"
-    train = data
+  train, columns = _load(data)
 
   mapping = {0: 0, 1: 1, 2: 3, 3: 5}
   k = mapping[indicator]
   mapping_name = {0: 'cell_lines', 1: 'compounds', 2: 'doses', 3: 'time'}
 
-  mylist = []
+  counts = field_counts(columns, columns.fields[k])
 
-  for i in range(len(train)):
-    mylist.append(train[i][0][k])
+  current_stage().info['n_unique'] = counts.n_unique
 
-  print("Number of unique {}: {}".format(mapping_name[indicator],
-                                         len(set(mylist))))
-
-  assert end < len(set(mylist)), "end is out of valid range!"
+  assert end < counts.n_unique, "end is out of valid range!"
 
   # List of n most frequent cell lines
-  y = list(map(lambda x: x[0], Counter(mylist).most_common()))[start:end]
+  y = counts.top(start, end)
 
-  print("Desired {}: {}".format(mapping_name[indicator], y))
+  current_stage().info['selected'] = list(y)
 
-  parse_data = [line for line in train if line[0][k] in y]
+  parse_data = _take(train, select(columns, isin(columns.fields[k], y)))
 
   return parse_data
 
 
-def parse_dose_range(data: Union[str, List],
+@instrumented()
+def parse_dose_range(data: Union[str, List, LincsDataset],
                      dose_min: int = 0,
                      dose_max: int = 5) -> List:
   """
@@ -518,14 +694,16 @@ def parse_dose_range(data: Union[str, List],
 
   Parameters
   ----------
-  data: Union[str, List]
+  data: Union[str, List, LincsDataset]
     the data can be a string which is the directory of the dataset.
     dataset should be a pickle file. e.g., valid argument is something like this:
     './Data/level3_trt_cp_landmark.pkl'
+    or a dataset directory written by storage.save_dataset (memory-mapped).
     or it can be a list which contains the gene expression and metadata.
     It must be a list of tuples with the following format:
     line[0]:(cell_line, drug, drug_type, does, does_type, time, time_type)
     line[1]: 978 or 12328-dimensional Vector(Gene_expression_profile)
+    or a LincsDataset (the output then is a LincsDataset as well).
 
   dose_min: int, optional (default dose_min=0)
     minimum dose. Default=0
@@ -544,29 +722,21 @@ def parse_dose_range(data: Union[str, List],
   assert isinstance(dose_max, int), "The parameter dose_max must be an integer"
   assert dose_min < dose_max, "The minimum dose must be less than the maximum dose !!"
 
-  print("=================================================================")
-  print("Data Loading..")
-
-  assert isinstance(data,
-                    (str, list)), "The data should be string or list object"
-  if isinstance(data, str):
-    with open(data, "rb") as f:
-      train = pickle.load(f)
-  else:
-    assert isinstance(data, list), "The data must be a list object"
-    train = data
+  train, columns = _load(data)
 
-  print("Number of Train Data: {}".format(len(train)))
+  current_stage().rows = len(train)
 
-  parse_data = [
-      line for line in train if line[0][3] > dose_min and line[0][3] < dose_max
-  ]
+  parse_data = _take(
+      train, select(columns, between(columns.fields[3], dose_min, dose_max)))
 
-  print("Number of Data after parsing: {}".format(len(parse_data)))
+  current_stage().info['kept'] = len(parse_data)
   return parse_data
 
 
-def to_dataframe(data: Union[str, List]) -> pd.DataFrame:
+@instrumented()
+def to_dataframe(data: Union[str, List, LincsDataset],
+                 copy: bool = True,
+                 categorical: bool = False) -> pd.DataFrame:
   '''This takes a list and produce a pandas datframe of data
   
   The input to this function is a list which contains metadata
@@ -577,14 +747,24 @@ def to_dataframe(data: Union[str, List]) -> pd.DataFrame:
   
   Parameters
   ----------
-  data: Union[str, List]
+  data: Union[str, List, LincsDataset]
     the data can be a string which is the directory of the dataset.
     dataset should be a pickle file. e.g., valid argument is something like this:
     './Data/level3_trt_cp_landmark.pkl'
+    or a dataset directory written by storage.save_dataset (memory-mapped).
     or it can be a list which contains the gene expression and metadata.
     It must be a list of tuples with the following format:
     line[0]:(cell_line, drug, drug_type, does, does_type, time, time_type)
     line[1]: 978 or 12328-dimensional Vector(Gene_expression_profile)
+    or a LincsDataset.
+  copy: bool, optional (default True)
+    If False, the gene expression columns wrap the expression matrix of
+    the LincsDataset (memory-mapped for on-disk datasets) as one float32
+    block, without copying it. Lists are converted to a single matrix
+    first (one copy instead of three).
+  categorical: bool, optional (default False)
+    Whether the metadata columns have a pandas categorical dtype (which
+    reuses the category codes of the dataset) instead of object.
     
   Returns
   -------
@@ -594,32 +774,96 @@ def to_dataframe(data: Union[str, List]) -> pd.DataFrame:
     contains cell line, pert_id, dose, and time
     
   '''
-  assert isinstance(data,
-                    (str, list)), "The data should be string or list object"
-  if isinstance(data, str):
-    with open(data, "rb") as f:
-      train = pickle.load(f)
+  train, columns = _load(data)
+
+  if not copy:
+    if not isinstance(train, LincsDataset):
+      dtype = train[0][1].dtype if len(train) > 0 else np.float32
+      train = LincsDataset.from_list(train, dtype=dtype)
+    return _frame(train, categorical)
+
+  if isinstance(train, LincsDataset):
+    genes = train.expression
   else:
-    assert isinstance(data, list), "The data must be a list object"
-    train = data
+    genes = [line[1] for line in train]
+
+  data_df = pd.concat([pd.DataFrame(genes),
+                       pd.DataFrame(_frame_metadata(columns, categorical))],
+                      axis=1)
+  return data_df
 
-  genes = [line[1] for line in train]
-  cell_lines = [line[0][0] for line in train]
-  compounds = [line[0][1] for line in train]
-  doses = [line[0][3] for line in train]
-  times = [line[0][5] for line in train]
-
-  metadata = {
-      "cell_lines": cell_lines,
-      "compounds": compounds,
-      "doses": doses,
-      "times": times
-  }
 
-  data_df = pd.concat([pd.DataFrame(genes), pd.DataFrame(metadata)], axis=1)
+def iter_dataframe(data: Union[str, List, LincsDataset],
+                   chunk_size: int = 10000,
+                   categorical: bool = True) -> Iterator[pd.DataFrame]:
+  """Chunked version of to_dataframe
+
+  The dataset is converted chunk_size profiles at a time, so datasets that
+  do not fit in memory (e.g. memory-mapped on-disk datasets) can be
+  processed frame by frame. The frames wrap the expression matrix without
+  copying it (see to_dataframe(copy=False)) and their index continues from
+  one chunk to the next.
+
+  Parameters
+  ----------
+  data: Union[str, List, LincsDataset]
+    The dataset, in any of the formats accepted by to_dataframe.
+  chunk_size: int, optional (default 10000)
+    Number of profiles per frame.
+  categorical: bool, optional (default True)
+    Whether the metadata columns have a pandas categorical dtype.
+
+  Yields
+  ------
+  pd.DataFrame
+    Frames with the columns of to_dataframe.
+  """
+  assert isinstance(chunk_size, int) and chunk_size > 0, \
+      "chunk_size must be a positive integer"
+  train = _read_data(data)
+
+  for start in range(0, len(train), chunk_size):
+    if isinstance(train, LincsDataset):
+      chunk = train.subset(slice(start, start + chunk_size))
+    else:
+      block = train[start:start + chunk_size]
+      chunk = LincsDataset.from_list(block, dtype=block[0][1].dtype)
+    data_df = _frame(chunk, categorical)
+    data_df.index = pd.RangeIndex(start, start + len(chunk))
+    yield data_df
+
+
+def _frame_metadata(columns: LincsDataset, categorical: bool) -> dict:
+  """The four metadata columns of to_dataframe
+
+  Without categorical, every column gets the dtype pandas infers for the
+  list of its values, as in the legacy output (e.g. float64 doses and
+  int64 times). It is inferred on the categories only, which are then
+  indexed by the codes.
+  """
+  metadata = {}
+  for name, k in [("cell_lines", 0), ("compounds", 1), ("doses", 3),
+                  ("times", 5)]:
+    field = columns.fields[k]
+    if categorical:
+      metadata[name] = columns.categorical(field)
+    else:
+      values = pd.Series(columns.categories[field].tolist()).to_numpy()
+      metadata[name] = values[columns.codes[field]]
+  return metadata
+
+
+def _frame(dataset: LincsDataset, categorical: bool) -> pd.DataFrame:
+  """to_dataframe output wrapping the expression matrix of dataset"""
+  assert dataset.expression is not None, "The dataset has no expression matrix"
+  data_df = pd.DataFrame(dataset.expression, copy=False)
+  # Columns are added one by one: pd.concat would copy the expression block
+  for name, values in _frame_metadata(dataset, categorical).items():
+    data_df[name] = values
   return data_df
 
 
+@instrumented()
 def parse_list_v2(dataset_dir, indicator=0, query=['MCF7'], data=None):
   """
 This function takes the directory of dataset, indicator that indicates
@@ -669,6 +913,8 @@ Input:
         line[0]:(cell_line, drug, drug_type, does, does_type, time, time_type,
         touchstone, clinical phase, moa, target)
         line[1]: 978 or 12328-dimensional Vector(Gene_expression_profile)
+        It can also be a LincsDataset with the same fields, in which case
+        the output is a LincsDataset as well.
 
 Output:
         -:params parse_data (list): A list containing data that belongs to desired list.
@@ -686,14 +932,13 @@ based on dataset_dir.
   ], "You should choose indicator from 0, 1, 2, 3, 4, 5, 6, 7 range"
   assert isinstance(query, list), "The parameter query must be a list"
 
-  print("=================================================================")
-  print("Data Loading..")
   if data is None:
-    with open(dataset_dir, "rb") as f:
-      train = pickle.load(f)
+    train = _read_data(dataset_dir)
   else:
-    assert isinstance(data, list), "The data must be a list object"
+    assert isinstance(data, (list, LincsDataset)), \
+        "The data must be a list or LincsDataset object"
     train = data
+  columns = _columns(train)
 
   mapping = {0: 0, 1: 1, 2: 3, 3: 5, 4: 7, 5: 8, 6: 9, 7: 10}
   k = mapping[indicator]
@@ -708,20 +953,16 @@ based on dataset_dir.
       7: 'target'
   }
 
-  print("Number of Train Data: {}".format(len(train)))
-  print("You are parsing the data base on {}".format(mapping_name[indicator]))
+  current_stage().rows = len(train)
+  current_stage().info['field'] = mapping_name[indicator]
 
-  parse_data = []
   if indicator in [0, 1, 2, 3, 4]:
-    parse_data = [line for line in train if line[0][k] in query]
+    parse_data = _take(train,
+                     cached_select(columns, isin(columns.fields[k], query)))
 
   elif indicator in [5, 6, 7]:
-    for line in train:
-      tmp = line[0][k][0].split('|')
-      for a in tmp:
-        if a in query:
-          parse_data.append(line)
-          break
-
-  print("Number of Data after parsing: {}".format(len(parse_data)))
+    parse_data = _take(
+        train, cached_select(columns, has_any(columns.fields[k], query)))
+
+  current_stage().info['kept'] = len(parse_data)
   return parse_data